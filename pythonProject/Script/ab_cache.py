@@ -0,0 +1,133 @@
+import hashlib
+import os
+import threading
+import numpy as np
+
+# This module implements an on-disk cache of the 'ab' channels predicted by the network. Each prediction is stored
+# under a key computed from the 'L' network input (224x224 by default) and a fingerprint of the model files, so
+# running the folder script again on the same images (e.g. after a crash or to save them in another format) skips the
+# forward passes already done. The predictions are small (2x56x56 float32 values) compared to the images, and the least
+# recently used ones are evicted when the cache grows beyond its maximum size.
+
+# Default maximum size of the cache in MB
+DEFAULT_CACHE_SIZE = 1024
+
+
+def model_fingerprint(*paths):
+    """
+    Computes a fingerprint of the files defining the model (prototxt, caffemodel and cluster center points), so that
+    predictions made by a different model are never returned by the cache.
+
+    :param paths: paths of the model files
+    :return: hexadecimal SHA-256 digest of the content of all the files
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ABCache:
+    """
+    Content-addressed cache of 'ab' predictions, with least recently used eviction based on the total size on disk.
+    """
+
+    def __init__(self, cache_dir, fingerprint, max_size=DEFAULT_CACHE_SIZE):
+        """
+        :param cache_dir: folder where the predictions are stored, created if it doesn't exist
+        :param fingerprint: fingerprint of the model, as returned by model_fingerprint
+        :param max_size: maximum size of the cache in MB
+        """
+        if max_size <= 0:
+            raise ValueError("max_size must be positive.")
+
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.max_bytes = int(max_size * 1024 * 1024)
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(os.path.getsize(path) for path in self._entries())
+
+    def key(self, L):
+        """
+        Computes the key of a network input.
+
+        :param L: mean centered 'L' channel passed to the network
+        :return: hexadecimal key
+        """
+        L = np.ascontiguousarray(L, dtype="float32")
+        digest = hashlib.sha256(self.fingerprint.encode())
+        digest.update(str(L.shape).encode())
+        digest.update(L.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the prediction stored for a key, marking it as recently used.
+
+        :param key: key returned by the key method
+        :return: HxWx2 'ab' prediction, or None if the key is not in the cache
+        """
+        path = self._path(key)
+        try:
+            ab = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return ab
+
+    def put(self, key, ab):
+        """
+        Stores the prediction of a key, then evicts the least recently used entries if the cache is too large.
+
+        :param key: key returned by the key method
+        :param ab: HxWx2 'ab' prediction
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first, so an interrupted run never leaves a truncated entry in the cache
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as file:
+            np.save(file, np.ascontiguousarray(ab, dtype="float32"))
+
+        with self._lock:
+            # An entry already stored for the key is replaced, its size no longer counts
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(temporary_path, path)
+            self._size += os.path.getsize(path) - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".npy"):
+                    yield os.path.join(root, name)
+
+    def _evict(self):
+        # Remove the least recently used entries until the cache is back under 90% of its maximum size
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
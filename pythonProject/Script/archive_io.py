@@ -0,0 +1,216 @@
+import io
+import os
+import posixpath
+import tarfile
+import threading
+import time
+import zipfile
+
+# This module reads the images of zip and tar archives without extracting them, and writes the results into a new
+# archive, so that the scans delivered as large bundles can be colorized without extracting them to disk first and
+# without archiving the outputs afterwards. The files of an archive are read one at a time, in the order of the
+# archive, and handed over as bytes to be decoded in memory (input_preprocess.decode_image). Tar archives, compressed
+# or not, are read in a single forward pass, never seeking back. The output archive is written incrementally, one
+# file as soon as it is encoded, under a temporary name that is renamed when the archive is complete.
+
+# Extensions of the archives that can be read and written
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# tarfile modes used to write the tar archives, by extension
+_TAR_WRITE_MODES = {
+    '.tar': 'w',
+    '.tar.gz': 'w:gz',
+    '.tgz': 'w:gz',
+    '.tar.bz2': 'w:bz2',
+    '.tbz2': 'w:bz2',
+    '.tar.xz': 'w:xz',
+    '.txz': 'w:xz',
+}
+
+
+def is_archive(path):
+    """
+    :param path: path of a file or folder
+    :return: True if the path is a zip or tar archive, from its extension
+    """
+    return path.lower().endswith(ARCHIVE_EXTENSIONS) and not os.path.isdir(path)
+
+
+def archive_extension(path):
+    """
+    :param path: path of an archive
+    :return: extension of the archive, e.g. ".tar.gz"
+    """
+    for extension in sorted(ARCHIVE_EXTENSIONS, key=len, reverse=True):
+        if path.lower().endswith(extension):
+            return extension
+    raise ValueError(f"Unsupported archive: {path}")
+
+
+def _safe_name(name):
+    # Names of the files, used to build output paths: the absolute paths and the names going up the tree are unsafe,
+    # and the metadata folders added by macOS hold no images
+    name = posixpath.normpath(name)
+    if posixpath.isabs(name) or name.split("/")[0] in ("..", "__MACOSX"):
+        return None
+    return name
+
+
+def _members(path):
+    # Yields the (name, read) tuple of each file of an archive, where read returns the content of the file and must be
+    # called before moving on to the next file
+    if archive_extension(path) == ".zip":
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                name = _safe_name(info.filename)
+                if not info.is_dir() and name is not None:
+                    yield name, lambda info=info: archive.read(info)
+    else:
+        # Stream mode reads the archive forward only, decompressing it once
+        with tarfile.open(path, "r|*") as archive:
+            for member in archive:
+                name = _safe_name(member.name)
+                if member.isfile() and name is not None:
+                    yield name, lambda member=member: archive.extractfile(member).read()
+
+
+def iter_archive(path, extensions=None, selected=None):
+    """
+    Reads the files of a zip or tar archive one at a time, in the order of the archive, without extracting them.
+
+    :param path: path of the archive
+    :param extensions: optional tuple of the (lower case) extensions of the files to read, the others are skipped
+    :param selected: optional function called with the name of each file, returning False to skip it unread
+    :return: generator of (name, content) tuples, where name is the path of the file in the archive and content its
+             bytes
+    """
+    for name, read in _members(path):
+        if extensions is not None and not name.lower().endswith(extensions):
+            continue
+        if selected is None or selected(name):
+            yield name, read()
+
+
+def archive_names(path, extensions=None):
+    """
+    Lists the files of a zip or tar archive. Tar archives have no central directory: the whole archive is read, but
+    none of the files is kept in memory.
+
+    :param path: path of the archive
+    :param extensions: optional tuple of the (lower case) extensions of the files to list
+    :return: list of the names of the files, in the order of the archive
+    """
+    return [name for name, _ in _members(path) if extensions is None or name.lower().endswith(extensions)]
+
+
+class ArchiveReader:
+    """
+    Zip or tar archive whose files are read by name, one at a time, without extracting them, possibly from several
+    threads. The names are listed when the archive is opened (a single pass for tar archives), the contents are only
+    read by read. Compressed tar archives can't seek back cheaply: their files are best read in the order of the
+    archive.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the archive, the extension giving its type (see ARCHIVE_EXTENSIONS)
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        if archive_extension(path) == ".zip":
+            self._archive = zipfile.ZipFile(path)
+            members = [(info.filename, info) for info in self._archive.infolist() if not info.is_dir()]
+        else:
+            self._archive = tarfile.open(path, "r:*")
+            members = [(member.name, member) for member in self._archive.getmembers() if member.isfile()]
+        self._members = {}
+        for name, member in members:
+            name = _safe_name(name)
+            if name is not None:
+                self._members.setdefault(name, member)
+
+    def names(self):
+        """
+        :return: list of the names of the files, in the order of the archive
+        """
+        return list(self._members)
+
+    def read(self, name):
+        """
+        :param name: name of a file of the archive, as returned by names
+        :return: content of the file, bytes
+        """
+        with self._lock:
+            member = self._members[name]
+            if isinstance(self._archive, zipfile.ZipFile):
+                return self._archive.read(member)
+            return self._archive.extractfile(member).read()
+
+    def close(self):
+        """
+        Closes the archive.
+        """
+        with self._lock:
+            self._archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ArchiveWriter:
+    """
+    Zip or tar archive written incrementally, one file at a time, possibly from several threads.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the archive, the extension giving its type (see ARCHIVE_EXTENSIONS). The archive is
+                     written to path + ".part" and renamed by close
+        """
+        self.path = path
+        self.extension = archive_extension(path)
+        self._temporary_path = path + ".part"
+        self._lock = threading.Lock()
+        if self.extension == ".zip":
+            # The images are already compressed by their own format, compressing them again costs time for nothing
+            self._archive = zipfile.ZipFile(self._temporary_path, "w", zipfile.ZIP_STORED)
+        else:
+            self._archive = tarfile.open(self._temporary_path, _TAR_WRITE_MODES[self.extension])
+
+    def write(self, name, data):
+        """
+        Adds a file to the archive.
+
+        :param name: path of the file in the archive
+        :param data: content of the file, bytes
+        """
+        with self._lock:
+            if self.extension == ".zip":
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                self._archive.writestr(info, data)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = time.time()
+                self._archive.addfile(info, io.BytesIO(data))
+
+    def close(self, complete=True):
+        """
+        Closes the archive.
+
+        :param complete: True to give the archive its final name, False to leave it under its temporary name, e.g.
+                         when the run failed
+        """
+        with self._lock:
+            self._archive.close()
+            if complete:
+                os.replace(self._temporary_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
@@ -1,8 +1,20 @@
+import argparse
+import cv2
 import os
+import input_preprocess
 import save_images
+from canvas_layout import GridLayout
+from colorizer import Colorizer, add_colorizer_arguments
+from image_writer import EncoderSettings
 
-# Before running this script is necessary to run bw2color_image_folder and update
-# properly input_folders and output_path with the correct paths
+# By default this script composes the comparison of the images already saved in input_folders: before running it,
+# it is necessary to run bw2color_image_folder once for each variant and update properly input_folders and
+# output_path with the correct paths.
+#
+# With --single-pass, the script instead reads each black and white image of the --input folder once and computes
+# all the variants (plain, denoised, histogram equalized and grain/scratch removal) in memory, passing all of them
+# through the network in one batched forward pass, and composes the comparison directly. The model is loaded once
+# and the colorized variants are written to disk only if --save-intermediates is set.
 
 # folder of the images to display and compare
 input_folders = [
@@ -16,10 +28,150 @@ input_folders = [
 
 # folder where to save the benchmark image
 output_path = r"E:\PyCharm\Colorization\pythonProject\Images\Output\Benchmark"
-os.makedirs(output_path, exist_ok=True)
 
-# Read images from all the folders
-images_by_position = save_images.read_images_from_folders(input_folders)
+# Variants computed in single pass mode, in the order of save_images.BENCHMARK_CAPTIONS: name of the output
+# subfolder and prefix used when the intermediates are saved (as bw2color_image_folder does), and preprocessing
+VARIANTS = [
+    ("Colorized", "colorized", None),
+    ("Denoise", "denoised", input_preprocess.simple_denoise),
+    ("Hist_EQ", "equalized_hist", input_preprocess.equalize_bgr_image),
+    ("Remove_grain_and_scratches", "removedGrainAndScratches_", input_preprocess.remove_grain_and_scratches),
+]
+
+# Construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser()
+ap.add_argument("--single-pass", action="store_true",
+                help="compute all the variants in memory instead of reading them from input_folders")
+ap.add_argument("-i", "--input", type=str,
+                help="path to the folder containing black and white images (single pass mode)")
+ap.add_argument("-o", "--output", type=str, default=output_path,
+                help="path to the folder where the benchmark images are saved")
+ap.add_argument("--photoshop", type=str, default=None,
+                help="folder of the Photoshop colorizations, matched by file name, added as last column "
+                     "(single pass mode)")
+ap.add_argument("--save-intermediates", action="store_true",
+                help="also save the colorized variants in subfolders of the output folder (single pass mode)")
+ap.add_argument("--reduce", type=int, default=1, choices=[1, 2, 4, 8],
+                help="decode the images of input_folders at 1/reduce of their resolution")
+ap.add_argument("--columns", type=int, default=3,
+                help="number of images in each row of the comparison")
+ap.add_argument("--scale", type=float, default=1.0,
+                help="scale of the comparison, relative to the height of the tallest image")
+ap.add_argument("--thumbnail", type=int, default=None,
+                help="height in pixels of the images of the comparison, for a thumbnail-size contact sheet")
+ap.add_argument("--workers", type=int, default=2,
+                help="number of threads decoding and drawing the images of each comparison")
+ap.add_argument("--grayscale", type=str, default="auto", choices=["auto", "force", "off"],
+                help="decode the input as a single channel image: 'auto' if it is black and white, 'force' always, "
+                     "'off' never (single pass mode)")
+ap.add_argument("-b", "--batch-size", type=int, default=2,
+                help="number of input images whose variants share a forward pass (single pass mode)")
+add_colorizer_arguments(ap)
+args = vars(ap.parse_args())
+
+os.makedirs(args["output"], exist_ok=True)
+
+# Layout of the comparison images
+layout = GridLayout(columns=args["columns"], scale=args["scale"], cell_height=args["thumbnail"])
+
+
+def find_by_stem(folder, filename):
+    """
+    Returns the path of the image of the folder with the same name as filename, ignoring the extension.
+    """
+    stem = os.path.splitext(filename)[0]
+    for item in os.listdir(folder):
+        if os.path.splitext(item)[0] == stem:
+            return os.path.join(folder, item)
+    return None
+
+
+def save_intermediate(variant, filename, colorized):
+    """
+    Saves a colorized variant the same way bw2color_image_folder does.
+    """
+    folder, prefix, _ = variant
+    variant_folder = os.path.join(args["output"], folder)
+    os.makedirs(variant_folder, exist_ok=True)
+
+    encoder = EncoderSettings()
+    encoder.save(colorized, encoder.output_path(os.path.join(variant_folder, f"{prefix}_{filename}")))
+
+
+def compose_batch(batch):
+    """
+    Colorizes all the variants of a batch of images with one forward pass and saves their comparisons, named after the
+    input files as in the default mode.
+
+    :param batch: list of (filename, image) tuples
+    """
+    # Compute the preprocessed variants of each image and their network inputs
+    prepared = []
+    for filename, image in batch:
+        for _, _, preprocess in VARIANTS:
+            prepared.append(colorizer.prepare(image if preprocess is None else preprocess(image)))
+
+    # Predict the 'a' and 'b' channels of every variant of every image at once
+    ab_batch = colorizer.predict([L for _, L in prepared])
+
+    for i, (filename, image) in enumerate(batch):
+        images_at_position = [image]
+        for j, variant in enumerate(VARIANTS):
+            variant_image, _ = prepared[i * len(VARIANTS) + j]
+            colorized = colorizer.reconstruct(variant_image, ab_batch[i * len(VARIANTS) + j])
+            if args["save_intermediates"]:
+                save_intermediate(variant, filename, colorized)
+            images_at_position.append(cv2.cvtColor(colorized, cv2.COLOR_RGB2BGR))
+
+        if args["photoshop"]:
+            photoshop_path = find_by_stem(args["photoshop"], filename)
+            photoshop_image = cv2.imread(photoshop_path) if photoshop_path is not None else None
+            if photoshop_path is None:
+                print(f"[INFO] No Photoshop colorization found for {filename}")
+            elif photoshop_image is None:
+                print(f"[ERROR] Can't read the Photoshop colorization {photoshop_path}, skipped")
+            else:
+                images_at_position.append(photoshop_image)
+
+        final_image = save_images.compose_comparison(images_at_position, layout=layout)
+        output_image_path = os.path.join(args["output"], f"comparison_{save_images.normalized_stem(filename)}.jpg")
+        cv2.imwrite(output_image_path, final_image)
+        print(f"[INFO] Saved comparison of {filename} to {output_image_path}")
+
+
+if args["single_pass"]:
+    # The model arguments are checked by Colorizer.from_args, for the selected backend
+    if not args["input"]:
+        ap.error("--single-pass requires --input")
+    if args["batch_size"] < 1:
+        ap.error("--batch-size must be a positive integer")
+
+    print("[INFO] Loading model...")
+    colorizer = Colorizer.from_args(args)
+
+    filenames = [filename for filename in os.listdir(args["input"])
+                 if filename.lower().endswith(save_images.IMAGE_EXTENSIONS)]
+
+    # Decode each input once, and colorize the variants of batch_size images at a time
+    batch = []
+    for filename in filenames:
+        print(f"[INFO] Processing {filename}...")
+        image = input_preprocess.read_image(os.path.join(args["input"], filename), args["grayscale"])
+        if image is None:
+            print(f"[ERROR] Can't read the image {filename}, skipped")
+            continue
+        batch.append((filename, image))
+        if len(batch) == args["batch_size"]:
+            compose_batch(batch)
+            batch = []
+    if batch:
+        compose_batch(batch)
+
+    print("Comparison images saved.")
+else:
+    # Match the images of all the folders by file name, decoding them one position at a time
+    images_by_stem = save_images.iter_images_by_stem(input_folders, reduce=args["reduce"],
+                                                      workers=args["workers"])
 
-# Concatenate images for each position
-save_images.concatenate_images(images_by_position, output_path)
+    # Concatenate images for each position
+    save_images.save_comparisons(images_by_stem, args["output"], layout=layout, workers=args["workers"])
@@ -1,120 +1,316 @@
-import numpy as np
 import argparse
-import cv2
 import os
+import sys
+import threading
+import time
 import input_preprocess
 import save_images as save
-from PIL import Image
+from archive_io import ArchiveWriter, archive_extension, is_archive, iter_archive
+from colorizer import Colorizer, add_colorizer_arguments
+from image_writer import EncoderSettings, WriterPool, add_writer_arguments
+from instrumentation import Instrumentation, add_instrumentation_arguments, peak_memory_mb
+from pipeline import Pipeline
+from run_manifest import RunManifest, manifest_name, parse_shard, shard_of
 
 # Given an input folder containing black and white images, an output folder to save the colorized images,
 # and several flags expressed through argparse (such as histogram equalization, denoising, and grain removal),
 # this script processes each image in the input folder by applying the selected modifications and colorizes the images.
 # The processed images are then saved to the specified output folder.
+#
+# A large folder can be split between several processes or machines sharing the output folder: each one runs with
+# --shard i/N and processes the images whose name hashes to shard i, recording them in its own manifest. An image
+# that can't be processed is recorded as failed and skipped, and the exit status is 1. merge_manifests.py then
+# combines the manifests of the shards and lists the images to process again, which --files accepts.
+#
+# The input can also be a zip or tar archive: its images are read one at a time, in the order of the archive, and
+# decoded in memory without being extracted. If the output path is an archive, the colorized images are written into
+# this new archive as they are encoded, and the manifest is saved next to it.
 
 # Construct the argument parser and parse the arguments
 ap = argparse.ArgumentParser()
 ap.add_argument("-i", "--input", type=str, required=True,
-                help="path to the folder containing black and white images")
+                help="path to the folder, or zip/tar archive, containing black and white images")
 ap.add_argument("-o", "--output", type=str, required=True,
-                help="path to the output folder to save colorized images")
-ap.add_argument("-p", "--prototxt", type=str, required=True,
-                help="path to Caffe prototxt file")
-ap.add_argument("-m", "--model", type=str, required=True,
-                help="path to Caffe pre-trained model")
-ap.add_argument("-c", "--points", type=str, required=True,
-                help="path to cluster center points")
+                help="path to the output folder to save colorized images, or of a new zip/tar archive")
+add_colorizer_arguments(ap)
 ap.add_argument("--equalizeHist", action="store_true",
                 help="apply histogram equalization to the input image before coloring")
 ap.add_argument("--denoise", action="store_true",
                 help="denoise the image before coloring")
 ap.add_argument("--removeGrainAndScratches", action="store_true",
                 help="remove grain and scratches before coloring")
+ap.add_argument("--preprocessLowRes", action="store_true",
+                help="apply the preprocessing only to the downscaled network input, keeping the full resolution "
+                     "luminance of the original image")
+ap.add_argument("--grayscale", type=str, default="auto", choices=["auto", "force", "off"],
+                help="decode the input as a single channel image: 'auto' if it is black and white, 'force' always, "
+                     "'off' never")
+ap.add_argument("-b", "--batch-size", type=int, default=1,
+                help="number of images passed through the network in a single forward pass")
+ap.add_argument("--decode-workers", type=int, default=2,
+                help="number of threads reading and preprocessing the input images")
+ap.add_argument("--encode-workers", type=int, default=2,
+                help="number of threads rebuilding the full resolution colorized images")
+ap.add_argument("--queue-depth", type=int, default=8,
+                help="maximum number of images waiting between two stages of the pipeline")
+ap.add_argument("--resume", action="store_true",
+                help="skip the images already saved by a previous, interrupted run into the same output folder")
+ap.add_argument("--shard", type=parse_shard, default=None,
+                help="process only the shard i/N of the input folder (0 <= i < N), the images being assigned to the "
+                     "shards by a hash of their name")
+ap.add_argument("--files", type=str, default=None,
+                help="text file listing the names of the images to process, one per line, e.g. the images re-queued "
+                     "by merge_manifests.py")
+add_writer_arguments(ap)
+add_instrumentation_arguments(ap)
 args = vars(ap.parse_args())
 
+archive_input = is_archive(args["input"])
+archive_output = is_archive(args["output"])
+if archive_output and args["resume"]:
+    ap.error("--resume requires an output folder, an output archive is always written from scratch")
+
+# Timers and counters of the run, disabled unless a metrics output is requested
+instrumentation = Instrumentation.from_args(args)
+instrumentation.start()
+
 # Load the model and cluster center points
 print("[INFO] Loading model...")
-net = cv2.dnn.readNetFromCaffe(args["prototxt"], args["model"])
-pts = np.load(args["points"])
-
-# Add the cluster centers as 1x1 convolutions to the model
-class8 = net.getLayerId("class8_ab")
-conv8 = net.getLayerId("conv8_313_rh")
-pts = pts.transpose().reshape(2, 313, 1, 1)
-net.getLayer(class8).blobs = [pts.astype("float32")]
-net.getLayer(conv8).blobs = [np.full([1, 313], 2.606, dtype="float32")]
-
-# Check if the output directory exists
-if not os.path.exists(args["output"]):
-    # If not, create the directory
-    os.makedirs(args["output"])
-
-# The 'colorized' prefix is used to name the saved file.
+with instrumentation.timer("model_load"):
+    colorizer = Colorizer.from_args(args)
+
+# The output folder holds the manifest, and the output archive if there is one. Each shard writes its own archive
+if archive_output:
+    output_dir = os.path.dirname(os.path.abspath(args["output"]))
+    archive_path = args["output"]
+    if args["shard"]:
+        extension = archive_extension(archive_path)
+        archive_path = f"{archive_path[:-len(extension)]}.shard-{args['shard'][0]}-of-{args['shard'][1]}{extension}"
+else:
+    output_dir = args["output"]
+os.makedirs(output_dir, exist_ok=True)
+
+# Folder of the saved images, the paths in an output archive are relative to its root
+output_root = "" if archive_output else args["output"]
+
+# The 'colorized' prefix is used to name the saved file, the last preprocessing flag set replaces it.
 output_prefix = "colorized"
+if args["equalizeHist"]:
+    output_prefix = "equalized_hist"
+if args["denoise"]:
+    output_prefix = "denoised"
+if args["removeGrainAndScratches"]:
+    output_prefix = "removedGrainAndScratches_"
+
+
+# Format of the saved images
+encoder = EncoderSettings.from_args(args)
+
+
+def output_path_for(filename):
+    """
+    Returns the path where the colorized version of an input image is saved, with the extension of the output format.
+    The images of a subfolder of an input archive keep their subfolder.
+    """
+    folder, name = os.path.split(filename)
+    return encoder.output_path(os.path.join(output_root, folder, f"{output_prefix}_{name}"))
+
+
+# The manifest records the images completed (or failed) by this run, so an interrupted run can be resumed. Each shard
+# has its own manifest, so that the shards never write to the same file
+manifest = RunManifest(os.path.join(output_dir, manifest_name(args["shard"])))
+
+# Names of the images listed by --files
+listed = None
+if args["files"]:
+    with open(args["files"], "r", encoding="utf-8") as file:
+        listed = {line.strip() for line in file if line.strip()}
+
+# Number of images skipped by --resume
+resumed = [0]
+
+
+def selected(filename):
+    """
+    Checks if an image of the input is processed by this run: listed by --files, in the shard, and not already
+    processed with --resume.
+    """
+    if listed is not None and filename not in listed:
+        return False
+    if args["shard"] and shard_of(filename, args["shard"][1]) != args["shard"][0]:
+        return False
+    if args["resume"] and manifest.is_done(filename, output_path_for(filename)):
+        resumed[0] += 1
+        return False
+    return True
+
 
-# Process all images in the input directory
-for filename in os.listdir(args["input"]):
-    if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.tif')):
-        input_path = os.path.join(args["input"], filename)
-        print(f"[INFO] Processing {filename}...")
-        image = cv2.imread(input_path)
-
-        # Apply histogram equalization if the flag is set
-        if args["equalizeHist"]:
-            output_prefix = "equalized_hist"
-            print("[INFO] Applying histogram equalization...")
-            original_image = image
+# Encoded images read from the input archive and waiting to be decoded. The archive is read by the thread feeding the
+# pipeline, which stays at most --queue-depth images ahead of the decoders
+encoded_images = {}
+
+
+def archive_images():
+    """
+    Reads the selected images of the input archive in order, keeping their content for load_image.
+    """
+    for filename, data in iter_archive(args["input"], save.IMAGE_EXTENSIONS, selected):
+        encoded_images[filename] = data
+        yield filename
+
+
+# Images to process in the input directory, or streamed from the input archive
+if archive_input:
+    print(f"[INFO] Streaming the images of {args['input']}...")
+    filenames = archive_images()
+else:
+    filenames = [filename for filename in os.listdir(args["input"])
+                 if filename.lower().endswith(save.IMAGE_EXTENSIONS) and selected(filename)]
+    if args["shard"]:
+        print(f"[INFO] Shard {args['shard'][0]}/{args['shard'][1]}: {len(filenames) + resumed[0]} images.")
+    if args["resume"]:
+        print(f"[INFO] Resuming: {resumed[0]} images already processed, {len(filenames)} left.")
+
+
+# Start time of the images being processed, the time taken by each image is recorded in the manifest
+started = {}
+
+# Images that failed in this run. An image fails if any of its files, colorized image or comparison, can't be saved
+failures = set()
+failures_lock = threading.Lock()
+
+
+def load_image(filename):
+    """
+    Reads and preprocesses an image of the input directory.
+    """
+    input_path = os.path.join(args["input"], filename)
+    print(f"[INFO] Processing {filename}...")
+    started[filename] = time.perf_counter()
+    with instrumentation.timer("decode", filename):
+        if archive_input:
+            image = input_preprocess.decode_image(encoded_images.pop(filename), args["grayscale"])
+        else:
+            image = input_preprocess.read_image(input_path, args["grayscale"])
+    if image is None:
+        raise IOError(f"Can't read the image {input_path}")
+
+    # Preprocess only the network input, the comparison images are not saved in this mode
+    if args["preprocessLowRes"]:
+        with instrumentation.timer("preprocess_lowres", filename):
+            net_image = input_preprocess.preprocess_lowres(image, colorizer.net_shape(image.shape),
+                                                           equalize=args["equalizeHist"], denoise=args["denoise"],
+                                                           remove_grain=args["removeGrainAndScratches"])
+        return image, net_image
+
+    # Name of the comparisons of the preprocessing, flattened for the images of a subfolder of an input archive
+    comparison_name = filename.replace("/", "_")
+
+    def comparison_failed(path, error):
+        image_failed(filename, error)
+
+    # Apply histogram equalization if the flag is set
+    if args["equalizeHist"]:
+        print("[INFO] Applying histogram equalization...")
+        original_image = image
+        with instrumentation.timer("equalize_hist", filename):
             image = input_preprocess.equalize_bgr_image(image)
-            save.save_input_preprocess(original_image, image, filename, args["output"], "Histogram equalization")
+        save.save_input_preprocess(original_image, image, comparison_name, output_root, "Histogram equalization",
+                                   writer=writer, on_error=comparison_failed)
 
-        # Apply denoising if the flag is set
-        if args["denoise"]:
-            output_prefix = "denoised"
-            print("[INFO] Applying denoising...")
-            original_image = image
+    # Apply denoising if the flag is set
+    if args["denoise"]:
+        print("[INFO] Applying denoising...")
+        original_image = image
+        with instrumentation.timer("denoise", filename):
             image = input_preprocess.simple_denoise(image)
-            save.save_input_preprocess(original_image, image, filename, args["output"], "Denoising")
+        save.save_input_preprocess(original_image, image, comparison_name, output_root, "Denoising", writer=writer,
+                                   on_error=comparison_failed)
 
-        # Remove grain and scratches if the flag is set
-        if args["removeGrainAndScratches"]:
-            output_prefix = "removedGrainAndScratches_"
-            print("[INFO] Removing grain and stretches...")
-            original_image = image
+    # Remove grain and scratches if the flag is set
+    if args["removeGrainAndScratches"]:
+        print("[INFO] Removing grain and stretches...")
+        original_image = image
+        with instrumentation.timer("remove_grain_and_scratches", filename):
             image = input_preprocess.remove_grain_and_scratches(image)
-            save.save_input_preprocess(original_image, image, filename, args["output"],
-                                        "Denoising & morphological operations")
+        save.save_input_preprocess(original_image, image, comparison_name, output_root,
+                                    "Denoising & morphological operations", writer=writer,
+                                    on_error=comparison_failed)
+
+    return image
+
+
+def save_image(filename, colorized):
+    """
+    Queues a colorized image to be saved to the output directory by the writer pool.
+    """
+    output_path = output_path_for(filename)
+    if not archive_output:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-        # Scale the pixel intensities and convert to Lab color space
-        scaled = image.astype("float32") / 255.0
-        lab = cv2.cvtColor(scaled, cv2.COLOR_BGR2LAB)
+    def saved(path):
+        with failures_lock:
+            if filename in failures:
+                # A comparison of the image couldn't be saved, the image stays failed to be processed again
+                return
+            seconds = time.perf_counter() - started.pop(filename)
+            if archive_output:
+                manifest.record(filename, archive_path, seconds, member=path)
+            else:
+                manifest.record(filename, path, seconds)
+        print(f"[INFO] Saved colorized image to {path}")
 
-        # Resize the Lab image, extract L channel, and mean center
-        resized = cv2.resize(lab, (224, 224))
-        L = cv2.split(resized)[0]
-        L -= 50
+    writer.submit(output_path, colorized, on_done=saved, on_error=lambda path, error: image_failed(filename, error))
 
-        # Predict the 'a' and 'b' channels
-        net.setInput(cv2.dnn.blobFromImage(L))
-        ab = net.forward()[0, :, :, :].transpose((1, 2, 0))
-        ab = cv2.resize(ab, (image.shape[1], image.shape[0]))
 
-        # Combine L channel with predicted 'ab' channels
-        L = cv2.split(lab)[0]
-        colorized = np.concatenate((L[:, :, np.newaxis], ab), axis=2)
-        colorized = cv2.cvtColor(colorized, cv2.COLOR_LAB2RGB)
-        colorized = np.clip(colorized, 0, 1)
-        colorized = (255 * colorized).astype("uint8")
+def image_failed(filename, error):
+    """
+    Records an image that couldn't be processed, the other images go on.
+    """
+    with failures_lock:
+        if filename in failures:
+            return
+        failures.add(filename)
+        started.pop(filename, None)
+        manifest.record_failure(filename, error)
+    print(f"[ERROR] Failed to process {filename}: {error}")
 
-        # Save the colorized image
-        output_path = os.path.join(args["output"], f"{output_prefix}_{filename}")
 
-        # Handle file extension issues by replacing `.tif` with `.tiff` if necessary
-        if output_path.lower().endswith('.tif'):
-            output_path = output_path.replace(".tif", ".tiff")
+# Decode, colorize and save the images in overlapping stages, the files are written in the background
+archive = ArchiveWriter(archive_path) if archive_output else None
+try:
+    with WriterPool(encoder, workers=args["writer_workers"], queue_depth=args["writer_queue"],
+                    instrumentation=instrumentation, archive=archive) as writer:
+        pipeline = Pipeline(colorizer, load_image, save_image,
+                            decode_workers=args["decode_workers"], encode_workers=args["encode_workers"],
+                            queue_depth=args["queue_depth"], batch_size=args["batch_size"],
+                            instrumentation=instrumentation, on_error=image_failed)
+        pipeline.run(filenames)
+except BaseException:
+    # The archive is closed, so that it is readable, but kept under its temporary name since the run didn't finish
+    if archive is not None:
+        archive.close(complete=False)
+    raise
+if archive is not None:
+    archive.close()
+    print(f"[INFO] Saved colorized images to {archive_path}")
+if archive_input and args["resume"]:
+    print(f"[INFO] Resumed: {resumed[0]} images already processed were skipped.")
 
-        # Save using Pillow to avoid the 'KeyError' issue with TIF files
-        colorized_image = Image.fromarray(colorized)
-        colorized_image.save(output_path, format='TIFF')
+if failures:
+    print(f"[INFO] All images processed, {len(failures)} failed (recorded in {manifest.path}).")
+else:
+    print("[INFO] All images processed.")
+print(f"[INFO] {writer.summary()}")
+if colorizer.index is not None:
+    print(f"[INFO] {colorizer.index.hits} images reused the prediction of a near-identical image, "
+          f"see dedup_report.py")
+instrumentation.close()
 
-        print(f"[INFO] Saved colorized image to {output_path}")
+peak_memory = peak_memory_mb()
+if peak_memory is not None:
+    print(f"[INFO] Peak memory usage: {peak_memory:.1f} MB")
 
-print("[INFO] All images processed.")
+# A non zero exit status lets the scheduler of the shards notice the failed images
+if failures:
+    sys.exit(1)
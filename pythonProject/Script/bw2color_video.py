@@ -0,0 +1,174 @@
+import argparse
+import os
+import cv2
+import input_preprocess
+from colorizer import Colorizer, add_colorizer_arguments
+from image_writer import EncoderSettings, WriterPool, add_writer_arguments
+from instrumentation import Instrumentation, add_instrumentation_arguments, peak_memory_mb
+from save_images import IMAGE_EXTENSIONS
+from video_colorizer import (KeyframeColorizer, DEFAULT_KEYFRAME_THRESHOLD, DEFAULT_MAX_INTERVAL,
+                             DEFAULT_SCENE_THRESHOLD)
+
+# Given a black and white video file, or a folder of frames exported from one, this script colorizes the frames as a
+# stream, without extracting them to disk: they are read with cv2.VideoCapture (or one file at a time) and written
+# with cv2.VideoWriter if the output is a video file, or as images into the output folder otherwise. The network runs
+# on keyframes only and the frames in between reuse their predictions, see video_colorizer. The preprocessing flags
+# are applied to the downscaled network input only, like --preprocessLowRes in the other scripts.
+
+# Extensions of the output paths written as a video file
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov')
+
+# Construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser()
+ap.add_argument("-i", "--input", type=str, required=True,
+                help="path to the black and white video file, or to a folder of frames")
+ap.add_argument("-o", "--output", type=str, required=True,
+                help="path of the colorized video file (.mp4, .avi, .mkv, .mov), or of a folder to save the frames")
+add_colorizer_arguments(ap)
+ap.add_argument("--equalizeHist", action="store_true",
+                help="apply histogram equalization to the network input")
+ap.add_argument("--denoise", action="store_true",
+                help="denoise the network input")
+ap.add_argument("--removeGrainAndScratches", action="store_true",
+                help="remove grain and scratches from the network input")
+ap.add_argument("--grayscale", type=str, default="auto", choices=["auto", "force", "off"],
+                help="process the frames as single channel images: 'auto' if they are black and white, 'force' "
+                     "always, 'off' never")
+ap.add_argument("--keyframe-threshold", type=float, default=DEFAULT_KEYFRAME_THRESHOLD,
+                help="mean absolute difference of the 'L' network input to the last keyframe (0-100 scale) from which "
+                     "the network runs again, 0 to run it on every frame")
+ap.add_argument("--scene-threshold", type=float, default=DEFAULT_SCENE_THRESHOLD,
+                help="histogram distance to the last keyframe (0-1) detecting a scene cut")
+ap.add_argument("--max-interval", type=int, default=DEFAULT_MAX_INTERVAL,
+                help="maximum number of frames between two keyframes")
+ap.add_argument("--hold", action="store_true",
+                help="reuse the prediction of the last keyframe instead of blending the keyframes before and after "
+                     "each frame (uses less memory)")
+ap.add_argument("--fps", type=float, default=None,
+                help="frame rate of the output video, by default the one of the input video (24 for frame folders)")
+ap.add_argument("--fourcc", type=str, default="mp4v",
+                help="four character code of the codec of the output video")
+add_writer_arguments(ap)
+add_instrumentation_arguments(ap)
+args = vars(ap.parse_args())
+
+if len(args["fourcc"]) != 4:
+    ap.error("--fourcc must be a four character code")
+
+# Timers and counters of the run, disabled unless a metrics output is requested
+instrumentation = Instrumentation.from_args(args)
+instrumentation.start()
+
+# Load the model and cluster center points
+print("[INFO] Loading model...")
+with instrumentation.timer("model_load"):
+    colorizer = Colorizer.from_args(args)
+
+preprocess = args["equalizeHist"] or args["denoise"] or args["removeGrainAndScratches"]
+
+
+def capture_frames(capture):
+    """
+    Reads the frames of a video one at a time.
+
+    :param capture: opened cv2.VideoCapture, released at the end
+    :return: generator of (name, image) tuples
+    """
+    index = 0
+    try:
+        while True:
+            with instrumentation.timer("decode", index):
+                grabbed, frame = capture.read()
+                if grabbed:
+                    frame = input_preprocess.convert_grayscale(frame, args["grayscale"])
+            if not grabbed:
+                return
+            yield f"frame_{index:06d}.png", frame
+            index += 1
+    finally:
+        capture.release()
+
+
+def folder_frames(names):
+    """
+    Reads the frames of a folder one at a time, skipping the files that can't be read.
+
+    :param names: sorted names of the frames in the input folder
+    :return: generator of (name, image) tuples
+    """
+    for name in names:
+        with instrumentation.timer("decode", name):
+            frame = input_preprocess.read_image(os.path.join(args["input"], name), args["grayscale"])
+        if frame is None:
+            print(f"[ERROR] Can't read the frame {name}, skipped")
+            continue
+        yield name, frame
+
+
+def with_network_input(frames):
+    """
+    Adds the preprocessed network input of each frame, None if no preprocessing flag is set.
+
+    :param frames: iterable of (name, image) tuples
+    :return: generator of (name, image, net_image) tuples, as expected by KeyframeColorizer.colorize
+    """
+    for name, image in frames:
+        net_image = None
+        if preprocess:
+            with instrumentation.timer("preprocess_lowres", name):
+                net_image = input_preprocess.preprocess_lowres(image, colorizer.net_shape(image.shape),
+                                                               equalize=args["equalizeHist"], denoise=args["denoise"],
+                                                               remove_grain=args["removeGrainAndScratches"])
+        yield name, image, net_image
+
+
+# Frames of the input, read lazily
+if os.path.isdir(args["input"]):
+    names = sorted(name for name in os.listdir(args["input"]) if name.lower().endswith(IMAGE_EXTENSIONS))
+    frames = folder_frames(names)
+    fps = args["fps"] or 24.0
+else:
+    capture = cv2.VideoCapture(args["input"])
+    if not capture.isOpened():
+        raise IOError(f"Can't open the video {args['input']}")
+    frames = capture_frames(capture)
+    fps = args["fps"] or capture.get(cv2.CAP_PROP_FPS) or 24.0
+
+keyframe_colorizer = KeyframeColorizer(colorizer, keyframe_threshold=args["keyframe_threshold"],
+                                       scene_threshold=args["scene_threshold"], max_interval=args["max_interval"],
+                                       blend=not args["hold"], instrumentation=instrumentation)
+colorized_frames = keyframe_colorizer.colorize(with_network_input(frames))
+
+if args["output"].lower().endswith(VIDEO_EXTENSIONS):
+    # The writer is created with the size of the first frame
+    video_writer = None
+    try:
+        for name, colorized in colorized_frames:
+            if video_writer is None:
+                height, width = colorized.shape[:2]
+                video_writer = cv2.VideoWriter(args["output"], cv2.VideoWriter_fourcc(*args["fourcc"]), fps,
+                                               (width, height))
+                if not video_writer.isOpened():
+                    raise IOError(f"Can't write the video {args['output']} with the codec {args['fourcc']}")
+            with instrumentation.timer("save", name):
+                video_writer.write(cv2.cvtColor(colorized, cv2.COLOR_RGB2BGR))
+    finally:
+        if video_writer is not None:
+            video_writer.release()
+    print(f"[INFO] Saved colorized video to {args['output']}")
+else:
+    os.makedirs(args["output"], exist_ok=True)
+    encoder = EncoderSettings.from_args(args)
+    with WriterPool(encoder, workers=args["writer_workers"], queue_depth=args["writer_queue"],
+                    instrumentation=instrumentation) as writer:
+        for name, colorized in colorized_frames:
+            writer.submit(encoder.output_path(os.path.join(args["output"], name)), colorized)
+    print(f"[INFO] Saved colorized frames to {args['output']}")
+    print(f"[INFO] {writer.summary()}")
+
+print(f"[INFO] {keyframe_colorizer.summary()}")
+instrumentation.close()
+
+peak_memory = peak_memory_mb()
+if peak_memory is not None:
+    print(f"[INFO] Peak memory usage: {peak_memory:.1f} MB")
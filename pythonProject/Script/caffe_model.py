@@ -0,0 +1,432 @@
+import json
+import os
+import re
+import shutil
+from collections import OrderedDict
+import numpy as np
+
+# This module reads the files of the Caffe colorization model without Caffe: the network definition (prototxt, a
+# protobuf text file) and the weights (caffemodel, a binary protobuf file). Only the small subset of the protobuf
+# formats used by the model is supported. It is used to export the model to other formats, e.g. ONNX, to compile the
+# model into a folder loading faster (see compile_model), and to write a caffemodel with random weights for a
+# prototxt, which lets the performance suite run without the downloaded model.
+
+# Scale applied to the conv8_313 output before the softmax (the conv8_313_rh layer), see Colorizer
+CONV8_313_RH_SCALE = 2.606
+
+# Files of a compiled model folder: the network definition, the weights with the cluster center points and the rescale
+# baked in, and the fingerprint of the source files
+COMPILED_PROTOTXT = "colorization.prototxt"
+COMPILED_MODEL = "colorization.caffemodel"
+COMPILED_MANIFEST = "compiled.json"
+
+# Protobuf wire types
+_VARINT, _FIXED64, _LENGTH_DELIMITED, _FIXED32 = 0, 1, 2, 5
+
+# Tokens of the protobuf text format: quoted strings, braces, colons and bare words (names, numbers, enums)
+_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|[{}:]|[^\s{}:"\']+')
+
+
+def parse_prototxt(path):
+    """
+    Parses a prototxt file. Every message is returned as a dictionary mapping each field name to the list of its
+    values (fields can be repeated), nested messages being dictionaries themselves.
+
+    :param path: path of the prototxt file
+    :return: dictionary of the NetParameter message
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        text = "\n".join(line.split("#", 1)[0] for line in file)
+    tokens = _TOKEN_RE.findall(text)
+    message, position = _parse_message(tokens, 0)
+    if position != len(tokens):
+        raise ValueError(f"Unexpected '{tokens[position]}' in {path}")
+    return message
+
+
+def field(message, name, default=None):
+    """
+    Returns the first value of a field of a parsed message.
+
+    :param message: dictionary returned by parse_prototxt
+    :param name: name of the field
+    :param default: value returned if the field is not set
+    :return: value of the field
+    """
+    values = message.get(name)
+    return values[0] if values else default
+
+
+def _parse_message(tokens, position):
+    message = {}
+    while position < len(tokens) and tokens[position] != "}":
+        name = tokens[position]
+        position += 1
+        if position < len(tokens) and tokens[position] == ":":
+            position += 1
+        if position >= len(tokens):
+            raise ValueError(f"Missing value of '{name}'")
+        if tokens[position] == "{":
+            value, position = _parse_message(tokens, position + 1)
+            if position >= len(tokens):
+                raise ValueError(f"Missing '}}' after '{name}'")
+            position += 1
+        else:
+            value = _parse_scalar(tokens[position])
+            position += 1
+        message.setdefault(name, []).append(value)
+    return message, position
+
+
+def _parse_scalar(token):
+    if token[0] in "\"'":
+        return token[1:-1]
+    if token in ("true", "false"):
+        return token == "true"
+    for convert in (int, float):
+        try:
+            return convert(token)
+        except ValueError:
+            pass
+    # Enum values are kept as strings
+    return token
+
+
+def read_caffemodel(path):
+    """
+    Reads the weights of a caffemodel file.
+
+    :param path: path of the caffemodel file
+    :return: ordered dictionary mapping each layer name to the list of its blobs (float32 arrays)
+    """
+    with open(path, "rb") as file:
+        data = memoryview(file.read())
+
+    weights = OrderedDict()
+    for number, wire_type, value in _fields(data):
+        # NetParameter.layer (LayerParameter) and the legacy NetParameter.layers (V1LayerParameter)
+        if wire_type != _LENGTH_DELIMITED or number not in (100, 2):
+            continue
+        name_field, blobs_field = (1, 7) if number == 100 else (4, 6)
+        name, blobs = None, []
+        for layer_number, layer_wire_type, layer_value in _fields(value):
+            if layer_number == name_field and layer_wire_type == _LENGTH_DELIMITED:
+                name = bytes(layer_value).decode("utf-8")
+            elif layer_number == blobs_field and layer_wire_type == _LENGTH_DELIMITED:
+                blobs.append(_read_blob(layer_value))
+        if name is not None and blobs:
+            weights[name] = blobs
+    return weights
+
+
+def _read_varint(data, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+def _fields(data):
+    # Yields the (field number, wire type, value) of each field of a binary protobuf message, where value is an int
+    # for varints, a memoryview of the bytes for length delimited and fixed size fields
+    position = 0
+    while position < len(data):
+        key, position = _read_varint(data, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == _VARINT:
+            value, position = _read_varint(data, position)
+        elif wire_type == _FIXED64:
+            value, position = data[position:position + 8], position + 8
+        elif wire_type == _LENGTH_DELIMITED:
+            length, position = _read_varint(data, position)
+            value, position = data[position:position + length], position + length
+        elif wire_type == _FIXED32:
+            value, position = data[position:position + 4], position + 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        yield number, wire_type, value
+
+
+def _read_blob(data):
+    # BlobProto: legacy num/channels/height/width (1-4), data (5), shape (7)
+    legacy_shape = {}
+    shape = None
+    chunks = []
+    for number, wire_type, value in _fields(data):
+        if number in (1, 2, 3, 4) and wire_type == _VARINT:
+            legacy_shape[number] = value
+        elif number == 5 and wire_type == _LENGTH_DELIMITED:
+            chunks.append(np.frombuffer(value, dtype="<f4"))
+        elif number == 5 and wire_type == _FIXED32:
+            chunks.append(np.frombuffer(value, dtype="<f4"))
+        elif number == 7 and wire_type == _LENGTH_DELIMITED:
+            shape = []
+            for dim_number, dim_wire_type, dim_value in _fields(value):
+                if dim_number != 1:
+                    continue
+                if dim_wire_type == _VARINT:
+                    shape.append(dim_value)
+                else:
+                    position = 0
+                    while position < len(dim_value):
+                        dim, position = _read_varint(dim_value, position)
+                        shape.append(dim)
+
+    values = np.concatenate(chunks) if chunks else np.zeros(0, dtype="<f4")
+    if shape is None:
+        shape = [legacy_shape.get(number, 1) for number in (1, 2, 3, 4)]
+    return values.astype("float32").reshape(shape)
+
+
+def random_weights(prototxt, seed=0):
+    """
+    Generates random weights for the layers of a network definition, with the shapes expected by Caffe. The
+    convolutions are initialized like He et al. so that the activations stay in a reasonable range, the BatchNorm
+    layers are identities and the Scale layers keep their constant filler. The weights are meaningless, but running
+    them takes exactly as long as running the trained ones.
+
+    :param prototxt: path to Caffe prototxt file
+    :param seed: seed of the random generator
+    :return: ordered dictionary mapping each layer name to the list of its blobs, as returned by read_caffemodel
+    """
+    rng = np.random.default_rng(seed)
+    net = parse_prototxt(prototxt)
+
+    weights = OrderedDict()
+    channels = {}  # Caffe blob name -> number of channels
+    for layer in net.get("layer", []):
+        name = field(layer, "name")
+        layer_type = field(layer, "type")
+        bottoms = layer.get("bottom", [])
+        top = field(layer, "top")
+        in_channels = channels[bottoms[0]] if bottoms else None
+
+        if layer_type == "Input":
+            channels[top] = field(field(layer, "input_param", {}), "shape", {})["dim"][1]
+            continue
+
+        out_channels = in_channels
+        if layer_type in ("Convolution", "Deconvolution"):
+            param = field(layer, "convolution_param", {})
+            kernel = field(param, "kernel_size")
+            group = field(param, "group", 1)
+            out_channels = field(param, "num_output")
+            if layer_type == "Convolution":
+                shape = (out_channels, in_channels // group, kernel, kernel)
+            else:
+                shape = (in_channels, out_channels // group, kernel, kernel)
+            fan_in = shape[1] * kernel * kernel
+            blobs = [rng.normal(0, (2 / fan_in) ** 0.5, shape).astype("float32")]
+            if field(param, "bias_term", True):
+                blobs.append(np.zeros(out_channels, dtype="float32"))
+            weights[name] = blobs
+        elif layer_type == "BatchNorm":
+            weights[name] = [np.zeros(in_channels, dtype="float32"), np.ones(in_channels, dtype="float32"),
+                             np.ones(1, dtype="float32")]
+        elif layer_type == "Scale" and len(bottoms) == 1:
+            param = field(layer, "scale_param", {})
+            weights[name] = [np.full(in_channels, field(field(param, "filler", {}), "value", 1), dtype="float32")]
+            if field(param, "bias_term", False):
+                weights[name].append(np.zeros(in_channels, dtype="float32"))
+
+        if top is not None:
+            channels[top] = out_channels
+    return weights
+
+
+def write_caffemodel(path, weights, net_name=None):
+    """
+    Writes weights to a caffemodel file, which can be read by read_caffemodel and cv2.dnn.readNetFromCaffe.
+
+    :param path: path of the caffemodel file
+    :param weights: dictionary mapping each layer name to the list of its blobs
+    :param net_name: optional name of the network
+    """
+    with open(path, "wb") as file:
+        if net_name:
+            file.write(_length_delimited(1, net_name.encode("utf-8")))
+        # One NetParameter.layer (LayerParameter) at a time, so the whole file is never held in memory
+        for name, blobs in weights.items():
+            layer = [_length_delimited(1, name.encode("utf-8"))]
+            layer.extend(_length_delimited(7, _blob_bytes(blob)) for blob in blobs)
+            file.write(_length_delimited(100, b"".join(layer)))
+
+
+def _write_varint(value):
+    data = bytearray()
+    while value > 0x7F:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def _length_delimited(number, payload):
+    return _write_varint(number << 3 | _LENGTH_DELIMITED) + _write_varint(len(payload)) + payload
+
+
+def _blob_bytes(blob):
+    # BlobProto: shape (7, a BlobShape with packed dims in field 1) and packed data (5)
+    blob = np.asarray(blob)
+    shape = _length_delimited(1, b"".join(_write_varint(dim) for dim in blob.shape))
+    return _length_delimited(7, shape) + _length_delimited(5, np.ascontiguousarray(blob, dtype="<f4").tobytes())
+
+
+def colorization_blobs(points):
+    """
+    Computes the blobs that the downloaded caffemodel lacks: the cluster centers, as the weights of the 1x1
+    convolution class8_ab (without bias), and the 2.606 rescale of the conv8_313_rh layer.
+
+    :param points: path to cluster center points
+    :return: dictionary mapping the layer names to the lists of their blobs
+    """
+    pts = np.load(points).transpose().reshape(2, 313, 1, 1).astype("float32")
+    return {
+        "class8_ab": [pts],
+        "conv8_313_rh": [np.full([1, 313], CONV8_313_RH_SCALE, dtype="float32")],
+    }
+
+
+def compile_model(prototxt, model, points, output_dir, fingerprint):
+    """
+    Writes a compiled model folder: a copy of the prototxt, and a caffemodel holding only the weights of the layers
+    of the prototxt plus the blobs of colorization_blobs, so that loading it needs neither the cluster center points
+    nor any patching of the network. The files are written under temporary names and renamed at the end, so an
+    interrupted compilation never leaves a partial model behind.
+
+    :param prototxt: path to Caffe prototxt file
+    :param model: path to Caffe pre-trained model
+    :param points: path to cluster center points
+    :param output_dir: folder of the compiled model, created if it doesn't exist
+    :param fingerprint: fingerprint of the source files, as returned by ab_cache.model_fingerprint, kept so that the
+                        prediction caches built with the source files stay valid without hashing them at startup
+    """
+    names = {field(layer, "name") for layer in parse_prototxt(prototxt).get("layer", [])}
+    weights = OrderedDict((name, blobs) for name, blobs in read_caffemodel(model).items() if name in names)
+    weights.update(colorization_blobs(points))
+
+    os.makedirs(output_dir, exist_ok=True)
+    model_path = os.path.join(output_dir, COMPILED_MODEL)
+    prototxt_path = os.path.join(output_dir, COMPILED_PROTOTXT)
+    manifest_path = os.path.join(output_dir, COMPILED_MANIFEST)
+    write_caffemodel(model_path + ".tmp", weights)
+    shutil.copyfile(prototxt, prototxt_path + ".tmp")
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump({"fingerprint": fingerprint,
+                   "sources": {"prototxt": os.path.abspath(prototxt), "model": os.path.abspath(model),
+                               "points": os.path.abspath(points)}}, file, indent=2)
+    # The manifest is renamed last: a folder without it is not a compiled model
+    for path in (model_path, prototxt_path, manifest_path):
+        os.replace(path + ".tmp", path)
+
+
+def read_compiled_manifest(model_dir):
+    """
+    :param model_dir: folder written by compile_model
+    :return: dictionary with the fingerprint and the paths of the source files of the compiled model
+    """
+    path = os.path.join(model_dir, COMPILED_MANIFEST)
+    if not os.path.exists(path):
+        raise ValueError(f"{model_dir} is not a compiled model, see compile_model.py")
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def to_onnx(prototxt, model, points):
+    """
+    Converts the colorization network to an ONNX model. The cluster center points (class8_ab layer) and the
+    2.606 rescale of the conv8_313_rh layer are folded into the exported graph, exactly as the Colorizer injects
+    them in the OpenCV network. The height, width and batch size of the input are dynamic.
+
+    :param prototxt: path to Caffe prototxt file
+    :param model: path to Caffe pre-trained model
+    :param points: path to cluster center points
+    :return: onnx.ModelProto
+    """
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    net = parse_prototxt(prototxt)
+    weights = read_caffemodel(model)
+    pts = colorization_blobs(points)["class8_ab"][0]
+
+    nodes = []
+    initializers = []
+    tensors = {}  # Caffe blob name -> name of the ONNX tensor currently holding it
+    inputs = []
+    output = None
+
+    def constant(name, array):
+        initializers.append(numpy_helper.from_array(np.ascontiguousarray(array, dtype="float32"), name))
+        return name
+
+    for layer in net.get("layer", []):
+        name = field(layer, "name")
+        layer_type = field(layer, "type")
+        bottoms = [tensors[bottom] for bottom in layer.get("bottom", [])]
+        top = field(layer, "top")
+
+        if layer_type == "Input":
+            inputs.append(helper.make_tensor_value_info(top, TensorProto.FLOAT, ["N", 1, "H", "W"]))
+            tensors[top] = top
+            continue
+        if layer_type == "Silence":
+            continue
+
+        if layer_type in ("Convolution", "Deconvolution"):
+            param = field(layer, "convolution_param", {})
+            kernel = field(param, "kernel_size")
+            pad = field(param, "pad", 0)
+            attributes = {
+                "kernel_shape": [kernel, kernel],
+                "pads": [pad, pad, pad, pad],
+                "strides": [field(param, "stride", 1)] * 2,
+                "dilations": [field(param, "dilation", 1)] * 2,
+                "group": field(param, "group", 1),
+            }
+            if name == "class8_ab":
+                # Cluster centers as 1x1 convolution, without bias
+                node_inputs = bottoms + [constant(f"{name}_W", pts)]
+            else:
+                blobs = weights[name]
+                node_inputs = bottoms + [constant(f"{name}_W", blobs[0])]
+                if field(param, "bias_term", True) and len(blobs) > 1:
+                    node_inputs.append(constant(f"{name}_B", blobs[1].reshape(-1)))
+            op_type = "Conv" if layer_type == "Convolution" else "ConvTranspose"
+            nodes.append(helper.make_node(op_type, node_inputs, [name], name=name, **attributes))
+        elif layer_type == "ReLU":
+            nodes.append(helper.make_node("Relu", bottoms, [name], name=name))
+        elif layer_type == "BatchNorm":
+            # Caffe stores the running mean and variance multiplied by a scale factor (third blob)
+            mean, variance = weights[name][0].reshape(-1), weights[name][1].reshape(-1)
+            if len(weights[name]) > 2 and weights[name][2].reshape(-1)[0] != 0:
+                scale_factor = 1 / weights[name][2].reshape(-1)[0]
+                mean, variance = mean * scale_factor, variance * scale_factor
+            epsilon = field(field(layer, "batch_norm_param", {}), "eps", 1e-5)
+            node_inputs = bottoms + [constant(f"{name}_scale", np.ones_like(mean)),
+                                     constant(f"{name}_B", np.zeros_like(mean)),
+                                     constant(f"{name}_mean", mean), constant(f"{name}_var", variance)]
+            nodes.append(helper.make_node("BatchNormalization", node_inputs, [name], name=name, epsilon=epsilon))
+        elif layer_type == "Scale" and name == "conv8_313_rh":
+            nodes.append(helper.make_node("Mul", bottoms + [constant(f"{name}_scale", [CONV8_313_RH_SCALE])],
+                                          [name], name=name))
+        elif layer_type == "Softmax":
+            axis = field(field(layer, "softmax_param", {}), "axis", 1)
+            nodes.append(helper.make_node("Softmax", bottoms, [name], name=name, axis=axis))
+        else:
+            raise ValueError(f"Unsupported layer {name} of type {layer_type}")
+
+        tensors[top] = name
+        output = name
+
+    graph = helper.make_graph(nodes, field(net, "name", "colorization"), inputs,
+                              [helper.make_tensor_value_info(output, TensorProto.FLOAT, ["N", 2, None, None])],
+                              initializers)
+    onnx_model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    onnx.checker.check_model(onnx_model)
+    return onnx_model
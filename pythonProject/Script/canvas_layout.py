@@ -0,0 +1,140 @@
+import cv2
+import numpy as np
+
+# This module arranges captioned images on a grid, as used by the comparison images of save_images. The geometry of
+# the final canvas is computed upfront from the shapes of the images, the canvas is allocated once, and every image
+# and caption is written directly into its slice of the canvas, without intermediate padded copies of the images,
+# rows or whole composites. The caption band, the font and the gaps scale with the size of the images, the reference
+# values below being the ones originally tuned by hand for inputs of about 3000x4000 pixels.
+
+# Height of the caption band, relative to the height of the images (400 px for 4000 px high images)
+CAPTION_RATIO = 0.1
+
+# Font scale for a caption band 1 px high (a font scale of 5 for a 400 px band)
+FONT_SCALE_RATIO = 5 / 400
+
+# Gap between images, relative to the height of the images (20 px for 4000 px high images)
+GAP_RATIO = 0.005
+
+
+class GridLayout:
+    """
+    Layout of a grid of images, each one with a caption above it.
+    """
+
+    def __init__(self, columns=3, scale=1.0, cell_height=None, gap_ratio=GAP_RATIO, gap_color=(255, 255, 255),
+                 background=(255, 255, 255), caption_align="center"):
+        """
+        :param columns: maximum number of images in a row, the images are arranged row by row
+        :param scale: scale of the output, relative to the height of the tallest image
+        :param cell_height: height of the images in the output, in pixels (e.g. 256 for a thumbnail contact sheet);
+                            overrides scale if set
+        :param gap_ratio: gap between images, relative to the height of the images
+        :param gap_color: BGR color of the gaps between images
+        :param background: BGR color of the caption bands
+        :param caption_align: "center" or "left"
+        """
+        if columns < 1:
+            raise ValueError("columns must be a positive integer.")
+        if scale <= 0 or (cell_height is not None and cell_height < 1):
+            raise ValueError("The output size must be positive.")
+        if caption_align not in ("center", "left"):
+            raise ValueError("caption_align must be 'center' or 'left'.")
+
+        self.columns = columns
+        self.scale = scale
+        self.cell_height = cell_height
+        self.gap_ratio = gap_ratio
+        self.gap_color = gap_color
+        self.background = background
+        self.caption_align = caption_align
+
+    def geometry(self, shapes):
+        """
+        Computes the geometry of the canvas for images of the given shapes. All the images are resized to the
+        same height, keeping their aspect ratio.
+
+        :param shapes: list of the shapes of the images
+        :return: tuple (canvas_shape, cells, caption_height) where cells is the list of (x, y, width, height)
+                 rectangles of the images in the canvas, in the same order as shapes
+        """
+        if self.cell_height is not None:
+            height = self.cell_height
+        else:
+            height = max(1, int(round(max(shape[0] for shape in shapes) * self.scale)))
+        caption_height = int(round(height * CAPTION_RATIO))
+        gap = max(1, int(round(height * self.gap_ratio)))
+        widths = [max(1, int(shape[1] * height / shape[0])) for shape in shapes]
+
+        cells = []
+        canvas_width = 0
+        y = 0
+        for start in range(0, len(shapes), self.columns):
+            x = 0
+            for width in widths[start:start + self.columns]:
+                cells.append((x, y + caption_height, width, height))
+                x += width + gap
+            canvas_width = max(canvas_width, x - gap)
+            y += caption_height + height + gap
+
+        return (y - gap, canvas_width, 3), cells, caption_height
+
+    def render(self, images, captions, executor=None):
+        """
+        Renders the images and their captions on a new canvas.
+
+        :param images: list of BGR or grayscale images (uint8)
+        :param captions: list of captions, one for each image
+        :param executor: optional concurrent.futures.Executor drawing the cells in parallel, each cell being a
+                         separate slice of the canvas
+        :return: the canvas, a BGR image (uint8)
+        """
+        canvas_shape, cells, caption_height = self.geometry([image.shape for image in images])
+        canvas = np.empty(canvas_shape, dtype=np.uint8)
+        canvas[:] = self.gap_color
+
+        def draw(image, caption, cell):
+            x, y, width, height = cell
+            # Caption band above the image
+            band = canvas[y - caption_height:y, x:x + width]
+            band[:] = self.background
+            self._put_caption(band, caption)
+
+            # Resize the image straight to its slice of the canvas
+            if image.shape[:2] != (height, width):
+                interpolation = cv2.INTER_AREA if height < image.shape[0] else cv2.INTER_LINEAR
+                image = cv2.resize(image, (width, height), interpolation=interpolation)
+            if image.ndim == 2:
+                canvas[y:y + height, x:x + width] = image[:, :, np.newaxis]
+            else:
+                canvas[y:y + height, x:x + width] = image
+
+        if executor is None:
+            for image, caption, cell in zip(images, captions, cells):
+                draw(image, caption, cell)
+        else:
+            # list() waits for all the cells and raises the first error
+            list(executor.map(draw, images, captions, cells))
+        return canvas
+
+    def _put_caption(self, band, caption):
+        if not caption or band.shape[0] < 2:
+            return
+        font = cv2.FONT_HERSHEY_COMPLEX
+        font_scale = band.shape[0] * FONT_SCALE_RATIO
+        thickness = max(1, int(round(font_scale * 2)))
+        text_size = cv2.getTextSize(caption, font, font_scale, thickness)[0]
+
+        # Shrink the text if it doesn't fit the width of the image
+        margin = max(1, band.shape[0] // 40)
+        if text_size[0] > band.shape[1] - 2 * margin:
+            font_scale *= (band.shape[1] - 2 * margin) / text_size[0]
+            thickness = max(1, int(round(font_scale * 2)))
+            text_size = cv2.getTextSize(caption, font, font_scale, thickness)[0]
+
+        if self.caption_align == "center":
+            text_x = (band.shape[1] - text_size[0]) // 2
+        else:
+            text_x = margin
+        text_y = (band.shape[0] + text_size[1]) // 2
+        cv2.putText(band, caption, (text_x, text_y), font, font_scale, (0, 0, 0), thickness)
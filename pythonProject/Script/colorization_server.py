@@ -0,0 +1,244 @@
+import argparse
+import io
+import json
+import queue
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import input_preprocess
+from colorizer import Colorizer, add_colorizer_arguments
+from image_writer import EncoderSettings
+from instrumentation import Instrumentation
+from micro_batcher import MicroBatcher
+
+# This script runs a local HTTP service keeping the model loaded, for front-ends needing low latency colorizations of
+# single images. Each request is decoded, preprocessed and reconstructed in its own thread, while the forward passes
+# of concurrent requests are grouped into micro-batches (see micro_batcher). The service only binds to the loopback
+# interface by default.
+#
+#   POST /colorize   body: the encoded black and white image, the response is the encoded colorized image. The query
+#                    string selects the preprocessing (equalizeHist, denoise, removeGrainAndScratches,
+#                    preprocessLowRes, set to 1) and the output (format=png|jpeg|webp|tiff, quality=1-100)
+#   GET /healthz     200 with the queue depth as JSON once the model is loaded
+#   GET /metrics     latency percentiles of each stage, counters, queue depth, in the Prometheus text format
+#
+# At most --max-inflight requests are processed at the same time: the others are rejected with a 503 and a Retry-After
+# header before their body is read, so the memory used by the decoded and reconstructed images stays bounded and the
+# clients back off instead of piling up. The requests admitted are also rejected when more than --max-queue images
+# are waiting for the network.
+
+# Content types of the response formats
+CONTENT_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "tiff": "image/tiff",
+}
+
+# Construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser()
+add_colorizer_arguments(ap)
+ap.add_argument("--host", type=str, default="127.0.0.1",
+                help="address the service binds to")
+ap.add_argument("--port", type=int, default=8000,
+                help="port the service listens on")
+ap.add_argument("--max-batch-size", type=int, default=8,
+                help="maximum number of images passed through the network in a single forward pass")
+ap.add_argument("--max-wait-ms", type=float, default=10.0,
+                help="maximum time in milliseconds a request waits for other requests to fill a batch")
+ap.add_argument("--max-queue", type=int, default=64,
+                help="maximum number of images waiting for the network, further requests get a 503")
+ap.add_argument("--max-inflight", type=int, default=16,
+                help="maximum number of requests processed at the same time, further requests get a 503")
+ap.add_argument("--request-timeout", type=float, default=30.0,
+                help="maximum time in seconds a request waits for its prediction")
+ap.add_argument("--max-body-mb", type=float, default=100.0,
+                help="maximum size in MB of the uploaded images")
+ap.add_argument("--grayscale", type=str, default="auto", choices=["auto", "force", "off"],
+                help="decode the uploaded images as single channel images: 'auto' if they are black and white, "
+                     "'force' always, 'off' never")
+ap.add_argument("--format", type=str, default="png", choices=list(CONTENT_TYPES),
+                help="default format of the colorized images")
+ap.add_argument("--png-level", type=int, default=1, choices=range(10),
+                help="compression level of the PNG responses (0-9), low values are faster")
+ap.add_argument("--quality", type=int, default=95,
+                help="default quality of the JPEG and WebP responses (1-100)")
+args = vars(ap.parse_args())
+
+# The metrics are kept for the most recent requests only, since the service runs for a long time
+instrumentation = Instrumentation(enabled=True, window=10000)
+instrumentation.start()
+
+print("[INFO] Loading model...")
+with instrumentation.timer("model_load"):
+    colorizer = Colorizer.from_args(args)
+if args["max_inflight"] < 1:
+    ap.error("--max-inflight must be a positive integer")
+
+# Slots of the requests being processed, taken before the body is read
+inflight = threading.BoundedSemaphore(args["max_inflight"])
+
+batcher = MicroBatcher(colorizer, max_batch_size=args["max_batch_size"], max_wait_ms=args["max_wait_ms"],
+                       max_queue=args["max_queue"], instrumentation=instrumentation)
+
+
+class ColorizationHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of the colorization service.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/healthz":
+            self._send(200, "application/json", json.dumps({"status": "ok", "queue": batcher.queue_depth()}).encode())
+        elif path == "/metrics":
+            text = instrumentation.metrics_text(instrumentation.summary(instrumentation.elapsed()), gauges=[
+                ("queue_depth", "Images waiting for the network.", batcher.queue_depth()),
+                ("max_batch_size", "Maximum number of images in a forward pass.", args["max_batch_size"]),
+            ])
+            self._send(200, "text/plain; version=0.0.4", text.encode())
+        else:
+            self._send_error(404, "Not found")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/colorize":
+            self._send_error(404, "Not found")
+            return
+        instrumentation.count("requests")
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0:
+            self._send_error(400, "The body must contain the encoded image")
+            return
+        if length > args["max_body_mb"] * 1024 * 1024:
+            # The body is not read, so the connection can't be reused
+            self.close_connection = True
+            self._send_error(413, "Image too large", {"Connection": "close"})
+            return
+        if not inflight.acquire(blocking=False):
+            # Rejected before reading the body, which is left unread: the connection can't be reused either
+            instrumentation.count("rejected")
+            self.close_connection = True
+            self._send_error(503, "Too many requests in progress, retry later",
+                             {"Retry-After": "1", "Connection": "close"})
+            return
+        try:
+            self._handle_colorize(url, length)
+        except OSError as error:
+            # The client went away while the body was read or the response written
+            instrumentation.count("errors")
+            self.close_connection = True
+            print(f"[ERROR] Connection error: {error}")
+        finally:
+            inflight.release()
+
+    def _handle_colorize(self, url, length):
+        body = self.rfile.read(length)
+
+        options = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            encoder = EncoderSettings(options.get("format", args["format"]), png_level=args["png_level"],
+                                      quality=int(options.get("quality", args["quality"])))
+        except ValueError as error:
+            self._send_error(400, str(error))
+            return
+        if encoder.format not in CONTENT_TYPES:
+            self._send_error(400, f"Unsupported format: {encoder.format}")
+            return
+
+        with instrumentation.timer("decode"):
+            image = input_preprocess.decode_image(body, args["grayscale"])
+        if image is None:
+            self._send_error(400, "The body is not a supported image")
+            return
+
+        try:
+            colorized = self._colorize(image, options)
+        except queue.Full:
+            instrumentation.count("rejected")
+            self._send_error(503, "Too many requests waiting, retry later", {"Retry-After": "1"})
+            return
+        except FutureTimeoutError:
+            instrumentation.count("timeouts")
+            self._send_error(503, "The prediction took too long", {"Retry-After": "1"})
+            return
+        except Exception as error:
+            instrumentation.count("errors")
+            self._send_error(500, f"Colorization failed: {error}")
+            return
+
+        try:
+            with instrumentation.timer("encode"):
+                buffer = io.BytesIO()
+                encoder.save(colorized, buffer)
+        except Exception as error:
+            instrumentation.count("errors")
+            self._send_error(500, f"Encoding failed: {error}")
+            return
+        instrumentation.count("images")
+        self._send(200, CONTENT_TYPES[encoder.format], buffer.getvalue())
+
+    def _colorize(self, image, options):
+        # Preprocessing, network input and reconstruction run in the thread of the request, only the forward pass is
+        # shared with the other requests
+        image, net_image = self._preprocess(image, options)
+        with instrumentation.timer("network_input"):
+            image, L = colorizer.prepare(image, net_image)
+        ab = batcher.submit(L).result(timeout=args["request_timeout"])
+        with instrumentation.timer("reconstruction"):
+            return colorizer.reconstruct(image, ab)
+
+    def _preprocess(self, image, options):
+        # Same preprocessing options as the command line scripts, set to 1 in the query string
+        flags = {name: options.get(name) == "1"
+                 for name in ("equalizeHist", "denoise", "removeGrainAndScratches", "preprocessLowRes")}
+        if flags["preprocessLowRes"]:
+            with instrumentation.timer("preprocess_lowres"):
+                net_image = input_preprocess.preprocess_lowres(image, colorizer.net_shape(image.shape),
+                                                               equalize=flags["equalizeHist"],
+                                                               denoise=flags["denoise"],
+                                                               remove_grain=flags["removeGrainAndScratches"])
+            return image, net_image
+        if flags["equalizeHist"]:
+            with instrumentation.timer("equalize_hist"):
+                image = input_preprocess.equalize_bgr_image(image)
+        if flags["denoise"]:
+            with instrumentation.timer("denoise"):
+                image = input_preprocess.simple_denoise(image)
+        if flags["removeGrainAndScratches"]:
+            with instrumentation.timer("remove_grain_and_scratches"):
+                image = input_preprocess.remove_grain_and_scratches(image)
+        return image, None
+
+    def _send(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message, headers=None):
+        self._send(status, "application/json", json.dumps({"error": message}).encode(), headers)
+
+    def log_message(self, format, *arguments):
+        # The access log of BaseHTTPRequestHandler is too verbose under load, the metrics endpoint counts requests
+        pass
+
+
+server = ThreadingHTTPServer((args["host"], args["port"]), ColorizationHandler)
+server.daemon_threads = True
+print(f"[INFO] Listening on http://{args['host']}:{args['port']}")
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    print("[INFO] Shutting down...")
+finally:
+    server.server_close()
+    batcher.close()
+    instrumentation.close()
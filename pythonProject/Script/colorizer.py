@@ -0,0 +1,398 @@
+from functools import lru_cache
+import numpy as np
+import cv2
+from ab_cache import ABCache, DEFAULT_CACHE_SIZE, model_fingerprint
+from caffe_model import read_compiled_manifest
+from inference_backends import OpenCVBackend, add_backend_arguments, backend_from_args
+from phash_index import DEFAULT_MAX_DISTANCE, HASH_METHODS, PerceptualIndex
+
+# This module contains the colorization engine shared by the scripts. The pre-trained Caffe network and the cluster
+# center points are loaded only once, when a Colorizer is created, and the same instance can then colorize any number
+# of images held in memory as numpy arrays, without temporary files. bw2color_single_image and bw2color_image_folder
+# are thin command line wrappers around it, and other programs can import it directly. Images can be either BGR or
+# single channel grayscale: for the latter the 'L' channel is read from a lookup table and the 3 channel image is
+# only built by the final conversion to RGB.
+
+# Default dimensions of the L channel passed to the colorization network. The network is fully convolutional and
+# accepts other sizes too, as long as they are multiples of 8 (see net_input_shape)
+NET_INPUT_SIZE = 224
+
+# Default memory budget, in MB, for the temporary arrays of the full resolution reconstruction
+DEFAULT_MEMORY_BUDGET = 64
+
+# Bytes of temporary float32 arrays needed for each pixel of a strip during the reconstruction: the scaled BGR
+# values, the Lab values (whose 'ab' channels are then replaced by the prediction), the two source rows and the
+# interpolated 'ab' channels, and the RGB result.
+_STRIP_BYTES_PER_PIXEL = 12 + 12 + 3 * 8 + 12
+
+
+@lru_cache(maxsize=None)
+def gray_to_L_table():
+    """
+    Returns the 'L' channel of the Lab color space of each gray level: for a grayscale image, table[image] is equal
+    to the 'L' channel of cv2.cvtColor(BGR image / 255, cv2.COLOR_BGR2LAB), without building the BGR image.
+
+    :return: float32 array of 256 values
+    """
+    levels = np.arange(256, dtype="float32").reshape(256, 1) / 255.0
+    lab = cv2.cvtColor(cv2.merge((levels, levels, levels)), cv2.COLOR_BGR2LAB)
+    return np.ascontiguousarray(lab[:, 0, 0])
+
+
+def _lightness(image):
+    """
+    Computes the 'L' channel of a BGR or grayscale image (uint8).
+    """
+    if image.ndim == 2:
+        return gray_to_L_table()[image]
+    return cv2.cvtColor(image.astype("float32") / 255.0, cv2.COLOR_BGR2LAB)[:, :, 0]
+
+
+def to_lab(image):
+    """
+    Converts a BGR or grayscale image (uint8), or a strip of its rows, to the Lab color space. The 'L' channel of a
+    grayscale image is read from a lookup table, its 'a' and 'b' channels are left uninitialized.
+
+    :param image: BGR or grayscale image (uint8)
+    :return: HxWx3 Lab image (float32)
+    """
+    if image.ndim == 2:
+        lab = np.empty(image.shape + (3,), dtype="float32")
+        lab[:, :, 0] = gray_to_L_table()[image]
+        return lab
+    return cv2.cvtColor(image.astype("float32") / 255.0, cv2.COLOR_BGR2LAB)
+
+
+def parse_net_size(value):
+    """
+    Parses the --net-size argument: a size N for an NxN network input, "auto" for an input keeping the aspect ratio
+    of the image with about as many pixels as the default 224x224 input, or "auto:N" for about NxN pixels.
+
+    :param value: value of the argument
+    :return: int or tuple ("auto", N)
+    """
+    if value.startswith("auto"):
+        size = int(value[5:]) if value.startswith("auto:") else NET_INPUT_SIZE
+        size_value = ("auto", size)
+    else:
+        size = int(value)
+        size_value = size
+    if size < 8 or size % 8:
+        raise ValueError("The network input size must be a positive multiple of 8.")
+    return size_value
+
+
+def net_input_shape(image_shape, net_size=NET_INPUT_SIZE):
+    """
+    Computes the dimensions of the network input of an image.
+
+    :param image_shape: shape of the image
+    :param net_size: int N for an NxN input, or ("auto", N) to keep the aspect ratio of the image with about NxN
+                     pixels, the sides being rounded to multiples of 8
+    :return: tuple (width, height) of the network input
+    """
+    if not isinstance(net_size, tuple):
+        return net_size, net_size
+    height, width = image_shape[:2]
+    area = net_size[1] * net_size[1]
+    net_width = max(8, int(round((area * width / height) ** 0.5 / 8)) * 8)
+    net_height = max(8, int(round((area * height / width) ** 0.5 / 8)) * 8)
+    return net_width, net_height
+
+
+def add_colorizer_arguments(ap):
+    """
+    Adds the arguments needed to create a Colorizer to an argument parser. The model is given either as the three
+    downloaded files or as a compiled model folder, which is checked when the Colorizer is created.
+
+    :param ap: argparse.ArgumentParser of the calling script
+    """
+    ap.add_argument("-p", "--prototxt", type=str, default=None,
+                    help="path to Caffe prototxt file")
+    ap.add_argument("-m", "--model", type=str, default=None,
+                    help="path to Caffe pre-trained model")
+    ap.add_argument("-c", "--points", type=str, default=None,
+                    help="path to cluster center points")
+    ap.add_argument("--compiled", type=str, default=None,
+                    help="folder of the model compiled by compile_model.py, used instead of --prototxt, --model and "
+                         "--points and faster to load")
+    ap.add_argument("--memory-budget", type=float, default=DEFAULT_MEMORY_BUDGET,
+                    help="memory budget in MB for the temporary arrays of the full resolution reconstruction")
+    ap.add_argument("--cache-dir", type=str, default=None,
+                    help="folder of the on-disk cache of the network predictions (disabled if not set)")
+    ap.add_argument("--cache-size", type=float, default=DEFAULT_CACHE_SIZE,
+                    help="maximum size in MB of the prediction cache")
+    ap.add_argument("--net-size", type=parse_net_size, default=NET_INPUT_SIZE,
+                    help="size of the network input: N (multiple of 8) for NxN, 'auto' to keep the aspect ratio of "
+                         "the image with about as many pixels as 224x224, 'auto:N' for about NxN pixels")
+    ap.add_argument("--dedup-index", type=str, default=None,
+                    help="folder of the perceptual hash index reusing the predictions of near-identical images "
+                         "(disabled if not set)")
+    ap.add_argument("--dedup-method", type=str, default="phash", choices=list(HASH_METHODS),
+                    help="perceptual hash of the index")
+    ap.add_argument("--dedup-distance", type=int, default=DEFAULT_MAX_DISTANCE,
+                    help="maximum Hamming distance (out of 64 bits) between the hashes of near-identical images")
+    ap.add_argument("--dedup-align", action="store_true",
+                    help="align the reused predictions to the new image, for crops and shifted rescans")
+    add_backend_arguments(ap)
+
+
+class Colorizer:
+    """
+    Colorizes black and white images using the pre-trained network from "Colorful Image Colorization".
+    The network predicts the 'a' and 'b' channels of the Lab color space from the 'L' channel of the input.
+    """
+
+    def __init__(self, prototxt=None, model=None, points=None, memory_budget=DEFAULT_MEMORY_BUDGET, cache=None,
+                 backend=None, net_size=NET_INPUT_SIZE, index=None):
+        """
+        Loads the network, by default with cv2.dnn (see inference_backends.OpenCVBackend).
+
+        :param prototxt: path to Caffe prototxt file, not needed if backend is given
+        :param model: path to Caffe pre-trained model, not needed if backend is given
+        :param points: path to cluster center points, not needed if backend is given
+        :param memory_budget: memory budget in MB for the temporary arrays of the full resolution reconstruction
+        :param cache: optional ABCache of the network predictions
+        :param backend: optional inference backend running the network, see inference_backends
+        :param net_size: size of the network input, see net_input_shape
+        :param index: optional PerceptualIndex reusing the predictions of near-identical images
+        """
+        if memory_budget <= 0:
+            raise ValueError("memory_budget must be positive.")
+        self.memory_budget = memory_budget
+        self.cache = cache
+        self.net_size = net_size
+        self.index = index
+
+        if backend is None:
+            backend = OpenCVBackend(prototxt, model, points)
+        self.backend = backend
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Creates a Colorizer from the parsed arguments added by add_colorizer_arguments.
+
+        :param args: dictionary of parsed arguments
+        :return: Colorizer instance
+        """
+        backend = backend_from_args(args)
+        cache = None
+        index = None
+        if args["cache_dir"] or args["dedup_index"]:
+            if args["backend"] == "onnxruntime":
+                fingerprint = model_fingerprint(args["onnx"])
+            elif args["compiled"]:
+                # Computed when the model was compiled, hashing the 129 MB caffemodel at every start is not needed
+                fingerprint = read_compiled_manifest(args["compiled"])["fingerprint"]
+            else:
+                fingerprint = model_fingerprint(args["prototxt"], args["model"], args["points"])
+        if args["cache_dir"]:
+            cache = ABCache(args["cache_dir"], fingerprint, args["cache_size"])
+        if args["dedup_index"]:
+            index = PerceptualIndex(args["dedup_index"], fingerprint, args["dedup_method"], args["dedup_distance"],
+                                    args["dedup_align"])
+        return cls(memory_budget=args["memory_budget"], cache=cache, backend=backend,
+                   net_size=args["net_size"], index=index)
+
+    def net_shape(self, image_shape):
+        """
+        :param image_shape: shape of the image
+        :return: tuple (width, height) of the network input of the image
+        """
+        return net_input_shape(image_shape, self.net_size)
+
+    def prepare(self, image, net_image=None):
+        """
+        Builds the network input of a BGR or grayscale image. Only the image downscaled to the network input size is
+        converted to the Lab color space here, the full resolution conversion is done strip by strip in reconstruct.
+
+        :param image: BGR or grayscale image (uint8)
+        :param net_image: optional BGR or grayscale image (uint8) used for the network input instead of the image
+                          itself, e.g. the output of input_preprocess.preprocess_lowres
+        :return: tuple (image, L) with the image itself and its mean centered L channel at the network input size
+        """
+        if net_image is None:
+            net_image = image
+        return image, network_input(net_image, self.net_shape(image.shape))
+
+    def predict(self, inputs, names=None):
+        """
+        Predicts the 'a' and 'b' channels for a list of network inputs with a single forward pass (one for each
+        input size, when they differ). If a cache is set, only the inputs not found in the cache go through the
+        network. If an index is set, the inputs similar to an indexed image reuse its prediction, and the others are
+        added to the index.
+
+        :param inputs: list of mean centered L channels, as returned by prepare
+        :param names: optional list of the names of the images, recorded in the index
+        :return: list of low resolution HxWx2 'ab' predictions, one for each input
+        """
+        if self.cache is None and self.index is None:
+            return self._forward(inputs)
+
+        names = names or [None] * len(inputs)
+        keys = None
+        predictions = [None] * len(inputs)
+        if self.cache is not None:
+            keys = [self.cache.key(L) for L in inputs]
+            predictions = [self.cache.get(key) for key in keys]
+        if self.index is not None:
+            predictions = [ab if ab is not None else self.index.lookup(L, name)
+                           for L, ab, name in zip(inputs, predictions, names)]
+
+        missing = [index for index, ab in enumerate(predictions) if ab is None]
+        if missing:
+            for index, ab in zip(missing, self._forward([inputs[index] for index in missing])):
+                if keys is not None:
+                    self.cache.put(keys[index], ab)
+                if self.index is not None:
+                    self.index.add(inputs[index], ab, names[index])
+                predictions[index] = ab
+        return predictions
+
+    def _forward(self, inputs):
+        # Group the inputs by size, since a blob holds inputs of the same size only
+        groups = {}
+        for index, L in enumerate(inputs):
+            groups.setdefault(L.shape, []).append(index)
+
+        predictions = [None] * len(inputs)
+        for indices in groups.values():
+            # Stack the L channels into a single Nx1xHxW blob
+            ab_batch = self.backend.forward(cv2.dnn.blobFromImages([inputs[index] for index in indices]))
+
+            # Split the Nx2xH'xW' output back to the inputs it belongs to
+            for index, ab in zip(indices, ab_batch):
+                predictions[index] = ab.transpose((1, 2, 0))
+        return predictions
+
+    def reconstruct(self, image, ab):
+        """
+        Combines the full resolution 'L' channel of the image with the predicted 'ab' channels.
+        The image is processed in strips of rows so that the temporary float32 arrays never exceed the memory
+        budget, only the uint8 result is allocated at full resolution.
+
+        :param image: BGR or grayscale image (uint8), as returned by prepare
+        :param ab: low resolution 'ab' prediction, as returned by predict
+        :return: colorized RGB image (uint8)
+        """
+        height, width = image.shape[:2]
+        colorized = np.empty((height, width, 3), dtype="uint8")
+
+        for top, bottom, ab_strip in self.upsample_ab(ab, image.shape):
+            # Scale the pixel intensities and convert to Lab color space, then replace the 'ab' channels with the
+            # upsampled prediction
+            lab = to_lab(image[top:bottom])
+            lab[:, :, 1:] = ab_strip
+
+            # Convert from Lab to RGB, clip the values that fall outside the range [0, 1] and convert to uint8
+            rgb = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
+            np.clip(rgb, 0, 1, out=rgb)
+            rgb *= 255
+            colorized[top:bottom] = rgb
+
+        return colorized
+
+    def strips(self, image_shape):
+        """
+        Splits the rows of an image into the strips processed by reconstruct, whose temporary arrays fit in the
+        memory budget.
+
+        :param image_shape: shape of the image
+        :return: list of (top, bottom) tuples, the rows of each strip
+        """
+        height, width = image_shape[:2]
+        strip_height = max(1, int(self.memory_budget * 1024 * 1024) // (width * _STRIP_BYTES_PER_PIXEL))
+        return [(top, min(top + strip_height, height)) for top in range(0, height, strip_height)]
+
+    def upsample_ab(self, ab, image_shape):
+        """
+        Upsamples a prediction to the size of the image, strip by strip (see strips), with the bilinear interpolation
+        of cv2.resize.
+
+        :param ab: low resolution 'ab' prediction, as returned by predict
+        :param image_shape: shape of the image
+        :return: generator of (top, bottom, ab) tuples, with the (bottom - top)xWx2 'ab' channels (float32) of each
+                 strip
+        """
+        height, width = image_shape[:2]
+
+        # Resize the predicted 'ab' volume to the width of the image, the height is interpolated strip by strip
+        ab = cv2.resize(ab, (width, ab.shape[0]))
+        rows = _source_rows(ab.shape[0], height)
+        for top, bottom in self.strips(image_shape):
+            y0, y1, weight = (values[top:bottom] for values in rows)
+            yield top, bottom, ab[y0] * (1 - weight) + ab[y1] * weight
+
+    def colorize(self, image, net_image=None):
+        """
+        Colorizes a single image.
+
+        :param image: BGR or grayscale image (uint8)
+        :param net_image: optional BGR or grayscale image (uint8) used for the network input, see prepare
+        :return: colorized RGB image (uint8)
+        """
+        image, L = self.prepare(image, net_image)
+        return self.reconstruct(image, self.predict([L])[0])
+
+    def colorize_many(self, images, batch_size=1):
+        """
+        Colorizes an iterable of images, running one forward pass every batch_size images.
+        Images are consumed lazily and the results are yielded in the same order as the input.
+
+        :param images: iterable of BGR or grayscale images (uint8), or of (image, net_image) tuples, see prepare
+        :param batch_size: number of images passed through the network in a single forward pass
+        :return: generator of colorized RGB images (uint8)
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer.")
+
+        batch = []
+        for image in images:
+            batch.append(self.prepare(*image) if isinstance(image, tuple) else self.prepare(image))
+            if len(batch) == batch_size:
+                yield from self._colorize_batch(batch)
+                batch = []
+
+        # Colorize the last, partially filled batch
+        if batch:
+            yield from self._colorize_batch(batch)
+
+    def _colorize_batch(self, batch):
+        ab_batch = self.predict([L for _, L in batch])
+        for (image, _), ab in zip(batch, ab_batch):
+            yield self.reconstruct(image, ab)
+
+
+def network_input(image, shape=(NET_INPUT_SIZE, NET_INPUT_SIZE)):
+    """
+    Builds the network input of a BGR or grayscale image.
+
+    :param image: BGR or grayscale image (uint8)
+    :param shape: tuple (width, height) of the network input
+    :return: mean centered L channel (float32) of the image resized to shape
+    """
+    # Resize the image, scale the pixel intensities, extract the L channel and mean center
+    resized = cv2.resize(image, shape)
+    L = _lightness(resized)
+    L -= 50
+    return L
+
+
+def _source_rows(source_height, height):
+    """
+    Computes, for each row of the output, the two source rows and the weight used by a bilinear resize from
+    source_height to height, with the same pixel center convention and border handling as cv2.resize.
+
+    :return: tuple (y0, y1, weight) of arrays with one element for each output row, weight has shape (height, 1, 1)
+    """
+    fy = (np.arange(height, dtype="float64") + 0.5) * (source_height / height) - 0.5
+    y0 = np.floor(fy)
+    weight = fy - y0
+    weight[y0 < 0] = 0
+    y0[y0 < 0] = 0
+    weight[y0 >= source_height - 1] = 0
+    y0[y0 >= source_height - 1] = source_height - 1
+    y0 = y0.astype("intp")
+    y1 = np.minimum(y0 + 1, source_height - 1)
+    return y0, y1, weight.astype("float32")[:, np.newaxis, np.newaxis]
@@ -0,0 +1,31 @@
+import argparse
+import os
+import caffe_model
+from ab_cache import model_fingerprint
+
+# This script compiles the downloaded Caffe model, once, into a folder that the other scripts load faster with
+# --compiled <folder> instead of --prototxt, --model and --points. The cluster center points and the 2.606 rescale are
+# baked into the weights, so loading the model no longer reads pts_in_hull.npy nor patches the class8_ab and
+# conv8_313_rh layers, and the weights of layers unused by the prototxt are dropped. The fingerprint of the source
+# files is saved with the compiled weights, so the prediction cache and the duplicate index built with the downloaded
+# files are still valid and the 129 MB caffemodel is not hashed at every start. startup_report.py compares the startup
+# time with and without the compiled model.
+
+# Construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser()
+ap.add_argument("-p", "--prototxt", type=str, required=True,
+                help="path to Caffe prototxt file")
+ap.add_argument("-m", "--model", type=str, required=True,
+                help="path to Caffe pre-trained model")
+ap.add_argument("-c", "--points", type=str, required=True,
+                help="path to cluster center points")
+ap.add_argument("-o", "--output", type=str, required=True,
+                help="folder of the compiled model")
+args = vars(ap.parse_args())
+
+print("[INFO] Compiling model...")
+caffe_model.compile_model(args["prototxt"], args["model"], args["points"], args["output"],
+                          model_fingerprint(args["prototxt"], args["model"], args["points"]))
+size = os.path.getsize(os.path.join(args["output"], caffe_model.COMPILED_MODEL)) / (1024 * 1024)
+print(f"[INFO] Saved compiled model to {args['output']} ({size:.1f} MB of weights)")
+print(f"[INFO] Use it with --compiled {args['output']}")
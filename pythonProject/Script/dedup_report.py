@@ -0,0 +1,28 @@
+import argparse
+import json
+from phash_index import duplicate_clusters
+
+# This script lists the clusters of near-identical images found by the perceptual hash index of the colorization
+# scripts (--dedup-index): for each image whose prediction was reused, the images that reused it and the Hamming
+# distance between their hashes. It only reads the files of the index.
+
+# Construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser()
+ap.add_argument("--index", type=str, required=True,
+                help="folder of the perceptual hash index")
+ap.add_argument("-o", "--output", type=str, default=None,
+                help="optional path of a JSON file where the clusters are saved")
+args = vars(ap.parse_args())
+
+clusters = duplicate_clusters(args["index"])
+duplicates = sum(len(cluster["duplicates"]) for cluster in clusters)
+print(f"[INFO] {len(clusters)} clusters, {duplicates} duplicates colorized without a forward pass")
+for cluster in clusters:
+    print(f"{cluster['source']}:")
+    for duplicate in cluster["duplicates"]:
+        print(f"    {duplicate['name']} (distance {duplicate['distance']})")
+
+if args["output"]:
+    with open(args["output"], "w", encoding="utf-8") as file:
+        json.dump(clusters, file, indent=2)
+    print(f"[INFO] Saved clusters to {args['output']}")
@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import numpy as np
+import caffe_model
+import input_preprocess
+from colorizer import network_input
+from inference_backends import OpenCVBackend, OnnxRuntimeBackend
+from save_images import IMAGE_EXTENSIONS
+
+# This script exports the Caffe colorization network to ONNX, once, so that it can be run by the onnxruntime backend
+# of the other scripts (--backend onnxruntime --onnx <path>). The cluster center points and the 2.606 rescale are
+# folded into the exported model. It requires the onnx package, and onnxruntime for the parity check.
+#
+# With --check-parity, the script runs the same inputs through the OpenCV and the ONNX Runtime backends and checks
+# that the predicted 'ab' channels agree within --tolerance. The inputs are the images of --images if given, random
+# 'L' channels otherwise. The exit status is 1 if the backends don't agree.
+
+# Construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser()
+ap.add_argument("-p", "--prototxt", type=str, required=True,
+                help="path to Caffe prototxt file")
+ap.add_argument("-m", "--model", type=str, required=True,
+                help="path to Caffe pre-trained model")
+ap.add_argument("-c", "--points", type=str, required=True,
+                help="path to cluster center points")
+ap.add_argument("-o", "--output", type=str, required=True,
+                help="path of the exported ONNX model")
+ap.add_argument("--check-parity", action="store_true",
+                help="check that the OpenCV and ONNX Runtime backends predict the same 'ab' channels")
+ap.add_argument("--images", type=str, default=None,
+                help="folder of black and white images used by the parity check (random inputs if not set)")
+ap.add_argument("--tolerance", type=float, default=0.05,
+                help="maximum absolute difference of the 'ab' values allowed by the parity check")
+args = vars(ap.parse_args())
+
+print("[INFO] Exporting model...")
+onnx_model = caffe_model.to_onnx(args["prototxt"], args["model"], args["points"])
+with open(args["output"], "wb") as file:
+    file.write(onnx_model.SerializeToString())
+print(f"[INFO] Saved ONNX model to {args['output']}")
+
+if args["check_parity"]:
+    # Network inputs: the 'L' channels of the images at the default network input size, or random values in the
+    # range of the mean centered L
+    if args["images"]:
+        inputs = []
+        for filename in sorted(os.listdir(args["images"])):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                image = input_preprocess.read_image(os.path.join(args["images"], filename), "auto")
+                if image is None:
+                    print(f"[ERROR] Can't read the image {filename}, skipped")
+                    continue
+                inputs.append(network_input(image))
+        if not inputs:
+            print(f"[ERROR] No readable image in {args['images']} for the parity check.")
+            sys.exit(1)
+        blob = np.stack(inputs)[:, np.newaxis]
+    else:
+        blob = np.random.default_rng(0).uniform(-50, 50, (4, 1, 224, 224)).astype("float32")
+
+    print(f"[INFO] Checking parity of the backends on {blob.shape[0]} inputs...")
+    reference = OpenCVBackend(args["prototxt"], args["model"], args["points"]).forward(blob)
+    exported = OnnxRuntimeBackend(args["output"]).forward(blob)
+
+    # The shapes are compared first, numpy would otherwise broadcast outputs of different shapes, or fail to
+    if reference.shape != exported.shape:
+        print(f"[ERROR] The backends don't agree: the OpenCV output has shape {reference.shape}, "
+              f"the ONNX Runtime output {exported.shape}.")
+        sys.exit(1)
+    difference = np.abs(reference - exported).max()
+    print(f"[INFO] Maximum absolute difference of the 'ab' channels: {difference:.6f}")
+    if not difference <= args["tolerance"]:
+        print("[ERROR] The backends don't agree.")
+        sys.exit(1)
+    print("[INFO] The backends agree.")
@@ -0,0 +1,280 @@
+import io
+import os
+import queue
+import threading
+import time
+
+# This module saves images in the background. The scripts hand the finished arrays to a pool of writer threads
+# through a bounded queue and can go on with the next images while the (single-threaded) TIFF/PNG encoders run.
+# The encoder settings are chosen once per run: uncompressed, LZW or deflate TIFF, PNG with a compression level,
+# JPEG or WebP with a quality, or the same format as the input file. The pool keeps track of the number of bytes
+# written and of the time spent encoding, and reports the time spent saving each file to an optional Instrumentation.
+# Instead of files, the pool can write the images into an archive_io.ArchiveWriter, one at a time as they are encoded.
+
+# Output formats and the extension of the files saved in each of them
+FORMAT_EXTENSIONS = {
+    "tiff": ".tiff",
+    "png": ".png",
+    "jpeg": ".jpg",
+    "webp": ".webp",
+}
+
+# Formats recognized from the extension of the input file when the format is "keep"
+_EXTENSION_FORMATS = {
+    ".tif": "tiff",
+    ".tiff": "tiff",
+    ".png": "png",
+    ".jpg": "jpeg",
+    ".jpeg": "jpeg",
+    ".webp": "webp",
+    ".bmp": "bmp",
+}
+
+# Pillow names of the TIFF compressions
+_TIFF_COMPRESSIONS = {
+    "none": None,
+    "lzw": "tiff_lzw",
+    "deflate": "tiff_adobe_deflate",
+}
+
+
+def add_writer_arguments(ap):
+    """
+    Adds the arguments of the encoder settings and of the writer pool to an argument parser.
+
+    :param ap: argparse.ArgumentParser of the calling script
+    """
+    ap.add_argument("--format", type=str, default="tiff", choices=["tiff", "png", "jpeg", "webp", "keep"],
+                    help="format of the saved images, 'keep' uses the format of the input file")
+    ap.add_argument("--tiff-compression", type=str, default="none", choices=list(_TIFF_COMPRESSIONS),
+                    help="compression of the TIFF files")
+    ap.add_argument("--png-level", type=int, default=6, choices=range(10),
+                    help="compression level of the PNG files (0-9)")
+    ap.add_argument("--quality", type=int, default=95,
+                    help="quality of the JPEG and WebP files (1-100)")
+    ap.add_argument("--writer-workers", type=int, default=2,
+                    help="number of threads encoding and writing the images")
+    ap.add_argument("--writer-queue", type=int, default=8,
+                    help="maximum number of images waiting to be written")
+
+
+class EncoderSettings:
+    """
+    Format and compression options used to save the images of a run.
+    """
+
+    def __init__(self, format="tiff", tiff_compression="none", png_level=6, quality=95):
+        """
+        :param format: "tiff", "png", "jpeg", "webp" or "keep" to use the format given by the extension of each file
+        :param tiff_compression: "none", "lzw" or "deflate"
+        :param png_level: compression level of the PNG files (0-9)
+        :param quality: quality of the JPEG and WebP files (1-100)
+        """
+        if format != "keep" and format not in FORMAT_EXTENSIONS:
+            raise ValueError(f"Unknown format: {format}")
+        if tiff_compression not in _TIFF_COMPRESSIONS:
+            raise ValueError(f"Unknown TIFF compression: {tiff_compression}")
+        if not 0 <= png_level <= 9:
+            raise ValueError("png_level must be between 0 and 9.")
+        if not 1 <= quality <= 100:
+            raise ValueError("quality must be between 1 and 100.")
+
+        self.format = format
+        self.tiff_compression = tiff_compression
+        self.png_level = png_level
+        self.quality = quality
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Creates the settings from the parsed arguments added by add_writer_arguments.
+
+        :param args: dictionary of parsed arguments
+        :return: EncoderSettings instance
+        """
+        return cls(args["format"], args["tiff_compression"], args["png_level"], args["quality"])
+
+    def output_path(self, path):
+        """
+        Returns the path with the extension of the output format. With "keep", the extension is unchanged, except
+        for '.tif' which is replaced by '.tiff'.
+
+        :param path: path of the file, with the extension of the input
+        :return: path of the saved file
+        """
+        root, extension = os.path.splitext(path)
+        if self.format == "keep":
+            return root + ".tiff" if extension.lower() == ".tif" else path
+        return root + FORMAT_EXTENSIONS[self.format]
+
+    def for_comparisons(self):
+        """
+        Settings of the comparison images saved alongside the outputs: the format of the run if it is compressed
+        (PNG, JPEG, WebP), PNG with the compression level of the run otherwise, so that the comparisons of a run saving
+        uncompressed TIFF files don't take as much space as the outputs.
+
+        :return: EncoderSettings instance
+        """
+        if self.format in ("png", "jpeg", "webp"):
+            return self
+        return EncoderSettings("png", png_level=self.png_level, quality=self.quality)
+
+    def save(self, image, path, bgr=False, name=None):
+        """
+        Encodes and saves an image.
+
+        :param image: RGB (or BGR, see bgr) or grayscale image (uint8)
+        :param path: path of the file, as returned by output_path, or a binary file object
+        :param bgr: True if the channels of the image are in the BGR order used by OpenCV
+        :param name: name of the file giving the format with "keep", by default path
+        """
+        if bgr and image.ndim == 3:
+            image = image[:, :, ::-1]
+
+        format = self.format
+        if format == "keep":
+            format = _EXTENSION_FORMATS.get(os.path.splitext(name or path)[1].lower(), "tiff")
+
+        # Save using Pillow to avoid the 'KeyError' issue with TIF files. Pillow is imported on the first save only,
+        # so the scripts that never save an image don't pay for the import at startup
+        from PIL import Image
+
+        if format == "tiff":
+            options = {"compression": _TIFF_COMPRESSIONS[self.tiff_compression]}
+        elif format == "png":
+            options = {"compress_level": self.png_level}
+        elif format in ("jpeg", "webp"):
+            options = {"quality": self.quality}
+        else:
+            options = {}
+        Image.fromarray(image).save(path, format=format.upper(), **options)
+
+    def encode(self, image, name, bgr=False):
+        """
+        Encodes an image in memory.
+
+        :param image: RGB (or BGR, see bgr) or grayscale image (uint8)
+        :param name: name of the file, as returned by output_path
+        :param bgr: True if the channels of the image are in the BGR order used by OpenCV
+        :return: the encoded image, bytes
+        """
+        buffer = io.BytesIO()
+        self.save(image, buffer, bgr, name=name)
+        return buffer.getvalue()
+
+
+class WriterPool:
+    """
+    Pool of threads saving images in the background. Images are submitted through a bounded queue, so submit blocks
+    when the writers can't keep up, instead of holding an unbounded number of images in memory.
+    """
+
+    def __init__(self, settings, workers=2, queue_depth=8, instrumentation=None, archive=None):
+        """
+        :param settings: EncoderSettings of the saved images
+        :param workers: number of writer threads
+        :param queue_depth: maximum number of images waiting to be written
+        :param instrumentation: optional Instrumentation timing the saved files
+        :param archive: optional archive_io.ArchiveWriter receiving the images, the paths being the names of the files
+                        in the archive
+        """
+        if workers < 1 or queue_depth < 1:
+            raise ValueError("workers and queue_depth must be positive integers.")
+
+        self.settings = settings
+        self.instrumentation = instrumentation
+        self.archive = archive
+        self.files_written = 0
+        self.bytes_written = 0
+        self.encode_seconds = 0.0
+        self._errors = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(queue_depth)
+        target = instrumentation.thread_target(self._work) if instrumentation is not None else self._work
+        self._threads = [threading.Thread(target=target, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, path, image, bgr=False, on_done=None, on_error=None, settings=None):
+        """
+        Queues an image to be saved.
+
+        :param path: path of the file, as returned by settings.output_path
+        :param image: RGB (or BGR, see bgr) or grayscale image (uint8), must not be modified afterwards
+        :param bgr: True if the channels of the image are in the BGR order used by OpenCV
+        :param on_done: optional function called with the path once the file has been written
+        :param on_error: optional function called with the path and the exception if the file can't be written, or
+                         if on_done raises. Without it, the exception is raised again by close. The errors of a file
+                         never affect the other files
+        :param settings: optional EncoderSettings of this file, instead of the settings of the pool
+        """
+        self._queue.put((path, image, bgr, on_done, on_error, settings or self.settings))
+
+    def close(self):
+        """
+        Waits until all the queued images have been written and stops the threads.
+        The first exception raised while writing a file submitted without on_error is raised again here.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def summary(self):
+        """
+        :return: a one line summary of the files written and of the time spent encoding
+        """
+        return (f"{self.files_written} files, {self.bytes_written / (1024 * 1024):.1f} MB written, "
+                f"{self.encode_seconds:.1f} s spent encoding")
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            path, image, bgr, on_done, on_error, settings = task
+            try:
+                start = time.perf_counter()
+                if self.archive is not None:
+                    data = settings.encode(image, path, bgr)
+                    self.archive.write(path, data)
+                    size = len(data)
+                else:
+                    settings.save(image, path, bgr)
+                    size = os.path.getsize(path)
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.files_written += 1
+                    self.bytes_written += size
+                    self.encode_seconds += elapsed
+                if self.instrumentation is not None:
+                    self.instrumentation.record("save", elapsed, path)
+                    self.instrumentation.count("bytes_written", size)
+            except Exception as error:
+                self._failed(path, error, on_error)
+                continue
+            if on_done is not None:
+                try:
+                    on_done(path)
+                except Exception as error:
+                    self._failed(path, error, on_error)
+
+    def _failed(self, path, error, on_error):
+        # Reports the error of a file to its callback, or keeps it for close. A callback that raises must not stop the
+        # thread, or close would wait forever for the files left in the queue
+        if on_error is None:
+            with self._lock:
+                self._errors.append(error)
+            return
+        try:
+            on_error(path, error)
+        except Exception as callback_error:
+            print(f"[ERROR] Failed to report the error of {path} ({error}): {callback_error}")
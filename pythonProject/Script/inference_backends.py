@@ -0,0 +1,136 @@
+import os
+import numpy as np
+import cv2
+from caffe_model import COMPILED_MODEL, COMPILED_PROTOTXT, colorization_blobs, read_compiled_manifest
+
+# This module hides the engine running the colorization network behind a single interface: forward(blob) takes an
+# Nx1xHxW blob of mean centered 'L' channels and returns the Nx2xH'xW' 'ab' predictions. Two backends are available:
+#
+# - OpenCVBackend runs the Caffe model with cv2.dnn, with an explicit preferable backend/target and thread count,
+#   either from the downloaded files or from the folder written once by compile_model.py, which loads faster;
+# - OnnxRuntimeBackend runs, on the CPU, the ONNX model exported once from the Caffe model by export_onnx.py.
+#
+# The fastest engine depends on the host, and limiting the intra-op threads matters when several workers share a
+# node. export_onnx.py --check-parity verifies that the backends agree on the predicted 'ab' channels.
+
+# cv2.dnn preferable backends and targets selectable from the command line
+DNN_BACKENDS = {
+    "default": cv2.dnn.DNN_BACKEND_DEFAULT,
+    "opencv": cv2.dnn.DNN_BACKEND_OPENCV,
+    "openvino": cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE,
+}
+DNN_TARGETS = {
+    "cpu": cv2.dnn.DNN_TARGET_CPU,
+    "opencl": cv2.dnn.DNN_TARGET_OPENCL,
+    "opencl_fp16": cv2.dnn.DNN_TARGET_OPENCL_FP16,
+}
+
+
+def add_backend_arguments(ap):
+    """
+    Adds the arguments selecting the inference backend to an argument parser.
+
+    :param ap: argparse.ArgumentParser of the calling script
+    """
+    ap.add_argument("--backend", type=str, default="opencv", choices=["opencv", "onnxruntime"],
+                    help="engine running the colorization network")
+    ap.add_argument("--onnx", type=str, default=None,
+                    help="path to the ONNX model exported by export_onnx.py (onnxruntime backend)")
+    ap.add_argument("--dnn-backend", type=str, default="default", choices=list(DNN_BACKENDS),
+                    help="preferable cv2.dnn backend (opencv backend)")
+    ap.add_argument("--dnn-target", type=str, default="cpu", choices=list(DNN_TARGETS),
+                    help="preferable cv2.dnn target (opencv backend)")
+    ap.add_argument("--threads", type=int, default=None,
+                    help="maximum number of threads used by the inference backend")
+
+
+def backend_from_args(args):
+    """
+    Creates the inference backend selected by the parsed arguments added by add_backend_arguments.
+
+    :param args: dictionary of parsed arguments
+    :return: OpenCVBackend or OnnxRuntimeBackend instance
+    """
+    if args["backend"] == "onnxruntime":
+        if not args["onnx"]:
+            raise ValueError("The onnxruntime backend requires --onnx, see export_onnx.py")
+        return OnnxRuntimeBackend(args["onnx"], threads=args["threads"])
+    if not args["compiled"] and not (args["prototxt"] and args["model"] and args["points"]):
+        raise ValueError("The opencv backend requires --prototxt, --model and --points, or --compiled")
+    return OpenCVBackend(args["prototxt"], args["model"], args["points"], dnn_backend=args["dnn_backend"],
+                         dnn_target=args["dnn_target"], threads=args["threads"], compiled=args["compiled"])
+
+
+class OpenCVBackend:
+    """
+    Runs the Caffe model with the cv2.dnn module.
+    """
+
+    def __init__(self, prototxt=None, model=None, points=None, dnn_backend="default", dnn_target="cpu", threads=None,
+                 compiled=None):
+        """
+        Loads the network and adds the cluster centers as 1x1 convolutions to the model.
+
+        :param prototxt: path to Caffe prototxt file, not needed if compiled is given
+        :param model: path to Caffe pre-trained model, not needed if compiled is given
+        :param points: path to cluster center points, not needed if compiled is given
+        :param dnn_backend: preferable backend, one of DNN_BACKENDS
+        :param dnn_target: preferable target, one of DNN_TARGETS
+        :param threads: number of threads used by OpenCV, None to keep its default
+        :param compiled: optional folder written by compile_model.py, loaded instead of the three files above
+        """
+        if threads is not None:
+            cv2.setNumThreads(threads)
+
+        if compiled is not None:
+            # The cluster centers are already in the weights: neither the points nor the patching of the layers are
+            # needed
+            read_compiled_manifest(compiled)
+            self.net = cv2.dnn.readNetFromCaffe(os.path.join(compiled, COMPILED_PROTOTXT),
+                                                os.path.join(compiled, COMPILED_MODEL))
+        else:
+            self.net = cv2.dnn.readNetFromCaffe(prototxt, model)
+            # Add the cluster centers as 1x1 convolutions to the model
+            for name, blobs in colorization_blobs(points).items():
+                self.net.getLayer(self.net.getLayerId(name)).blobs = blobs
+
+        self.net.setPreferableBackend(DNN_BACKENDS[dnn_backend])
+        self.net.setPreferableTarget(DNN_TARGETS[dnn_target])
+
+    def forward(self, blob):
+        """
+        :param blob: Nx1xHxW float32 blob of mean centered 'L' channels
+        :return: Nx2xH'xW' float32 'ab' predictions
+        """
+        self.net.setInput(blob)
+        return self.net.forward()
+
+
+class OnnxRuntimeBackend:
+    """
+    Runs the exported ONNX model with ONNX Runtime on the CPU.
+    """
+
+    def __init__(self, onnx_path, threads=None):
+        """
+        :param onnx_path: path to the ONNX model exported by export_onnx.py
+        :param threads: number of intra-op threads, None to keep the ONNX Runtime default
+        """
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnxruntime backend requires the onnxruntime package (pip install onnxruntime)")
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, blob):
+        """
+        :param blob: Nx1xHxW float32 blob of mean centered 'L' channels
+        :return: Nx2xH'xW' float32 'ab' predictions
+        """
+        return self.session.run(None, {self.input_name: np.ascontiguousarray(blob, dtype="float32")})[0]
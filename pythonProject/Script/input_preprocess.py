@@ -1,21 +1,91 @@
+import math
 import numpy as np
 import cv2
 
 # This script performs a series of image preprocessing operations to evaluate how different techniques
 # affect the input image before colorization. It includes three main operations: histogram equalization,
 # denoising, and removal of grain and scratches. These operations can help "fix" or improve the quality
-# of an old or degraded image.
+# of an old or degraded image. All of them accept either BGR images or single channel grayscale images, which is
+# what black and white scans are: working on one channel instead of three identical ones is about 3 times cheaper.
+
+# Flags of cv2.imread/cv2.imdecode for each grayscale mode: "off" always decodes a BGR image, "force" always decodes
+# a single channel image, "auto" keeps the channels stored in the file (see _collapse_gray)
+_GRAYSCALE_READ_FLAGS = {
+    "off": cv2.IMREAD_COLOR,
+    "force": cv2.IMREAD_GRAYSCALE,
+    "auto": cv2.IMREAD_ANYCOLOR,
+}
+
+
+def read_image(path, grayscale="off"):
+    """
+    Reads an image from disk.
+
+    Args:
+        path (str): Path of the image.
+        grayscale (str): "off" to read a BGR image, "force" to read a single channel grayscale image, "auto" to read
+                         a grayscale image if the file is grayscale or its three channels are identical.
+
+    Returns:
+        np.ndarray: The BGR or grayscale image, or None if the file can't be read.
+    """
+    return _collapse_gray(cv2.imread(path, _GRAYSCALE_READ_FLAGS[grayscale]))
+
+
+def decode_image(buffer, grayscale="off"):
+    """
+    Decodes an image from an encoded buffer in memory (the content of an image file).
+
+    Args:
+        buffer (bytes or np.ndarray): The encoded image.
+        grayscale (str): Grayscale mode, as in read_image.
+
+    Returns:
+        np.ndarray: The BGR or grayscale image, or None if the buffer can't be decoded.
+    """
+    buffer = np.frombuffer(buffer, dtype=np.uint8)
+    return _collapse_gray(cv2.imdecode(buffer, _GRAYSCALE_READ_FLAGS[grayscale]))
+
+
+def convert_grayscale(image, grayscale="off"):
+    """
+    Applies a grayscale mode to an image decoded by other means than read_image, e.g. a video frame.
+
+    Args:
+        image (np.ndarray): The BGR or grayscale image.
+        grayscale (str): Grayscale mode, as in read_image.
+
+    Returns:
+        np.ndarray: The BGR or grayscale image.
+    """
+    if grayscale == "off":
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image
+    if grayscale == "force":
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    return _collapse_gray(image)
+
+
+def _collapse_gray(image):
+    # Black and white scans saved as color images have three identical channels: keep only one of them
+    if image is not None and image.ndim == 3 and image.shape[2] == 3:
+        if np.array_equal(image[:, :, 0], image[:, :, 1]) and np.array_equal(image[:, :, 0], image[:, :, 2]):
+            return np.ascontiguousarray(image[:, :, 0])
+    return image
+
 
 def equalize_bgr_image(image):
     """
-    Applies histogram equalization to each channel of a BGR image.
+    Applies histogram equalization to each channel of a BGR image, or to the only channel of a grayscale image.
 
     Args:
-        image (numpy.ndarray): The input BGR image.
+        image (numpy.ndarray): The input BGR or grayscale image.
 
     Returns:
-        numpy.ndarray: The BGR image with equalized histograms for each channel.
+        numpy.ndarray: The image with equalized histograms for each channel.
     """
+    if image.ndim == 2:
+        return cv2.equalizeHist(image)
+
     # Split the image into B, G, R channels
     B, G, R = cv2.split(image)
 
@@ -34,7 +104,7 @@ def simple_denoise(image, kernel_size=15, sigma=0):
     Applies low-pass filtering (Gaussian Blur) to reduce grain in an old photo.
 
     Args:
-        image (np.ndarray): The input BGR image.
+        image (np.ndarray): The input BGR or grayscale image.
         kernel_size (int): Size of the Gaussian kernel (must be odd). Default is 15 to remove grain from high resolution input.
         sigma (float): Standard deviation for Gaussian kernel.
                        If 0, it is calculated automatically. Default is 0.
@@ -44,8 +114,8 @@ def simple_denoise(image, kernel_size=15, sigma=0):
     """
     if not isinstance(image, np.ndarray):
         raise TypeError("Input image must be a numpy ndarray.")
-    if image.ndim != 3 or image.shape[2] != 3:
-        raise ValueError("Input image must be a BGR image (3 channels).")
+    if image.ndim != 2 and (image.ndim != 3 or image.shape[2] != 3):
+        raise ValueError("Input image must be a BGR image (3 channels) or a grayscale image (1 channel).")
 
     # Apply Gaussian Blur to the image
     denoised_image = cv2.GaussianBlur(image, (kernel_size, kernel_size), sigma)
@@ -58,18 +128,18 @@ def remove_grain_and_scratches(image, kernel_size=7, sigma=0, morph_kernel_size=
     median filtering, and morphological operations.
 
     Args:
-        image (np.ndarray): The input BGR image.
+        image (np.ndarray): The input BGR or grayscale image.
         kernel_size (int): Size of the Gaussian kernel (must be odd). Default is 7.
         sigma (float): Standard deviation for Gaussian kernel. If 0, it is calculated automatically.
         morph_kernel_size (int): Size of the morphological kernel for removing scratches. Default is 5.
 
     Returns:
-        np.ndarray: The cleaned image.
+        np.ndarray: The cleaned image, BGR or grayscale like the input.
     """
     if not isinstance(image, np.ndarray):
         raise TypeError("Input image must be a numpy ndarray.")
-    if image.ndim != 3 or image.shape[2] != 3:
-        raise ValueError("Input image must be a BGR image (3 channels).")
+    if image.ndim != 2 and (image.ndim != 3 or image.shape[2] != 3):
+        raise ValueError("Input image must be a BGR image (3 channels) or a grayscale image (1 channel).")
 
     # Step 1: Reduce grain using Gaussian Blur
     denoised_image = cv2.GaussianBlur(image, (kernel_size, kernel_size), sigma)
@@ -78,7 +148,10 @@ def remove_grain_and_scratches(image, kernel_size=7, sigma=0, morph_kernel_size=
     denoised_image = cv2.medianBlur(denoised_image, kernel_size)
 
     # Step 3: Convert image to grayscale for scratch removal
-    gray = cv2.cvtColor(denoised_image, cv2.COLOR_BGR2GRAY)
+    if image.ndim == 2:
+        gray = denoised_image
+    else:
+        gray = cv2.cvtColor(denoised_image, cv2.COLOR_BGR2GRAY)
 
     # Step 4: Detect scratches using morphological operations
     morph_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (morph_kernel_size, morph_kernel_size))
@@ -90,6 +163,58 @@ def remove_grain_and_scratches(image, kernel_size=7, sigma=0, morph_kernel_size=
     opened = cv2.morphologyEx(closed, cv2.MORPH_OPEN, morph_kernel)
 
     # Step 5: Combine cleaned grayscale with original color
+    if image.ndim == 2:
+        return opened
     restored_image = cv2.cvtColor(opened, cv2.COLOR_GRAY2BGR)
 
     return restored_image
+
+
+def scale_kernel_size(kernel_size, scale):
+    """
+    Scales the size of a kernel tuned for the full resolution image to an image resized by the given factor.
+
+    Args:
+        kernel_size (int): Size of the kernel at full resolution (odd).
+        scale (float): Ratio between the size of the resized image and the size of the full resolution image.
+
+    Returns:
+        int: The nearest odd kernel size, at least 1 (in which case the filter leaves the image unchanged).
+    """
+    return max(1, 2 * int(round((kernel_size * scale - 1) / 2)) + 1)
+
+
+def preprocess_lowres(image, size, equalize=False, denoise=False, remove_grain=False):
+    """
+    Downscales an image to the network input size and then applies the selected preprocessing operations, with the
+    kernel sizes scaled to match the downscaled image. This is much cheaper than preprocessing the full resolution
+    image, and leaves the luminance of the full resolution image untouched.
+
+    Args:
+        image (np.ndarray): The input BGR or grayscale image at full resolution.
+        size (int or tuple): Width and height of the downscaled image, or a (width, height) tuple.
+        equalize (bool): Apply histogram equalization.
+        denoise (bool): Apply denoising.
+        remove_grain (bool): Remove grain and scratches.
+
+    Returns:
+        np.ndarray: The preprocessed downscaled image, BGR or grayscale like the input.
+    """
+    if not isinstance(size, tuple):
+        size = (size, size)
+    height, width = image.shape[:2]
+    scale = math.sqrt(size[0] * size[1] / (height * width))
+
+    # Area interpolation averages the pixels of the full resolution image, which already attenuates the grain
+    small = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    # The same operations, in the same order, as the full resolution preprocessing of the scripts; the kernel sizes
+    # are the defaults of the functions above scaled to the downscaled image
+    if equalize:
+        small = equalize_bgr_image(small)
+    if denoise:
+        small = simple_denoise(small, kernel_size=scale_kernel_size(15, scale))
+    if remove_grain:
+        small = remove_grain_and_scratches(small, kernel_size=scale_kernel_size(7, scale),
+                                           morph_kernel_size=scale_kernel_size(5, scale))
+    return small
@@ -0,0 +1,397 @@
+import atexit
+import collections
+import cProfile
+import json
+import math
+import os
+import pstats
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# This module measures where the time goes during a run. The scripts wrap each stage (model load, decode, each
+# preprocessing step, forward pass, reconstruction, save) in a timer and count the images and bytes processed, while
+# a background thread samples the resident memory of the process. The results go to:
+#
+# - a JSON lines log (--metrics-log), with one line per timed stage of each input, so slow inputs can be found, one
+#   line per memory sample and a summary line at the end of the run;
+# - a metrics file in the Prometheus textfile format (--metrics-file), with the latency percentiles of each stage,
+#   the counters, the throughput and the peak memory, written at the end of the run;
+# - a cProfile dump (--profile), covering all the threads of the run, readable with pstats or snakeviz.
+#
+# When none of them is requested, the instrumentation is disabled: timers are a shared no-op context manager and
+# counters return immediately, so the overhead is negligible.
+
+# Quantiles of the stage latencies reported in the summary and in the metrics file
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Prefix of the names of the exported Prometheus metrics
+METRIC_PREFIX = "colorization"
+
+
+def add_instrumentation_arguments(ap):
+    """
+    Adds the arguments of the instrumentation to an argument parser.
+
+    :param ap: argparse.ArgumentParser of the calling script
+    """
+    ap.add_argument("--metrics-log", type=str, default=None,
+                    help="path of a JSON lines file receiving the timing of each stage of each input")
+    ap.add_argument("--metrics-file", type=str, default=None,
+                    help="path of a Prometheus textfile (.prom) written with the metrics of the run at the end")
+    ap.add_argument("--profile", type=str, default=None,
+                    help="path of a cProfile dump of the run")
+    ap.add_argument("--memory-interval", type=float, default=1.0,
+                    help="interval in seconds between two samples of the resident memory")
+
+
+def peak_memory_mb():
+    """
+    Returns the peak resident memory of the current process.
+
+    :return: peak resident set size in MB, or None if it can't be measured on this platform
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is expressed in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def _current_rss_bytes():
+    # Current resident set size, only available on Linux: None elsewhere, where only the peak is known
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError, IndexError):
+        return None
+
+
+def _quantile(sorted_values, q):
+    # Nearest rank quantile of a sorted list
+    return sorted_values[max(0, min(len(sorted_values) - 1, math.ceil(q * len(sorted_values)) - 1))]
+
+
+class _Timer:
+    """
+    Context manager recording the time spent in its block.
+    """
+
+    __slots__ = ("instrumentation", "stage", "item", "start")
+
+    def __init__(self, instrumentation, stage, item):
+        self.instrumentation = instrumentation
+        self.stage = stage
+        self.item = item
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.record(self.stage, time.perf_counter() - self.start, self.item)
+
+
+class _NullTimer:
+    """
+    Context manager doing nothing, returned by the timers of a disabled Instrumentation.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Instrumentation:
+    """
+    Timers, counters and memory sampling of a run, exported as JSON lines, Prometheus metrics and a cProfile dump.
+    """
+
+    def __init__(self, metrics_log=None, metrics_file=None, profile=None, memory_interval=1.0, enabled=False,
+                 window=None):
+        """
+        The instrumentation is enabled only if at least one of the outputs is given, or if enabled is True.
+
+        :param metrics_log: optional path of the JSON lines log
+        :param metrics_file: optional path of the Prometheus textfile
+        :param profile: optional path of the cProfile dump
+        :param memory_interval: interval in seconds between two samples of the resident memory
+        :param enabled: True to enable the instrumentation without any output, e.g. to serve the metrics
+        :param window: number of most recent durations of each stage the percentiles are computed on, None to keep
+                       all of them (long running processes should set it)
+        """
+        if memory_interval <= 0:
+            raise ValueError("memory_interval must be positive.")
+
+        self.metrics_log = metrics_log
+        self.metrics_file = metrics_file
+        self.profile = profile
+        self.memory_interval = memory_interval
+        self.enabled = bool(enabled or metrics_log or metrics_file or profile)
+        self.window = window
+
+        self.durations = {}  # stage -> most recent durations in seconds
+        self.totals = {}  # stage -> [count, total duration in seconds]
+        self.slowest = {}  # stage -> (duration, item) of the slowest input
+        self.counters = {}
+        self.peak_rss_bytes = 0
+        self._lock = threading.Lock()
+        self._log = None
+        self._profilers = []
+        self._started = None
+        self._closed = False
+        self._stop = threading.Event()
+        self._sampler = None
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Creates the instrumentation from the parsed arguments added by add_instrumentation_arguments.
+
+        :param args: dictionary of parsed arguments
+        :return: Instrumentation instance
+        """
+        return cls(args["metrics_log"], args["metrics_file"], args["profile"], args["memory_interval"])
+
+    def start(self):
+        """
+        Starts the clock of the run, the memory sampler and the profiler. The results are written by close, which is
+        also called when the interpreter exits, so they are kept if the run fails.
+        """
+        if not self.enabled or self._started is not None:
+            return
+        self._started = time.perf_counter()
+        if self.metrics_log:
+            self._log = open(self.metrics_log, "a", encoding="utf-8")
+        if self.profile:
+            self._profilers.append(cProfile.Profile())
+            self._profilers[0].enable()
+        self._sampler = threading.Thread(target=self._sample_memory, daemon=True)
+        self._sampler.start()
+        atexit.register(self.close)
+
+    def close(self):
+        """
+        Stops the run and writes the summary, the metrics file and the profile. Calling it again does nothing.
+        """
+        if not self.enabled or self._started is None or self._closed:
+            return
+        self._closed = True
+        run_seconds = time.perf_counter() - self._started
+        self._stop.set()
+        self._sampler.join()
+        self._sample_rss()
+        for profiler in self._profilers:
+            profiler.disable()
+
+        summary = self.summary(run_seconds)
+        for stage, stats in summary["stages"].items():
+            slowest = f" ({stats['slowest_item']})" if stats["slowest_item"] is not None else ""
+            print(f"[INFO] {stage}: {stats['count']} x, p50 {stats['p50'] * 1000:.1f} ms, "
+                  f"p90 {stats['p90'] * 1000:.1f} ms, p99 {stats['p99'] * 1000:.1f} ms, "
+                  f"max {stats['max'] * 1000:.1f} ms{slowest}")
+        if summary["throughput"] is not None:
+            print(f"[INFO] Throughput: {summary['throughput']:.2f} images/s")
+
+        if self._log is not None:
+            with self._lock:
+                self._write_event({"event": "summary", **summary})
+                self._log.close()
+                self._log = None
+        if self.metrics_file:
+            self._write_metrics_file(summary)
+        if self._profilers:
+            stats = pstats.Stats(self._profilers[0])
+            for profiler in self._profilers[1:]:
+                stats.add(profiler)
+            stats.dump_stats(self.profile)
+            print(f"[INFO] Saved profile to {self.profile}")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def timer(self, stage, item=None):
+        """
+        Returns a context manager recording the time spent in its block.
+
+        :param stage: name of the stage, e.g. "forward"
+        :param item: optional input being processed, e.g. its file name, reported with the slowest inputs
+        :return: context manager
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage, item)
+
+    def record(self, stage, seconds, item=None):
+        """
+        Records the duration of a stage.
+
+        :param stage: name of the stage
+        :param seconds: duration in seconds
+        :param item: optional input being processed
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if stage not in self.durations:
+                self.durations[stage] = collections.deque(maxlen=self.window)
+                self.totals[stage] = [0, 0.0]
+            self.durations[stage].append(seconds)
+            self.totals[stage][0] += 1
+            self.totals[stage][1] += seconds
+            if seconds > self.slowest.get(stage, (-1, None))[0]:
+                self.slowest[stage] = (seconds, item)
+            if self._log is not None:
+                self._write_event({"event": "timing", "stage": stage, "seconds": seconds, "item": item})
+
+    def count(self, name, value=1):
+        """
+        Increments a counter.
+
+        :param name: name of the counter, e.g. "images"
+        :param value: increment
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def thread_target(self, target):
+        """
+        Wraps the target of a worker thread so that it is covered by the profile. Before Python 3.12, cProfile only
+        profiles the thread that enabled it, so each worker gets its own profiler, merged at the end of the run.
+
+        :param target: function run by the thread
+        :return: function to pass to threading.Thread
+        """
+        if not self.profile or self._started is None or sys.version_info >= (3, 12):
+            return target
+
+        def profiled(*args, **kwargs):
+            profiler = cProfile.Profile()
+            with self._lock:
+                self._profilers.append(profiler)
+            profiler.enable()
+            try:
+                return target(*args, **kwargs)
+            finally:
+                profiler.disable()
+
+        return profiled
+
+    def summary(self, run_seconds):
+        """
+        :param run_seconds: duration of the run in seconds
+        :return: dictionary with the latency percentiles and slowest input of each stage, the counters, the
+                 throughput (images per second) and the peak resident memory
+        """
+        with self._lock:
+            stages = {}
+            for stage, durations in self.durations.items():
+                durations = sorted(durations)
+                stats = {"count": self.totals[stage][0], "total": self.totals[stage][1]}
+                for q in QUANTILES:
+                    stats[f"p{int(q * 100)}"] = _quantile(durations, q)
+                stats["max"] = durations[-1]
+                stats["slowest_item"] = self.slowest[stage][1]
+                stages[stage] = stats
+            counters = dict(self.counters)
+
+        images = counters.get("images")
+        return {
+            "run_seconds": run_seconds,
+            "stages": stages,
+            "counters": counters,
+            "throughput": images / run_seconds if images and run_seconds > 0 else None,
+            "peak_rss_bytes": self.peak_rss_bytes,
+        }
+
+    def elapsed(self):
+        """
+        :return: seconds since start was called, 0 if it wasn't
+        """
+        return time.perf_counter() - self._started if self._started is not None else 0.0
+
+    def metrics_text(self, summary, gauges=()):
+        """
+        Formats a summary in the Prometheus text exposition format.
+
+        :param summary: dictionary returned by summary
+        :param gauges: additional (name, description, value) gauges, the names being prefixed with METRIC_PREFIX
+        :return: text of the metrics
+        """
+        name = f"{METRIC_PREFIX}_stage_duration_seconds"
+        lines = [f"# HELP {name} Duration of each stage of the colorization.", f"# TYPE {name} summary"]
+        for stage, stats in summary["stages"].items():
+            for q in QUANTILES:
+                lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {stats[f"p{int(q * 100)}"]:.6f}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {stats["total"]:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {stats["count"]}')
+
+        # The byte counters (e.g. bytes_written) are exported as metrics of their own, not mixed with the items
+        name = f"{METRIC_PREFIX}_processed_total"
+        lines += [f"# HELP {name} Number of items processed, by counter.", f"# TYPE {name} counter"]
+        for counter, value in summary["counters"].items():
+            if not counter.startswith("bytes_"):
+                lines.append(f'{name}{{counter="{counter}"}} {value}')
+        for counter, value in summary["counters"].items():
+            if counter.startswith("bytes_"):
+                name = f"{METRIC_PREFIX}_{counter}_total"
+                lines += [f"# HELP {name} Number of {counter.replace('_', ' ')}.", f"# TYPE {name} counter",
+                          f"{name} {value}"]
+
+        gauges = [("run_duration_seconds", "Duration of the run.", summary["run_seconds"]),
+                  ("throughput_images_per_second", "Images colorized per second.", summary["throughput"]),
+                  ("peak_resident_memory_bytes", "Peak resident memory of the process.", summary["peak_rss_bytes"]),
+                  *gauges]
+        for suffix, description, value in gauges:
+            if value is None:
+                continue
+            name = f"{METRIC_PREFIX}_{suffix}"
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def _write_event(self, event):
+        self._log.write(json.dumps({"time": time.time(), **event}) + "\n")
+
+    def _sample_rss(self):
+        rss = _current_rss_bytes()
+        peak = peak_memory_mb()
+        with self._lock:
+            if rss is not None:
+                self.peak_rss_bytes = max(self.peak_rss_bytes, rss)
+            if peak is not None:
+                self.peak_rss_bytes = max(self.peak_rss_bytes, int(peak * 1024 * 1024))
+            if self._log is not None and rss is not None:
+                self._write_event({"event": "memory", "rss_bytes": rss})
+
+    def _sample_memory(self):
+        while not self._stop.wait(self.memory_interval):
+            self._sample_rss()
+
+    def _write_metrics_file(self, summary):
+        # Written to a temporary file first so that a collector reading the textfile directory never sees a partial
+        # file
+        temporary_path = f"{self.metrics_file}.{os.getpid()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            file.write(self.metrics_text(summary))
+        os.replace(temporary_path, self.metrics_file)
+        print(f"[INFO] Saved metrics to {self.metrics_file}")
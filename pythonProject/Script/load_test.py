@@ -0,0 +1,129 @@
+import argparse
+import json
+import math
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# This script measures the latency and the throughput of the colorization service (colorization_server.py) under
+# concurrent load: --concurrency clients post the same image --requests times in total, as fast as the service
+# answers. It reports the status codes, the latency percentiles of the successful requests and the throughput, and
+# the forward pass and batch counters read from /metrics. It only needs the standard library.
+
+# Construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser()
+ap.add_argument("-i", "--image", type=str, required=True,
+                help="path to the black and white image posted by the clients")
+ap.add_argument("--url", type=str, default="http://127.0.0.1:8000",
+                help="base URL of the colorization service")
+ap.add_argument("--query", type=str, default="",
+                help="query string of the requests, e.g. 'denoise=1&format=jpeg'")
+ap.add_argument("-n", "--requests", type=int, default=200,
+                help="total number of requests")
+ap.add_argument("-c", "--concurrency", type=int, default=8,
+                help="number of concurrent clients")
+ap.add_argument("--timeout", type=float, default=60.0,
+                help="timeout of each request in seconds")
+ap.add_argument("--json", type=str, default=None,
+                help="optional path of a JSON file where the results are saved")
+args = vars(ap.parse_args())
+
+if args["requests"] < 1 or args["concurrency"] < 1:
+    ap.error("--requests and --concurrency must be positive integers")
+
+with open(args["image"], "rb") as file:
+    body = file.read()
+url = f"{args['url'].rstrip('/')}/colorize" + (f"?{args['query']}" if args["query"] else "")
+
+latencies = []
+statuses = {}
+lock = threading.Lock()
+remaining = [args["requests"]]
+
+
+def client():
+    """
+    Posts the image until the total number of requests has been sent.
+    """
+    while True:
+        with lock:
+            if remaining[0] == 0:
+                return
+            remaining[0] -= 1
+
+        request = urllib.request.Request(url, data=body, method="POST",
+                                         headers={"Content-Type": "application/octet-stream"})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=args["timeout"]) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as error:
+            status = error.code
+        except (urllib.error.URLError, OSError):
+            status = "connection error"
+        latency = time.perf_counter() - start
+
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(latency)
+
+
+def metrics():
+    """
+    :return: dictionary of the counters exported by /metrics, empty if they can't be read
+    """
+    try:
+        with urllib.request.urlopen(f"{args['url'].rstrip('/')}/metrics", timeout=args["timeout"]) as response:
+            text = response.read().decode()
+    except (urllib.error.URLError, OSError):
+        return {}
+    counters = {}
+    for line in text.splitlines():
+        if line.startswith('colorization_processed_total{counter="'):
+            name = line.split('"')[1]
+            counters[name] = float(line.rsplit(" ", 1)[1])
+    return counters
+
+
+before = metrics()
+print(f"[INFO] Sending {args['requests']} requests to {url} with {args['concurrency']} clients...")
+start = time.perf_counter()
+threads = [threading.Thread(target=client, daemon=True) for _ in range(args["concurrency"])]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+elapsed = time.perf_counter() - start
+after = metrics()
+
+results = {
+    "requests": args["requests"],
+    "concurrency": args["concurrency"],
+    "seconds": elapsed,
+    "statuses": {str(status): count for status, count in statuses.items()},
+    "throughput": len(latencies) / elapsed,
+}
+print(f"[INFO] Status codes: {results['statuses']}")
+print(f"[INFO] Throughput: {results['throughput']:.2f} images/s")
+if latencies:
+    latencies.sort()
+    for q in (0.5, 0.9, 0.99):
+        value = latencies[max(0, math.ceil(q * len(latencies)) - 1)]
+        results[f"p{int(q * 100)}_ms"] = value * 1000
+    results["mean_ms"] = statistics.mean(latencies) * 1000
+    print(f"[INFO] Latency: mean {results['mean_ms']:.1f} ms, p50 {results['p50_ms']:.1f} ms, "
+          f"p90 {results['p90_ms']:.1f} ms, p99 {results['p99_ms']:.1f} ms")
+
+batches = after.get("forward_batches", 0) - before.get("forward_batches", 0)
+if batches > 0:
+    results["mean_batch_size"] = (after.get("batched_inputs", 0) - before.get("batched_inputs", 0)) / batches
+    print(f"[INFO] {batches:.0f} forward passes, {results['mean_batch_size']:.2f} images per batch on average")
+
+if args["json"]:
+    with open(args["json"], "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    print(f"[INFO] Saved results to {args['json']}")
@@ -0,0 +1,64 @@
+import argparse
+import json
+import os
+import sys
+from archive_io import archive_names, is_archive
+from run_manifest import MANIFEST_NAME, merge_manifests
+from save_images import IMAGE_EXTENSIONS
+
+# This script combines the manifests written by the shards of a folder run (bw2color_image_folder.py --shard i/N)
+# into the manifest of the output folder, and checks the work done: the shards that never wrote a manifest, the
+# images processed by more than one shard or by the wrong one, the images whose output disappeared, the failed
+# images and, given the input folder, the images that no shard processed. The images to process again are written to
+# --requeue, to be passed to bw2color_image_folder.py --files (with --shard again to spread them over several
+# machines). The exit status is 1 if any image has to be processed again.
+
+# Construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser()
+ap.add_argument("-o", "--output", type=str, required=True,
+                help="output folder shared by the shards")
+ap.add_argument("-i", "--input", type=str, default=None,
+                help="input folder (or archive) of the run, to find the images that no shard processed")
+ap.add_argument("--requeue", type=str, default=None,
+                help="path of a text file where the names of the images to process again are written")
+ap.add_argument("--json", type=str, default=None,
+                help="optional path of a JSON file where the report is saved")
+args = vars(ap.parse_args())
+
+input_names = None
+if args["input"] and is_archive(args["input"]):
+    input_names = archive_names(args["input"], IMAGE_EXTENSIONS)
+elif args["input"]:
+    input_names = [name for name in os.listdir(args["input"]) if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+report = merge_manifests(args["output"], input_names)
+
+for shard in report["shards"]:
+    print(f"[INFO] Shard {shard['shard']}: {shard['completed']} images in {shard['seconds']:.1f} s, "
+          f"{shard['failed']} failed")
+print(f"[INFO] {report['completed']} images completed, merged into {os.path.join(args['output'], MANIFEST_NAME)}")
+if report["missing_shards"]:
+    print(f"[WARNING] No manifest for the shards {', '.join(report['missing_shards'])}")
+for key, description in (("duplicated", "processed by more than one shard"),
+                         ("misplaced", "processed by a shard they don't belong to"),
+                         ("lost", "whose output no longer exists"),
+                         ("failed", "failed"),
+                         ("missing", "never processed")):
+    if report[key]:
+        print(f"[WARNING] {len(report[key])} images {description}: {', '.join(list(report[key])[:10])}"
+              f"{', ...' if len(report[key]) > 10 else ''}")
+if input_names is None:
+    print("[INFO] Without --input, the images that no shard processed are not detected")
+
+if args["requeue"]:
+    with open(args["requeue"], "w", encoding="utf-8") as file:
+        file.writelines(name + "\n" for name in report["requeue"])
+    print(f"[INFO] Saved the {len(report['requeue'])} images to process again to {args['requeue']}")
+
+if args["json"]:
+    with open(args["json"], "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"[INFO] Saved report to {args['json']}")
+
+if report["requeue"]:
+    sys.exit(1)
@@ -0,0 +1,100 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from instrumentation import Instrumentation
+
+# This module groups the network inputs of concurrent requests into micro-batches. Requests are queued, and a single
+# inference thread takes the first waiting request, keeps collecting the following ones until the batch is full or
+# the oldest request has waited max_wait_ms, and runs one forward pass for all of them. Under load the batches fill
+# up and the forward passes are amortized, while a lone request waits at most max_wait_ms. The queue is bounded:
+# when it is full, submit raises queue.Full instead of letting the latency grow without limit.
+
+
+class MicroBatcher:
+    """
+    Runs the forward passes of concurrent requests in micro-batches, with a Colorizer.
+    """
+
+    def __init__(self, colorizer, max_batch_size=8, max_wait_ms=10.0, max_queue=64, instrumentation=None):
+        """
+        :param colorizer: Colorizer running the network
+        :param max_batch_size: maximum number of inputs passed through the network in a single forward pass
+        :param max_wait_ms: maximum time in milliseconds an input waits for other inputs, from its submission
+        :param max_queue: maximum number of inputs waiting for the network
+        :param instrumentation: optional Instrumentation timing the forward passes and counting the batches
+        """
+        if max_batch_size < 1 or max_queue < 1:
+            raise ValueError("max_batch_size and max_queue must be positive integers.")
+        if max_wait_ms < 0:
+            raise ValueError("max_wait_ms must not be negative.")
+
+        self.colorizer = colorizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.instrumentation = instrumentation or Instrumentation()
+        self._queue = queue.Queue(max_queue)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self.instrumentation.thread_target(self._work), daemon=True)
+        self._thread.start()
+
+    def submit(self, L, name=None):
+        """
+        Queues a network input.
+
+        :param L: mean centered L channel, as returned by Colorizer.prepare
+        :param name: optional name of the image, see Colorizer.predict
+        :return: concurrent.futures.Future of the HxWx2 'ab' prediction
+        :raise queue.Full: if max_queue inputs are already waiting
+        """
+        if self._closed.is_set():
+            raise RuntimeError("The batcher is closed.")
+        future = Future()
+        self._queue.put_nowait((L, name, future, time.perf_counter()))
+        return future
+
+    def queue_depth(self):
+        """
+        :return: number of inputs waiting for the network
+        """
+        return self._queue.qsize()
+
+    def close(self):
+        """
+        Stops the inference thread once the queued inputs have been processed.
+        """
+        self._closed.set()
+        self._thread.join()
+
+    def _work(self):
+        while not (self._closed.is_set() and self._queue.empty()):
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+
+            # Collect more inputs until the batch is full or the first one has waited long enough since it was
+            # submitted. Past the deadline, the inputs already queued still join the batch, without waiting
+            deadline = batch[0][3] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    if remaining > 0:
+                        batch.append(self._queue.get(timeout=remaining))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            inputs = [L for L, _, _, _ in batch]
+            try:
+                with self.instrumentation.timer("forward"):
+                    predictions = self.colorizer.predict(inputs, names=[name for _, name, _, _ in batch])
+            except Exception as error:
+                for _, _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+            self.instrumentation.count("forward_batches")
+            self.instrumentation.count("batched_inputs", len(batch))
+            for (_, _, future, _), ab in zip(batch, predictions):
+                future.set_result(ab)
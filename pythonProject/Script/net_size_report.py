@@ -0,0 +1,128 @@
+import argparse
+import json
+import os
+import statistics
+import time
+import numpy as np
+import cv2
+import input_preprocess
+from colorizer import NET_INPUT_SIZE, add_colorizer_arguments, net_input_shape, network_input, parse_net_size
+from inference_backends import backend_from_args
+from save_images import IMAGE_EXTENSIONS
+
+# This script measures, over a folder of sample images, what the network input size (the --net-size option of the
+# other scripts) costs and saves: for each size, the median forward time of the network and the mean absolute
+# difference between its 'ab' prediction and the prediction at the default 224x224 size. The predictions are compared
+# after resizing them to the size of the reference one, on the same scale as the 'ab' values (about -110 to 110).
+# Smaller inputs are much faster, the difference tells how far their colors drift from the default.
+
+# Construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser()
+ap.add_argument("-i", "--input", type=str, required=True,
+                help="path to the folder of sample black and white images")
+ap.add_argument("--sizes", type=parse_net_size, nargs="+",
+                default=[128, 176, NET_INPUT_SIZE, 320, ("auto", NET_INPUT_SIZE)],
+                help="network input sizes to compare, same values as --net-size")
+ap.add_argument("--repeat", type=int, default=5,
+                help="number of timed forward passes of each image and size, the median is reported")
+ap.add_argument("--json", type=str, default=None,
+                help="optional path of a JSON file where the results are saved")
+ap.add_argument("--grayscale", type=str, default="auto", choices=["off", "force", "auto"],
+                help="decode the images as single channel images, see input_preprocess.read_image")
+add_colorizer_arguments(ap)
+args = vars(ap.parse_args())
+
+if args["repeat"] < 1:
+    ap.error("--repeat must be a positive integer")
+
+
+def size_label(net_size):
+    """
+    :param net_size: int or ("auto", N) tuple, as returned by parse_net_size
+    :return: the value of --net-size selecting this size
+    """
+    if isinstance(net_size, tuple):
+        return "auto" if net_size[1] == NET_INPUT_SIZE else f"auto:{net_size[1]}"
+    return str(net_size)
+
+
+def timed_forward(L):
+    """
+    Runs the network on a single input, once to warm up, then args["repeat"] times.
+
+    :param L: mean centered L channel
+    :return: tuple (HxWx2 'ab' prediction, median forward time in seconds)
+    """
+    blob = L[np.newaxis, np.newaxis]
+    backend.forward(blob)
+    durations = []
+    for _ in range(args["repeat"]):
+        start = time.perf_counter()
+        ab = backend.forward(blob)
+        durations.append(time.perf_counter() - start)
+    return ab[0].transpose((1, 2, 0)), statistics.median(durations)
+
+
+filenames = sorted(filename for filename in os.listdir(args["input"])
+                   if filename.lower().endswith(IMAGE_EXTENSIONS))
+if not filenames:
+    ap.error(f"no image found in {args['input']}")
+
+print("[INFO] Loading model...")
+backend = backend_from_args(args)
+
+# For each size: the median forward time and the 'ab' difference to the reference of every image
+latencies = {size_label(net_size): [] for net_size in args["sizes"]}
+differences = {size_label(net_size): [] for net_size in args["sizes"]}
+shapes = {size_label(net_size): set() for net_size in args["sizes"]}
+reference_latencies = []
+
+for filename in filenames:
+    print(f"[INFO] Measuring {filename}...")
+    image = input_preprocess.read_image(os.path.join(args["input"], filename), args["grayscale"])
+    if image is None:
+        print(f"[ERROR] Can't read the image {filename}, skipped")
+        continue
+
+    reference, reference_latency = timed_forward(network_input(image))
+    reference_latencies.append(reference_latency)
+    reference_shape = (reference.shape[1], reference.shape[0])
+
+    for net_size in args["sizes"]:
+        label = size_label(net_size)
+        shape = net_input_shape(image.shape, net_size)
+        if shape == (NET_INPUT_SIZE, NET_INPUT_SIZE):
+            ab, latency = reference, reference_latency
+        else:
+            ab, latency = timed_forward(network_input(image, shape))
+        latencies[label].append(latency)
+        differences[label].append(float(np.abs(cv2.resize(ab, reference_shape) - reference).mean()))
+        shapes[label].add(shape)
+
+if not reference_latencies:
+    ap.error(f"no readable image in {args['input']}")
+reference_latency = statistics.mean(reference_latencies)
+results = []
+print(f"[INFO] {len(reference_latencies)} images, reference size {NET_INPUT_SIZE}x{NET_INPUT_SIZE}")
+print(f"{'size':>10} {'input':>12} {'forward ms':>11} {'speedup':>8} {'mean ab diff':>13} {'max ab diff':>12}")
+for label in latencies:
+    latency = statistics.mean(latencies[label])
+    input_shapes = sorted(shapes[label])
+    input_shape = f"{input_shapes[0][0]}x{input_shapes[0][1]}" if len(input_shapes) == 1 else "varies"
+    result = {
+        "net_size": label,
+        "input_shapes": [list(shape) for shape in input_shapes],
+        "forward_ms": latency * 1000,
+        "speedup": reference_latency / latency,
+        "mean_ab_difference": statistics.mean(differences[label]),
+        "max_ab_difference": max(differences[label]),
+    }
+    results.append(result)
+    print(f"{label:>10} {input_shape:>12} {result['forward_ms']:>11.1f} {result['speedup']:>7.2f}x "
+          f"{result['mean_ab_difference']:>13.2f} {result['max_ab_difference']:>12.2f}")
+
+if args["json"]:
+    with open(args["json"], "w", encoding="utf-8") as file:
+        json.dump({"images": len(reference_latencies), "repeat": args["repeat"], "backend": args["backend"],
+                   "results": results}, file, indent=2)
+    print(f"[INFO] Saved results to {args['json']}")
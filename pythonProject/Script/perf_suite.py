@@ -0,0 +1,245 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+import cv2
+import caffe_model
+import input_preprocess
+from colorizer import Colorizer, add_colorizer_arguments, to_lab
+from image_writer import EncoderSettings
+
+# This script measures the speed of each stage of the colorization separately, so that performance regressions can be
+# caught on every change: decoding, the three preprocessing filters, the network input, the forward pass (at several
+# batch sizes), the full resolution Lab conversion and upsampling of the 'ab' channels, strip by strip as in the
+# reconstruction, the whole reconstruction and the encoding of the result. It runs on synthetic black and white images
+# of the given sizes in megapixels, and without the downloaded caffemodel: unless --model or --compiled is given, a
+# caffemodel with random weights is generated once for the prototxt (see caffe_model.random_weights) and kept in
+# --synthetic-dir. Random weights take as long to run as the trained ones.
+#
+# The median time of each measurement is saved as JSON with -o. With --baseline, the results are compared to a
+# previous JSON file and the exit status is 1 if any stage got slower than the baseline by more than --threshold.
+
+# Folder of the model files of the repository
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Model")
+
+# Stages measured on each image size, in the order of the pipeline (the forward pass is measured per batch size)
+IMAGE_STAGES = ["decode", "equalize_bgr_image", "simple_denoise", "remove_grain_and_scratches", "network_input",
+                "lab_conversion", "ab_upsampling", "reconstruction", "encode"]
+
+# Construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser()
+ap.add_argument("--megapixels", type=float, nargs="+", default=[0.5, 2, 12, 50],
+                help="sizes of the synthetic images in megapixels")
+ap.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8],
+                help="batch sizes of the forward pass measurements")
+ap.add_argument("--repeat", type=int, default=3,
+                help="number of timed runs of each measurement, the median is reported")
+ap.add_argument("--grayscale", type=str, default="auto", choices=["off", "force", "auto"],
+                help="grayscale mode used to decode the synthetic images, see input_preprocess.read_image")
+ap.add_argument("--seed", type=int, default=0,
+                help="seed of the synthetic images and of the random weights")
+ap.add_argument("--synthetic-dir", type=str, default=tempfile.gettempdir(),
+                help="folder where the caffemodel with random weights is generated and reused")
+ap.add_argument("-o", "--output", type=str, default=None,
+                help="path of the JSON file where the results are saved")
+ap.add_argument("--baseline", type=str, default=None,
+                help="JSON file of a previous run to compare the results to")
+ap.add_argument("--threshold", type=float, default=0.2,
+                help="relative slowdown compared to the baseline reported as a regression (0.2 = 20%%)")
+add_colorizer_arguments(ap)
+args = vars(ap.parse_args())
+
+if args["repeat"] < 1 or min(args["batch_sizes"]) < 1 or min(args["megapixels"]) <= 0:
+    ap.error("--repeat, --batch-sizes and --megapixels must be positive")
+
+
+def synthetic_model(prototxt, seed):
+    """
+    Returns the path of the caffemodel with random weights of a prototxt, generating it if needed.
+
+    :param prototxt: path to Caffe prototxt file
+    :param seed: seed of the random weights
+    :return: path of the caffemodel
+    """
+    with open(prototxt, "rb") as file:
+        digest = hashlib.sha256(file.read()).hexdigest()[:12]
+    path = os.path.join(args["synthetic_dir"], f"random_{digest}_{seed}.caffemodel")
+    if not os.path.exists(path):
+        print(f"[INFO] Generating random weights in {path}...")
+        os.makedirs(args["synthetic_dir"], exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        caffe_model.write_caffemodel(temporary_path, caffe_model.random_weights(prototxt, seed))
+        os.replace(temporary_path, path)
+    return path
+
+
+def synthetic_image(megapixels, seed):
+    """
+    Generates a black and white scan like image with a 3:2 aspect ratio: smooth shapes with some grain.
+
+    :param megapixels: number of pixels in millions
+    :param seed: seed of the random generator
+    :return: BGR image (uint8) with three identical channels
+    """
+    height = max(8, int(round((megapixels * 1e6 * 2 / 3) ** 0.5)))
+    width = max(8, int(round(height * 3 / 2)))
+    rng = np.random.default_rng(seed)
+    gray = cv2.resize(rng.integers(0, 256, (12, 18), dtype="uint8"), (width, height), interpolation=cv2.INTER_CUBIC)
+    grain = np.empty_like(gray)
+    cv2.setRNGSeed(seed)
+    cv2.randu(grain, 0, 24)
+    gray = cv2.add(gray, grain)
+    return cv2.merge((gray, gray, gray))
+
+
+def measure(function, *arguments):
+    """
+    Runs a function args["repeat"] times.
+
+    :return: tuple (result of the last run, list of durations in ms)
+    """
+    durations = []
+    result = None
+    for _ in range(args["repeat"]):
+        start = time.perf_counter()
+        result = function(*arguments)
+        durations.append((time.perf_counter() - start) * 1000)
+    return result, durations
+
+
+def add_result(stage, durations, megapixels=None, batch_size=None):
+    """
+    Records and prints the median and minimum durations of a measurement.
+    """
+    result = {"stage": stage, "megapixels": megapixels, "batch_size": batch_size,
+              "median_ms": statistics.median(durations), "min_ms": min(durations)}
+    results.append(result)
+    size = f"{megapixels} MP" if megapixels is not None else f"batch {batch_size}"
+    print(f"{stage:>28} {size:>10} {result['median_ms']:>12.1f} ms")
+
+
+def lab_conversion(image):
+    """
+    Converts an image to the Lab color space strip by strip, as Colorizer.reconstruct does.
+    """
+    for top, bottom in colorizer.strips(image.shape):
+        to_lab(image[top:bottom])
+
+
+def ab_upsampling(ab, image):
+    """
+    Upsamples a prediction to the size of an image strip by strip, as Colorizer.reconstruct does.
+    """
+    for _ in colorizer.upsample_ab(ab, image.shape):
+        pass
+
+
+def encode(image):
+    """
+    Encodes an RGB image with the default encoder settings of bw2color_image_folder, in memory.
+    """
+    buffer = io.BytesIO()
+    encoder.save(image, buffer)
+    return buffer
+
+
+if not args["prototxt"]:
+    args["prototxt"] = os.path.join(MODEL_DIR, "colorization_deploy_v2.prototxt")
+if not args["points"]:
+    args["points"] = os.path.join(MODEL_DIR, "pts_in_hull.npy")
+model_name = args["compiled"] or args["model"] or "synthetic"
+if not args["model"] and not args["compiled"]:
+    args["model"] = synthetic_model(args["prototxt"], args["seed"])
+
+# The prediction cache and the duplicate index would skip the forward passes being measured
+args["cache_dir"] = None
+args["dedup_index"] = None
+
+print("[INFO] Loading model...")
+colorizer = Colorizer.from_args(args)
+encoder = EncoderSettings("tiff")
+results = []
+
+for megapixels in args["megapixels"]:
+    print(f"[INFO] Measuring a {megapixels} MP image...")
+    encoded = cv2.imencode(".png", synthetic_image(megapixels, args["seed"]))[1]
+    image, durations = measure(input_preprocess.decode_image, encoded, args["grayscale"])
+    add_result("decode", durations, megapixels)
+    for stage in IMAGE_STAGES[1:4]:
+        _, durations = measure(getattr(input_preprocess, stage), image)
+        add_result(stage, durations, megapixels)
+
+    (_, L), durations = measure(colorizer.prepare, image)
+    add_result("network_input", durations, megapixels)
+    _, durations = measure(lab_conversion, image)
+    add_result("lab_conversion", durations, megapixels)
+    ab = colorizer.predict([L])[0]
+    _, durations = measure(ab_upsampling, ab, image)
+    add_result("ab_upsampling", durations, megapixels)
+    colorized, durations = measure(colorizer.reconstruct, image, ab)
+    add_result("reconstruction", durations, megapixels)
+    _, durations = measure(encode, colorized)
+    add_result("encode", durations, megapixels)
+    del image, colorized
+
+# The network input doesn't depend on the size of the image: the forward pass is measured per batch size, on inputs
+# of the smallest image size, and reported per image
+print("[INFO] Measuring the forward pass...")
+_, L = colorizer.prepare(synthetic_image(min(args["megapixels"]), args["seed"]))
+colorizer.predict([L])
+for batch_size in args["batch_sizes"]:
+    _, durations = measure(colorizer.predict, [L] * batch_size)
+    add_result("forward", [duration / batch_size for duration in durations], batch_size=batch_size)
+
+report = {
+    "environment": {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    },
+    "settings": {
+        "model": model_name,
+        "backend": args["backend"],
+        "net_size": args["net_size"],
+        "grayscale": args["grayscale"],
+        "repeat": args["repeat"],
+        "seed": args["seed"],
+    },
+    "results": results,
+}
+if args["output"]:
+    with open(args["output"], "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"[INFO] Saved results to {args['output']}")
+
+if args["baseline"]:
+    with open(args["baseline"], "r", encoding="utf-8") as file:
+        baseline = {(result["stage"], result["megapixels"], result["batch_size"]): result
+                    for result in json.load(file)["results"]}
+
+    regressions = 0
+    print(f"[INFO] Comparing to {args['baseline']} (threshold {args['threshold']:.0%})")
+    for result in results:
+        reference = baseline.get((result["stage"], result["megapixels"], result["batch_size"]))
+        if reference is None:
+            continue
+        ratio = result["median_ms"] / reference["median_ms"] if reference["median_ms"] > 0 else 1.0
+        slower = ratio > 1 + args["threshold"]
+        regressions += slower
+        size = f"{result['megapixels']} MP" if result["megapixels"] is not None else f"batch {result['batch_size']}"
+        print(f"{result['stage']:>28} {size:>10} {reference['median_ms']:>10.1f} -> {result['median_ms']:>10.1f} ms "
+              f"({ratio:.2f}x){' REGRESSION' if slower else ''}")
+
+    if regressions:
+        print(f"[ERROR] {regressions} measurements are slower than the baseline.")
+        sys.exit(1)
+    print("[INFO] No regression.")
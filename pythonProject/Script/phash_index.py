@@ -0,0 +1,277 @@
+import json
+import os
+import threading
+import numpy as np
+import cv2
+
+# This module implements a persistent index of the predictions made for near-identical scans: rescans, crops and
+# copies of the same photograph. Each prediction is indexed by a 64 bit perceptual hash of the 'L' network input
+# (dHash or pHash), which barely changes when the image is rescanned, resized or slightly shifted, unlike the exact
+# key of the ABCache. Before running the network on an image, the Colorizer looks for an indexed hash within a small
+# Hamming distance and reuses its 'ab' prediction, optionally aligned to the new image first, so the duplicates get
+# the same colors without a forward pass. Every reuse is recorded, and clusters returns the groups of duplicates.
+#
+# The index is a folder:
+#
+#   index.json         the hash method and the fingerprint of the model that made the predictions
+#   hashes.bin         the hashes, 8 bytes each, in the order of the entries
+#   entries.jsonl      the name of the image of each entry
+#   matches.jsonl      the images that reused the prediction of an entry
+#   entries/           the 'L' network input and the 'ab' prediction of each entry, in .npz files
+#
+# The hashes of a million images take 8 MB and are compared to a new hash in a single vectorized pass.
+
+# Hash methods
+HASH_METHODS = ("phash", "dhash")
+
+# Default maximum Hamming distance (out of 64 bits) between the hashes of two images considered duplicates
+DEFAULT_MAX_DISTANCE = 4
+
+# Number of bits set in each byte value, to count the differing bits of the hashes
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype="uint8")
+
+# Number of entries per subfolder of entries/
+_ENTRIES_PER_FOLDER = 1000
+
+
+def perceptual_hash(L, method="phash"):
+    """
+    Computes the perceptual hash of a network input.
+
+    :param L: mean centered L channel, as returned by Colorizer.prepare
+    :param method: "phash" (signs of the low frequencies of the DCT, more robust) or "dhash" (signs of the horizontal
+                   gradients, cheaper)
+    :return: 64 bit hash as an int
+    """
+    L = np.asarray(L, dtype="float32")
+    if method == "phash":
+        frequencies = cv2.dct(cv2.resize(L, (32, 32), interpolation=cv2.INTER_AREA))[:8, :8]
+        # The DC coefficient only depends on the mean brightness, it is left out of the median
+        bits = frequencies > np.median(frequencies.reshape(-1)[1:])
+    elif method == "dhash":
+        small = cv2.resize(L, (9, 8), interpolation=cv2.INTER_AREA)
+        bits = small[:, 1:] > small[:, :-1]
+    else:
+        raise ValueError(f"Unknown hash method: {method}")
+    return int.from_bytes(np.packbits(bits.reshape(-1)).tobytes(), "big")
+
+
+def duplicate_clusters(index_dir):
+    """
+    Groups the images that reused a prediction of an index by the image the prediction was made for. Only the files
+    of the index are read, so the model is not needed.
+
+    :param index_dir: folder of the index
+    :return: list of {"source", "duplicates": [{"name", "distance"}]} dictionaries, largest clusters first
+    """
+    names = []
+    with open(os.path.join(index_dir, "entries.jsonl"), "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                names.append(json.loads(line)["name"])
+            except (ValueError, KeyError):
+                break
+
+    duplicates = {}
+    matches_path = os.path.join(index_dir, "matches.jsonl")
+    if os.path.exists(matches_path):
+        with open(matches_path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    match = json.loads(line)
+                except ValueError:
+                    continue
+                if match["entry"] < len(names):
+                    duplicates.setdefault(match["entry"], {})[match["name"]] = match["distance"]
+
+    clusters = [{"source": names[entry],
+                 "duplicates": [{"name": name, "distance": distance}
+                                for name, distance in sorted(matched.items(), key=lambda item: str(item[0]))]}
+                for entry, matched in duplicates.items()]
+    clusters.sort(key=lambda cluster: -len(cluster["duplicates"]))
+    return clusters
+
+
+class PerceptualIndex:
+    """
+    On-disk index of 'ab' predictions by perceptual hash, with Hamming distance lookup.
+    """
+
+    def __init__(self, index_dir, fingerprint, method="phash", max_distance=DEFAULT_MAX_DISTANCE, align=False):
+        """
+        :param index_dir: folder of the index, created if it doesn't exist
+        :param fingerprint: fingerprint of the model, as returned by ab_cache.model_fingerprint
+        :param method: hash method, one of HASH_METHODS
+        :param max_distance: maximum Hamming distance between the hashes of duplicates
+        :param align: True to align the reused prediction to the new image (ECC affine registration of the 'L'
+                      network inputs), which helps with crops and shifted rescans
+        """
+        if method not in HASH_METHODS:
+            raise ValueError(f"Unknown hash method: {method}")
+        if not 0 <= max_distance <= 64:
+            raise ValueError("max_distance must be between 0 and 64.")
+
+        self.index_dir = index_dir
+        self.method = method
+        self.max_distance = max_distance
+        self.align = align
+        self.hits = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.join(index_dir, "entries"), exist_ok=True)
+        settings_path = os.path.join(index_dir, "index.json")
+        settings = {"method": method, "fingerprint": fingerprint}
+        if os.path.exists(settings_path):
+            with open(settings_path, "r", encoding="utf-8") as file:
+                existing = json.load(file)
+            if existing != settings:
+                raise ValueError(f"The index {index_dir} was built with another model or hash method.")
+        else:
+            with open(settings_path, "w", encoding="utf-8") as file:
+                json.dump(settings, file)
+
+        # An interrupted run may have written an entry without its hash, or the other way around: only the entries
+        # with both are kept, and the files are cut back to them
+        self.names = []
+        entries_path = os.path.join(index_dir, "entries.jsonl")
+        if os.path.exists(entries_path):
+            with open(entries_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        self.names.append(json.loads(line)["name"])
+                    except (ValueError, KeyError):
+                        break
+        hashes_path = os.path.join(index_dir, "hashes.bin")
+        self._hashes = bytearray()
+        if os.path.exists(hashes_path):
+            with open(hashes_path, "rb") as file:
+                self._hashes = bytearray(file.read())
+        size = min(len(self.names), len(self._hashes) // 8)
+        if len(self.names) != size or len(self._hashes) != size * 8:
+            del self.names[size:]
+            del self._hashes[size * 8:]
+            with open(entries_path, "w", encoding="utf-8") as file:
+                file.writelines(json.dumps({"name": name}) + "\n" for name in self.names)
+            with open(hashes_path, "wb") as file:
+                file.write(self._hashes)
+
+        # Entries of each image name, so that an image processed again doesn't match its own entry
+        self._entries_by_name = {}
+        for entry, name in enumerate(self.names):
+            self._entries_by_name.setdefault(name, []).append(entry)
+
+        self._entries_file = open(entries_path, "a", encoding="utf-8")
+        self._hashes_file = open(hashes_path, "ab")
+        self._matches_file = open(os.path.join(index_dir, "matches.jsonl"), "a", encoding="utf-8")
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, L, name=None):
+        """
+        Looks for a duplicate of a network input and returns its prediction, recording the match. An image already
+        in the index under the same name (e.g. a folder processed again) reuses its own prediction, which is not
+        recorded as a match.
+
+        :param L: mean centered L channel, as returned by Colorizer.prepare
+        :param name: optional name of the image, recorded in the matches
+        :return: HxWx2 'ab' prediction for the network input, or None if no duplicate was found
+        """
+        query = perceptual_hash(L, self.method)
+        with self._lock:
+            if not self.names:
+                return None
+            hashes = np.frombuffer(self._hashes, dtype="<u8")
+            distances = _POPCOUNT[(hashes ^ np.uint64(query)).view("uint8")].reshape(-1, 8).sum(axis=1)
+            del hashes
+            own_entries = self._entries_by_name.get(name, []) if name is not None else []
+            if own_entries:
+                own_entry = own_entries[int(np.argmin(distances[own_entries]))]
+                own_distance = int(distances[own_entry])
+                # The entries of the image itself are left out of the search for duplicates
+                distances[own_entries] = 65
+            entry = int(np.argmin(distances))
+            distance = int(distances[entry])
+        if own_entries and own_distance <= self.max_distance:
+            with np.load(self._entry_path(own_entry)) as data:
+                return self._fit(data["L"].astype("float32") - 50, data["ab"].astype("float32"), L)
+        if distance > self.max_distance:
+            return None
+
+        with np.load(self._entry_path(entry)) as data:
+            stored_L = data["L"].astype("float32") - 50
+            ab = data["ab"].astype("float32")
+        ab = self._fit(stored_L, ab, L)
+        if ab is None:
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self._matches_file.write(json.dumps({"name": name, "entry": entry, "distance": distance}) + "\n")
+            self._matches_file.flush()
+        return ab
+
+    def add(self, L, ab, name=None):
+        """
+        Adds a prediction to the index.
+
+        :param L: mean centered L channel passed to the network
+        :param ab: HxWx2 'ab' prediction of the network
+        :param name: optional name of the image
+        """
+        query = perceptual_hash(L, self.method)
+        with self._lock:
+            entry = len(self.names)
+            path = self._entry_path(entry)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # The L channel is stored on 8 bits and the prediction on 16 bits, which is plenty for reuse
+            np.savez(path, L=np.clip(L + 50, 0, 255).astype("uint8"), ab=np.asarray(ab, dtype="float16"))
+            self._entries_file.write(json.dumps({"name": name}) + "\n")
+            self._entries_file.flush()
+            self._hashes_file.write(query.to_bytes(8, "little"))
+            self._hashes_file.flush()
+            self._hashes += query.to_bytes(8, "little")
+            self.names.append(name)
+            self._entries_by_name.setdefault(name, []).append(entry)
+
+    def clusters(self):
+        """
+        :return: the duplicate clusters of the index, see duplicate_clusters
+        """
+        with self._lock:
+            self._matches_file.flush()
+        return duplicate_clusters(self.index_dir)
+
+    def close(self):
+        """
+        Closes the files of the index.
+        """
+        for file in (self._entries_file, self._hashes_file, self._matches_file):
+            file.close()
+
+    def _entry_path(self, entry):
+        return os.path.join(self.index_dir, "entries", str(entry // _ENTRIES_PER_FOLDER), f"{entry}.npz")
+
+    def _fit(self, stored_L, ab, L):
+        # Resizes (and optionally aligns) a stored prediction to a network input of possibly another size
+        height, width = L.shape[:2]
+        stored_height, stored_width = stored_L.shape[:2]
+        if (stored_height, stored_width) != (height, width):
+            ab = cv2.resize(ab, (max(1, round(ab.shape[1] * width / stored_width)),
+                                 max(1, round(ab.shape[0] * height / stored_height))))
+            stored_L = cv2.resize(stored_L, (width, height))
+        if not self.align:
+            return ab
+
+        # Affine warp mapping the new network input to the stored one, applied to the prediction (whose pixels are
+        # larger) so that it lines up with the new image
+        warp = np.eye(2, 3, dtype="float32")
+        criteria = (cv2.TERM_CRITERIA_COUNT | cv2.TERM_CRITERIA_EPS, 50, 1e-4)
+        try:
+            _, warp = cv2.findTransformECC(L.astype("float32"), stored_L, warp, cv2.MOTION_AFFINE, criteria, None, 5)
+        except cv2.error:
+            # The registration didn't converge: the images are too different to reuse the prediction
+            return None
+        warp[:, 2] *= ab.shape[1] / width
+        return cv2.warpAffine(ab, warp, (ab.shape[1], ab.shape[0]), flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP,
+                              borderMode=cv2.BORDER_REPLICATE)
@@ -0,0 +1,211 @@
+import queue
+import threading
+from instrumentation import Instrumentation
+
+# This module runs the colorization of many images as a pipeline of concurrent stages connected by bounded queues:
+#
+#   decode pool  ->  inference worker  ->  encode pool
+#
+# The decode pool reads and preprocesses the images and builds the network inputs, a single inference worker runs
+# the forward passes (batch_size images at a time), and the encode pool rebuilds the full resolution colorized images
+# and saves them. While the network is busy with a batch, the other stages keep reading and writing files, so neither
+# the CPU nor the network sits idle waiting for I/O. OpenCV and Pillow release the GIL during the heavy work, so
+# threads are enough to overlap the stages. Each image goes through exactly the same operations as in a sequential
+# run, only the order in which the images complete may differ. With an Instrumentation, the network input, forward
+# and reconstruction stages are timed and the completed images counted. By default the first error stops the whole
+# pipeline; with an on_error function, the failed images are reported to it and skipped, and the others go on.
+
+# Marks the end of the stream in a queue
+_DONE = object()
+
+
+class Pipeline:
+    """
+    Pipelined executor for colorizing a sequence of images with a Colorizer.
+    """
+
+    def __init__(self, colorizer, decode, encode, decode_workers=2, encode_workers=2, queue_depth=8, batch_size=1,
+                 instrumentation=None, on_error=None):
+        """
+        :param colorizer: Colorizer used for the network inputs, the forward passes and the reconstruction
+        :param decode: function called with an item, returning the preprocessed BGR image to colorize, or an
+                       (image, net_image) tuple as accepted by Colorizer.prepare
+        :param encode: function called with an item and its colorized RGB image, saving the result
+        :param decode_workers: number of threads reading and preprocessing images
+        :param encode_workers: number of threads reconstructing and saving colorized images
+        :param queue_depth: maximum number of images waiting between two stages
+        :param batch_size: number of images passed through the network in a single forward pass
+        :param instrumentation: optional Instrumentation timing the stages of the pipeline
+        :param on_error: optional function called with an item and the exception raised while processing it, the
+                         item being skipped; without it, the first exception stops the pipeline
+        """
+        if decode_workers < 1 or encode_workers < 1:
+            raise ValueError("The number of decode and encode workers must be a positive integer.")
+        if queue_depth < 1:
+            raise ValueError("queue_depth must be a positive integer.")
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer.")
+
+        self.colorizer = colorizer
+        self.decode = decode
+        self.encode = encode
+        self.decode_workers = decode_workers
+        self.encode_workers = encode_workers
+        self.queue_depth = queue_depth
+        self.batch_size = batch_size
+        self.instrumentation = instrumentation or Instrumentation()
+        self.on_error = on_error
+
+    def run(self, items):
+        """
+        Colorizes all the items and waits until every result has been saved.
+        Unless on_error is set, the first exception raised by any stage stops the pipeline and is raised again here.
+
+        :param items: iterable of items (e.g. file names) passed to decode and encode
+        :return: number of items processed
+        """
+        self._stop = threading.Event()
+        self._errors = []
+        self._processed = 0
+        self._lock = threading.Lock()
+
+        task_queue = queue.Queue(self.queue_depth)
+        infer_queue = queue.Queue(self.queue_depth)
+        encode_queue = queue.Queue(self.queue_depth)
+
+        thread_target = self.instrumentation.thread_target
+        threads = [threading.Thread(target=self._feed, args=(items, task_queue), daemon=True)]
+        threads += [threading.Thread(target=thread_target(self._decode_worker), args=(task_queue, infer_queue),
+                                     daemon=True) for _ in range(self.decode_workers)]
+        threads.append(threading.Thread(target=thread_target(self._inference_worker), args=(infer_queue, encode_queue),
+                                        daemon=True))
+        threads += [threading.Thread(target=thread_target(self._encode_worker), args=(encode_queue,), daemon=True)
+                    for _ in range(self.encode_workers)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+        return self._processed
+
+    def _put(self, q, value):
+        # Blocks while the queue is full, but gives up if another stage failed so no thread waits forever
+        while not self._stop.is_set():
+            try:
+                q.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _skip(self, items, error):
+        # Reports the items that failed to on_error, or raises the error again to stop the pipeline without it
+        if self.on_error is None:
+            raise error
+        self.instrumentation.count("failed", len(items))
+        for item in items:
+            self.on_error(item, error)
+
+    def _fail(self, error):
+        with self._lock:
+            self._errors.append(error)
+        self._stop.set()
+
+    def _feed(self, items, task_queue):
+        try:
+            for item in items:
+                if not self._put(task_queue, item):
+                    return
+        except Exception as error:
+            self._fail(error)
+        finally:
+            for _ in range(self.decode_workers):
+                self._put(task_queue, _DONE)
+
+    def _decode_worker(self, task_queue, infer_queue):
+        try:
+            while True:
+                item = self._get(task_queue)
+                if item is _DONE:
+                    break
+                try:
+                    decoded = self.decode(item)
+                    with self.instrumentation.timer("network_input", item):
+                        if isinstance(decoded, tuple):
+                            image, L = self.colorizer.prepare(*decoded)
+                        else:
+                            image, L = self.colorizer.prepare(decoded)
+                except Exception as error:
+                    self._skip([item], error)
+                    continue
+                if not self._put(infer_queue, (item, image, L)):
+                    break
+        except Exception as error:
+            self._fail(error)
+        finally:
+            self._put(infer_queue, _DONE)
+
+    def _inference_worker(self, infer_queue, encode_queue):
+        try:
+            running_decoders = self.decode_workers
+            batch = []
+            while running_decoders:
+                entry = self._get(infer_queue)
+                if entry is _DONE:
+                    running_decoders -= 1
+                    if self._stop.is_set():
+                        break
+                else:
+                    batch.append(entry)
+
+                # Run the network once the batch is full, or on the last, partially filled batch
+                if batch and (len(batch) == self.batch_size or not running_decoders):
+                    try:
+                        with self.instrumentation.timer("forward"):
+                            ab_batch = self.colorizer.predict([L for _, _, L in batch],
+                                                              names=[item for item, _, _ in batch])
+                    except Exception as error:
+                        self._skip([item for item, _, _ in batch], error)
+                        batch = []
+                        continue
+                    self.instrumentation.count("forward_batches")
+                    for (item, image, _), ab in zip(batch, ab_batch):
+                        if not self._put(encode_queue, (item, image, ab)):
+                            return
+                    batch = []
+        except Exception as error:
+            self._fail(error)
+        finally:
+            for _ in range(self.encode_workers):
+                self._put(encode_queue, _DONE)
+
+    def _encode_worker(self, encode_queue):
+        try:
+            while True:
+                entry = self._get(encode_queue)
+                if entry is _DONE:
+                    break
+                item, image, ab = entry
+                try:
+                    with self.instrumentation.timer("reconstruction", item):
+                        colorized = self.colorizer.reconstruct(image, ab)
+                    self.encode(item, colorized)
+                except Exception as error:
+                    self._skip([item], error)
+                    continue
+                self.instrumentation.count("images")
+                with self._lock:
+                    self._processed += 1
+        except Exception as error:
+            self._fail(error)
@@ -0,0 +1,248 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+# This module keeps track of the input files already processed by a folder run. Every completed image is appended
+# as a JSON line to a manifest file in the output folder, right after its output has been saved, with the time it
+# took; the images that failed are appended with their error. If the run is interrupted, the manifest tells the next
+# run (started with --resume) which images can be skipped, the failed ones being tried again.
+#
+# A large folder can be split between several processes or machines sharing the output folder, without any
+# coordination: with --shard i/N, a run only processes the files whose name hashes to shard i out of N, and writes
+# its own manifest (manifest.shard-i-of-N.jsonl). The hash of a name doesn't depend on the other files, so adding
+# files to the folder never moves the existing ones to another shard. merge_manifests combines the manifests of the
+# shards, and reports the missing, duplicated and failed images.
+
+# Name of the manifest file in the output folder
+MANIFEST_NAME = "manifest.jsonl"
+
+# Names of the manifest files of the shards
+_SHARD_MANIFEST_RE = re.compile(r"^manifest\.shard-(\d+)-of-(\d+)\.jsonl$")
+
+
+def parse_shard(value):
+    """
+    Parses the --shard argument "i/N": shard i (from 0 to N - 1) out of N.
+
+    :param value: value of the argument
+    :return: tuple (i, N)
+    """
+    index, _, count = value.partition("/")
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError("The shard must be i/N with 0 <= i < N.")
+    return index, count
+
+
+def shard_of(name, count):
+    """
+    Assigns a file to a shard from its name only, so the assignment is the same on every machine and doesn't change
+    when files are added to or removed from the folder.
+
+    :param name: name of the input file
+    :param count: number of shards
+    :return: index of the shard of the file, from 0 to count - 1
+    """
+    digest = hashlib.sha1(name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+def manifest_name(shard=None):
+    """
+    :param shard: optional (i, N) tuple returned by parse_shard
+    :return: name of the manifest file of a run, or of a shard
+    """
+    if shard is None:
+        return MANIFEST_NAME
+    return f"manifest.shard-{shard[0]}-of-{shard[1]}.jsonl"
+
+
+def shard_manifests(output_dir):
+    """
+    Lists the manifests of the shards in an output folder.
+
+    :param output_dir: output folder of the runs
+    :return: list of ((i, N), path) tuples, sorted by shard
+    """
+    manifests = []
+    for name in os.listdir(output_dir):
+        match = _SHARD_MANIFEST_RE.match(name)
+        if match:
+            manifests.append(((int(match.group(1)), int(match.group(2))), os.path.join(output_dir, name)))
+    return sorted(manifests)
+
+
+def read_manifest(path):
+    """
+    Reads the entries of a manifest, skipping the lines truncated by an interrupted run.
+
+    :param path: path of the manifest file
+    :return: list of the entries, in order: {"input", "output", "seconds"} dictionaries (with "member" for the outputs
+             written into an archive) for the completed images and
+             {"input", "error"} dictionaries for the failed ones
+    """
+    entries = []
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line truncated by an interrupted run
+                    continue
+                if isinstance(entry, dict) and "input" in entry:
+                    entries.append(entry)
+    return entries
+
+
+def _final_entries(path):
+    # The last entry of an input wins: an image that failed and then succeeded on a later run is done. Returns the
+    # entries of the completed images and the errors of the failed ones, by input name
+    done = {}
+    failures = {}
+    for entry in read_manifest(path):
+        if "error" in entry:
+            done.pop(entry["input"], None)
+            failures[entry["input"]] = entry["error"]
+        else:
+            failures.pop(entry["input"], None)
+            done[entry["input"]] = entry
+    return done, failures
+
+
+class RunManifest:
+    """
+    Append-only record of the input files completed, or failed, by a run.
+    """
+
+    def __init__(self, path):
+        """
+        Loads the entries already recorded in the manifest, if it exists.
+
+        :param path: path of the manifest file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        done, self.failures = _final_entries(path)
+        self._done = {input_name: entry["output"] for input_name, entry in done.items()}
+
+    def is_done(self, input_name, output_path):
+        """
+        Checks if an input has already been processed into the given output, and the output still exists.
+
+        :param input_name: name of the input file
+        :param output_path: path where the output of the input is saved
+        :return: True if the input can be skipped
+        """
+        return self._done.get(input_name) == output_path and os.path.exists(output_path)
+
+    def record(self, input_name, output_path, seconds=None, member=None):
+        """
+        Records that an input has been processed and its output saved.
+
+        :param input_name: name of the input file
+        :param output_path: path where the output has been saved, or of the archive it has been written into
+        :param seconds: optional time taken by the image, from the start of its decoding to the end of its saving
+        :param member: name of the output in the archive, if the output has been written into an archive
+        """
+        entry = {"input": input_name, "output": output_path}
+        if member is not None:
+            entry["member"] = member
+        if seconds is not None:
+            entry["seconds"] = round(seconds, 4)
+        with self._lock:
+            self._append(entry)
+            self.failures.pop(input_name, None)
+            self._done[input_name] = output_path
+
+    def record_failure(self, input_name, error):
+        """
+        Records that an input couldn't be processed, so that it is tried again by the next run.
+
+        :param input_name: name of the input file
+        :param error: exception raised, or error message
+        """
+        message = f"{type(error).__name__}: {error}" if isinstance(error, BaseException) else str(error)
+        with self._lock:
+            self._append({"input": input_name, "error": message})
+            self._done.pop(input_name, None)
+            self.failures[input_name] = message
+
+    def _append(self, entry):
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(entry) + "\n")
+
+
+def merge_manifests(output_dir, input_names=None):
+    """
+    Combines the manifests of the shards of an output folder into its manifest (MANIFEST_NAME), which also keeps the
+    entries of the unsharded runs, and checks the work done.
+
+    :param output_dir: output folder shared by the shards
+    :param input_names: optional names of all the input files, to find the images that no shard processed
+    :return: dictionary with the statistics of each shard ("shards"), the shards without a manifest
+             ("missing_shards"), the number of completed images, the images completed more than once ("duplicated"),
+             by a shard they don't belong to ("misplaced"), whose output no longer exists ("lost"), that failed
+             ("failed", with their error), that were never processed ("missing"), and the sorted names of the
+             images to process again ("requeue")
+    """
+    manifests = shard_manifests(output_dir)
+    if not manifests:
+        raise ValueError(f"No shard manifest in {output_dir}")
+
+    completed = {}  # input -> list of the entries of the shards that completed it
+    failed = {}  # input -> error
+    misplaced = set()
+    shards = []
+    for shard, path in manifests:
+        done, failures = _final_entries(path)
+        for input_name, entry in done.items():
+            completed.setdefault(input_name, []).append(entry)
+            if shard_of(input_name, shard[1]) != shard[0]:
+                misplaced.add(input_name)
+        failed.update(failures)
+        shards.append({"shard": f"{shard[0]}/{shard[1]}", "completed": len(done), "failed": len(failures),
+                       "seconds": round(sum(entry.get("seconds", 0) for entry in done.values()), 3)})
+    duplicated = sorted(name for name, entries in completed.items() if len(entries) > 1)
+
+    # The manifest of the output folder holds the unsharded runs and the previous merges: its entries only count for
+    # the images that no shard completed
+    done, failures = _final_entries(os.path.join(output_dir, MANIFEST_NAME))
+    for input_name, entry in done.items():
+        completed.setdefault(input_name, [entry])
+    for input_name, error in failures.items():
+        failed.setdefault(input_name, error)
+
+    counts = sorted({shard[1] for shard, _ in manifests})
+    present = {shard for shard, _ in manifests}
+    missing_shards = [f"{index}/{count}" for count in counts for index in range(count) if (index, count) not in present]
+
+    lost = sorted(name for name, entries in completed.items() if not os.path.exists(entries[-1]["output"]))
+    failed = {name: error for name, error in sorted(failed.items()) if name not in completed}
+    missing = []
+    if input_names is not None:
+        missing = sorted(set(input_names) - set(completed) - set(failed))
+
+    # The merged manifest is written next to the old one and renamed, so it is never left half written
+    merged_path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(merged_path + ".tmp", "w", encoding="utf-8") as file:
+        for name, entries in sorted(completed.items()):
+            if name not in lost:
+                file.write(json.dumps(entries[-1]) + "\n")
+        for name, error in failed.items():
+            file.write(json.dumps({"input": name, "error": error}) + "\n")
+    os.replace(merged_path + ".tmp", merged_path)
+
+    return {
+        "shards": shards,
+        "missing_shards": missing_shards,
+        "completed": len(completed) - len(lost),
+        "duplicated": duplicated,
+        "misplaced": sorted(misplaced),
+        "lost": lost,
+        "failed": failed,
+        "missing": missing,
+        "requeue": sorted(set(failed) | set(missing) | set(lost)),
+    }
@@ -1,14 +1,23 @@
 import cv2
-import numpy as np
 import os
+import posixpath
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from archive_io import ArchiveReader, is_archive
+from canvas_layout import GridLayout
+
 
+# The comparison images are composed by canvas_layout.GridLayout: the canvas is allocated once and the caption bands,
+# font sizes and gaps scale with the size of the images. The proportions were originally tuned for images with
+# approximate dimensions of 3000x4000 pixels, so that the comparisons are clear and readable even for large images.
 
-# All aesthetic parameters such as padding size and font size are based on images with approximate dimensions of
-# 3000x4000 pixels. The padding height, font scale, and text thickness were chosen to ensure that the comparison
-# images are clear and readable, even for images with large dimensions. Adjusting these parameters might be necessary
-# for different image sizes to maintain consistency and legibility.
+# Layout of the comparisons saved by save_input_preprocess: two images with left aligned captions, separated by a
+# black bar (100 px for 4000 px high images)
+PREPROCESS_LAYOUT = GridLayout(columns=2, gap_ratio=0.025, gap_color=(0, 0, 0), caption_align="left")
 
-def save_input_preprocess(original, edited, filename, output, elaboration):
+
+def save_input_preprocess(original, edited, filename, output, elaboration, layout=PREPROCESS_LAYOUT, writer=None,
+                          on_error=None):
     """
     Saves an image that contains both original and edited inputs, side by side, with text annotations.
     This is useful for comparing the effects of different image processing techniques.
@@ -16,48 +25,31 @@ def save_input_preprocess(original, edited, filename, output, elaboration):
     :param original: image without modification
     :param edited: image with modification
     :param filename: name of the file
-    :param output: folder to save the comparison
+    :param output: folder to save the comparison, relative to the root of the archive if the writer writes into one
     :param elaboration: name of the modification
+    :param layout: GridLayout of the comparison
+    :param writer: optional image_writer.WriterPool saving the comparison in the background, in a compressed format
+                   (see EncoderSettings.for_comparisons)
+    :param on_error: optional function called by the writer with the path and the exception if the comparison can't
+                     be saved
     """
 
     # Ensure the "Comparison" subfolder exists within the output folder
     comparison_folder = os.path.join(output, "Comparison")
-    os.makedirs(comparison_folder, exist_ok=True)  # Create the folder if it doesn't exist
-
-    # Define the font and size for the text
-    font = cv2.FONT_HERSHEY_COMPLEX
-    font_scale = 5  # Adjust font size for visibility
-    color = (0, 0, 0)  # Black color for text
-    thickness = 10
-
-    # Calculate the padding size (white space) above the image
-    padding_height = 400  # You can adjust this value to get more or less padding
-    original_height, original_width = original.shape[:2]
-    edited_height, edited_width = edited.shape[:2]
-
-    # Add white padding above the images
-    original_padded = np.ones((original_height + padding_height, original_width, 3),
-                              dtype=np.uint8) * 255  # White padding
-    edited_padded = np.ones((edited_height + padding_height, edited_width, 3), dtype=np.uint8) * 255  # White padding
-
-    # Place the original and edited images below the padding
-    original_padded[padding_height:, :] = original
-    edited_padded[padding_height:, :] = edited
-
-    # Add text above the images
-    cv2.putText(original_padded, f" No {elaboration}", (10, padding_height // 2), font, font_scale, color, thickness)
-    cv2.putText(edited_padded, f" With {elaboration}", (10, padding_height // 2), font, font_scale, color, thickness)
+    if writer is None or writer.archive is None:
+        os.makedirs(comparison_folder, exist_ok=True)  # Create the folder if it doesn't exist
 
-    # Add a space between the images by creating an empty space (e.g., a black bar)
-    space = np.zeros((max(original_padded.shape[0], edited_padded.shape[0]), 100, 3),
-                     dtype=np.uint8)  # Adjust width (50) for spacing
-
-    # Combine original, space, and edited images
-    combined_image = np.hstack((original_padded, space, edited_padded))
+    # Draw the original and edited images side by side, with their captions above them
+    combined_image = layout.render([original, edited], [f" No {elaboration}", f" With {elaboration}"])
 
     # Save the combined image
     output_path = os.path.join(comparison_folder, f"comparison_{elaboration}_{filename}")
-    cv2.imwrite(output_path, combined_image)
+    if writer is not None:
+        settings = writer.settings.for_comparisons()
+        writer.submit(settings.output_path(output_path), combined_image, bgr=True, on_error=on_error,
+                      settings=settings)
+    else:
+        cv2.imwrite(output_path, combined_image)
 
 
 def read_images_from_folders(folders):
@@ -84,6 +76,128 @@ def read_images_from_folders(folders):
     return images_by_position
 
 
+# Extensions of the files read as images
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.tif')
+
+# Prefixes added to the file names by bw2color_image_folder, removed to match the images of different folders
+OUTPUT_PREFIXES = ("removedGrainAndScratches__", "equalized_hist_", "colorized_", "denoised_")
+
+# Flags of cv2.imread for a decoding at full resolution or reduced by a factor of 2, 4 or 8
+_REDUCED_READ_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def normalized_stem(filename, prefixes=OUTPUT_PREFIXES):
+    """
+    Returns the name used to match the same image across folders: the file name without extension, without the
+    prefix added by the colorization and in lower case.
+
+    :param filename: name of the file
+    :param prefixes: prefixes to remove from the name
+    :return: normalized name
+    """
+    stem = os.path.splitext(filename)[0]
+    for prefix in prefixes:
+        if stem.startswith(prefix):
+            stem = stem[len(prefix):]
+            break
+    return stem.lower()
+
+
+def iter_images_by_stem(folders, reduce=1, prefixes=OUTPUT_PREFIXES, workers=1):
+    """
+    Matches the images of multiple folders by normalized file name and yields them one position at a time. Only the
+    file names are listed upfront, the images are decoded lazily, so the memory used doesn't depend on the number of
+    images. Zip and tar archives can be given instead of folders: their images are matched by file name, ignoring
+    their subfolder, and decoded in memory without extracting them. The positions are sorted by name, and the names
+    missing from some of the folders, or whose file can't be read in one of them, are reported and skipped.
+
+    :param folders: list of folders (or archives) containing the images.
+    :param reduce: decode the images at 1/reduce of their resolution (1, 2, 4 or 8), useful for quick previews.
+    :param prefixes: prefixes to remove from the file names before matching them.
+    :param workers: number of threads decoding the images of a position in parallel.
+    :return: generator of (stem, images) tuples, where images contains the image of each folder, in the same order.
+    """
+    if reduce not in _REDUCED_READ_FLAGS:
+        raise ValueError("reduce must be 1, 2, 4 or 8.")
+    read_flag = _REDUCED_READ_FLAGS[reduce]
+
+    # Index the files of each folder (or archive) by normalized name
+    readers = [ArchiveReader(folder) if is_archive(folder) else None for folder in folders]
+    try:
+        paths_by_folder = []
+        for folder, reader in zip(folders, readers):
+            paths = {}
+            if reader is not None:
+                for name in reader.names():
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        paths.setdefault(normalized_stem(posixpath.basename(name), prefixes), name)
+            else:
+                for item in sorted(os.listdir(folder)):
+                    item_path = os.path.join(folder, item)
+                    if os.path.isfile(item_path) and item.lower().endswith(IMAGE_EXTENSIONS):
+                        paths.setdefault(normalized_stem(item, prefixes), item_path)
+            paths_by_folder.append(paths)
+
+        # Report the names that can't be matched in all the folders
+        all_stems = set().union(*paths_by_folder)
+        for folder, paths in zip(folders, paths_by_folder):
+            for stem in sorted(all_stems - set(paths)):
+                print(f"[INFO] {stem} is missing from {folder}, skipped")
+
+        def read(reader, path):
+            if reader is None:
+                return cv2.imread(path, read_flag)
+            return cv2.imdecode(np.frombuffer(reader.read(path), dtype=np.uint8), read_flag)
+
+        with ThreadPoolExecutor(max(1, workers)) as executor:
+            for stem in sorted(set.intersection(*(set(paths) for paths in paths_by_folder))):
+                stem_paths = [paths[stem] for paths in paths_by_folder]
+                images = list(executor.map(read, readers, stem_paths))
+                unreadable = [path for path, image in zip(stem_paths, images) if image is None]
+                if unreadable:
+                    print(f"[ERROR] Can't read {', '.join(unreadable)}, {stem} skipped")
+                    continue
+                yield stem, images
+    finally:
+        for reader in readers:
+            if reader is not None:
+                reader.close()
+
+
+# The captions below are provided as examples, assuming the folders given as input contain images
+# corresponding to different stages of processing. These captions are customizable to match the
+# specific folder names or processing steps you are using in your project.
+BENCHMARK_CAPTIONS = [
+    "Input",
+    "Colorized",
+    "Denoised + Colorized",
+    "Hist. Equalized + Colorized",
+    "Morph. Ops + Colorized",
+    "Photoshop Colorization"
+]
+
+
+def compose_comparison(images_at_position, caption=BENCHMARK_CAPTIONS, layout=None, executor=None):
+    """
+    Builds the comparison image of a single position: the images are resized to the same height, captioned and
+    arranged in rows (by default the first 3 images and the remaining ones).
+
+    :param images_at_position: list of BGR images to compare.
+    :param caption: list of captions, one for each image.
+    :param layout: GridLayout of the comparison, by default 3 columns at full resolution.
+    :param executor: optional concurrent.futures.Executor drawing the images in parallel.
+    :return: the comparison image.
+    """
+    if layout is None:
+        layout = GridLayout(columns=3)
+    return layout.render(images_at_position, caption, executor)
+
+
 def concatenate_images(images_by_position, output_path):
     """
     Concatenates images from different folders with captions and padding, and arranges them into rows for comparison.
@@ -94,96 +208,34 @@ def concatenate_images(images_by_position, output_path):
     :param output_path: path to save the concatenated images.
     """
     num_images = min(len(folder_images) for folder_images in images_by_position)  # Min images across folders
-    padding = 20  # Padding between images
-
-    # The captions below are provided as examples, assuming the folders given as input contain images
-    # corresponding to different stages of processing. These captions are customizable to match the
-    # specific folder names or processing steps you are using in your project.
-
-    caption = [
-        "Input",
-        "Colorized",
-        "Denoised + Colorized",
-        "Hist. Equalized + Colorized",
-        "Morph. Ops + Colorized",
-        "Photoshop Colorization"
-    ]
-
-    # Define the font and size for the text
-    font = cv2.FONT_HERSHEY_COMPLEX
-    font_scale = 5  # Adjust font size for visibility
-    text_color = (0, 0, 0)  # Black text
-    text_thickness = 10
-    caption_padding = 400  # Space for the caption above each image
 
     for i in range(num_images):
         # Get all images for the i-th position
         images_at_position = [folder_images[i] for folder_images in images_by_position]
-
-        # Ensure all images are resized to the same height
-        height = max(img.shape[0] for img in images_at_position)
-        resized_images = [
-            cv2.resize(img, (int(img.shape[1] * height / img.shape[0]), height))
-            for img in images_at_position
-        ]
-
-        # Add captions and padding to each image
-        def add_caption_and_padding(image, caption_text):
-            """
-            Adds a caption and top padding to an image.
-            """
-            # Calculate the width of the caption text
-            text_size = cv2.getTextSize(caption_text, font, font_scale, text_thickness)[0]
-            text_x = (image.shape[1] - text_size[0]) // 2  # Center the text horizontally
-            text_y = caption_padding // 2 + text_size[1]  # Center the text vertically in padding
-
-            # Create a white image for padding and add text
-            padded_image = np.ones((image.shape[0] + caption_padding, image.shape[1], 3), dtype=np.uint8) * 255
-            padded_image[caption_padding:, :] = image  # Place the original image below the padding
-            cv2.putText(padded_image, caption_text, (text_x, text_y), font, font_scale, text_color, text_thickness)
-
-            return padded_image
-
-        images_with_captions = [
-            add_caption_and_padding(image, caption[idx])
-            for idx, image in enumerate(resized_images)
-        ]
-
-        # Split images into two rows: first 3 images and last 2 images
-        row1 = images_with_captions[:3]
-        row2 = images_with_captions[3:]
-
-        # Create padded rows
-        def create_row(images):
-            if not images:
-                return None
-            # Add padding between images
-            padded_images = [
-                                np.pad(img, ((0, 0), (0, padding), (0, 0)), mode="constant", constant_values=255)
-                                for img in images[:-1]
-                            ] + [images[-1]]  # No padding after the last image
-            return np.hstack(padded_images)
-
-        row1_padded = create_row(row1)
-        row2_padded = create_row(row2)
-
-        # Determine final image dimensions and combine rows
-        if row2_padded is not None:
-            max_width = max(row1_padded.shape[1], row2_padded.shape[1])
-            row1_padded = np.pad(
-                row1_padded, ((0, padding), (0, max_width - row1_padded.shape[1]), (0, 0)), mode="constant",
-                constant_values=255
-            )
-            row2_padded = np.pad(
-                row2_padded, ((0, 0), (0, max_width - row2_padded.shape[1]), (0, 0)), mode="constant",
-                constant_values=255
-            )
-            final_image = np.vstack((row1_padded, row2_padded))
-        else:
-            final_image = row1_padded
+        final_image = compose_comparison(images_at_position)
 
         # Save the concatenated image
         output_image_path = os.path.join(output_path, f"comparison_{i + 1}.jpg")
         cv2.imwrite(output_image_path, final_image)
 
     print("Comparison images saved.")
+
+
+def save_comparisons(images_by_stem, output_path, layout=None, workers=1):
+    """
+    Composes and saves the comparison of each position yielded by iter_images_by_stem, one position at a time: only
+    the images of the current position and its comparison are held in memory. The images of the position are drawn
+    on the canvas by workers threads in parallel.
+
+    :param images_by_stem: iterable of (stem, images) tuples.
+    :param output_path: path to save the concatenated images.
+    :param layout: GridLayout of the comparisons, e.g. GridLayout(columns=6, cell_height=256) for a contact sheet.
+    :param workers: number of threads drawing the images of a comparison.
+    """
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        for stem, images_at_position in images_by_stem:
+            comparison = compose_comparison(images_at_position, layout=layout, executor=executor)
+            del images_at_position
+            cv2.imwrite(os.path.join(output_path, f"comparison_{stem}.jpg"), comparison)
+
+    print("Comparison images saved.")
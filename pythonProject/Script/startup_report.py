@@ -0,0 +1,141 @@
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# This script measures the startup time of the scripts, which dominates short jobs such as cron runs on a handful of
+# images, and compares the downloaded model files with the compiled model folder of compile_model.py. Each run starts
+# a fresh Python interpreter that imports the modules, loads the model and runs a first forward pass on a blank
+# network input, and reports the time of each phase:
+#
+#   - "eager": the downloaded model (--prototxt, --model, --points), with matplotlib and Pillow imported upfront, as
+#     the scripts did before they imported them lazily;
+#   - "files": the downloaded model, with the lazy imports;
+#   - "compiled": the compiled model (--compiled), with the lazy imports.
+#
+# "files" against "compiled" gives the gain of the compiled model alone, "eager" against "files" the gain of the lazy
+# imports alone.
+#
+# With --fingerprint, the fingerprint needed by the prediction cache and the duplicate index is computed too: from the
+# model files for "files", read from the compiled folder for "compiled". The medians of --repeat runs are reported,
+# and saved as JSON with --json. The first runs warm up the page cache, so the results are those of a warm start.
+
+# Modules imported upfront by the scripts before they were imported lazily
+EAGER_IMPORTS = ("matplotlib.pyplot", "PIL.Image")
+
+# Code run by each interpreter: sys.argv[1] holds the settings as JSON, and the durations are printed as JSON
+_PROBE = """
+import json
+import sys
+import time
+start = time.perf_counter()
+import numpy as np
+from colorizer import Colorizer
+from inference_backends import OpenCVBackend
+settings = json.loads(sys.argv[1])
+for module in settings["imports"]:
+    __import__(module)
+imported = time.perf_counter()
+colorizer = Colorizer(backend=OpenCVBackend(**settings["model"]))
+loaded = time.perf_counter()
+if settings["fingerprint"]:
+    if settings["model"].get("compiled"):
+        from caffe_model import read_compiled_manifest
+        read_compiled_manifest(settings["model"]["compiled"])["fingerprint"]
+    else:
+        from ab_cache import model_fingerprint
+        model_fingerprint(settings["model"]["prototxt"], settings["model"]["model"], settings["model"]["points"])
+fingerprinted = time.perf_counter()
+colorizer.predict([np.zeros((224, 224), dtype="float32")])
+print(json.dumps({"imports": imported - start, "model_load": loaded - imported,
+                  "fingerprint": fingerprinted - loaded, "first_forward": time.perf_counter() - fingerprinted}))
+"""
+
+# Phases reported by the probe, in order
+PHASES = ("imports", "model_load", "fingerprint", "first_forward")
+
+# Construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser()
+ap.add_argument("-p", "--prototxt", type=str, required=True,
+                help="path to Caffe prototxt file")
+ap.add_argument("-m", "--model", type=str, required=True,
+                help="path to Caffe pre-trained model")
+ap.add_argument("-c", "--points", type=str, required=True,
+                help="path to cluster center points")
+ap.add_argument("--compiled", type=str, required=True,
+                help="folder of the model compiled by compile_model.py from the same files")
+ap.add_argument("--repeat", type=int, default=5,
+                help="number of runs of each variant, the median is reported")
+ap.add_argument("--fingerprint", action="store_true",
+                help="also compute the fingerprint of the model, as with --cache-dir or --dedup-index")
+ap.add_argument("--json", type=str, default=None,
+                help="optional path of a JSON file where the results are saved")
+args = vars(ap.parse_args())
+
+if args["repeat"] < 1:
+    ap.error("--repeat must be a positive integer")
+
+# The eager imports of the scripts are only measured if the packages are installed
+eager_imports = [module for module in EAGER_IMPORTS if importlib.util.find_spec(module.split(".")[0]) is not None]
+for module in EAGER_IMPORTS:
+    if module not in eager_imports:
+        print(f"[INFO] {module} is not installed, its import is not measured")
+
+model_files = {"prototxt": os.path.abspath(args["prototxt"]), "model": os.path.abspath(args["model"]),
+               "points": os.path.abspath(args["points"])}
+variants = {
+    "eager": {"imports": eager_imports, "model": model_files},
+    "files": {"imports": [], "model": model_files},
+    "compiled": {"imports": [], "model": {"compiled": os.path.abspath(args["compiled"])}},
+}
+
+
+def run_probe(settings):
+    """
+    Runs the probe in a new interpreter.
+
+    :param settings: settings of the variant
+    :return: dictionary with the duration in seconds of each phase and of the whole process ("total")
+    """
+    settings = dict(settings, fingerprint=args["fingerprint"])
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", _PROBE, json.dumps(settings)], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    total = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f"The startup probe failed:\n{completed.stderr}")
+    durations = json.loads(completed.stdout.strip().splitlines()[-1])
+    durations["total"] = total
+    return durations
+
+
+# The variants are interleaved, so that a change of load on the machine affects both of them
+runs = {name: [] for name in variants}
+print(f"[INFO] Measuring {args['repeat']} starts of each variant...")
+for _ in range(args["repeat"]):
+    for name, settings in variants.items():
+        runs[name].append(run_probe(settings))
+
+results = {name: {phase: statistics.median(run[phase] for run in variant_runs) * 1000
+                  for phase in PHASES + ("total",)}
+           for name, variant_runs in runs.items()}
+
+print(f"{'phase':>14}" + "".join(f"{name:>12}" for name in variants))
+for phase in PHASES + ("total",):
+    if phase == "fingerprint" and not args["fingerprint"]:
+        continue
+    print(f"{phase:>14}" + "".join(f"{results[name][phase]:>9.1f} ms" for name in variants))
+speedup = results["files"]["total"] / results["compiled"]["total"]
+print(f"[INFO] The compiled model starts {speedup:.2f}x as fast as the model files "
+      f"({results['files']['total'] - results['compiled']['total']:.0f} ms saved per run)")
+print(f"[INFO] The lazy imports save {results['eager']['imports'] - results['files']['imports']:.0f} ms per run")
+
+if args["json"]:
+    with open(args["json"], "w", encoding="utf-8") as file:
+        json.dump({"repeat": args["repeat"], "fingerprint": args["fingerprint"], "results_ms": results}, file,
+                  indent=2)
+    print(f"[INFO] Saved results to {args['json']}")
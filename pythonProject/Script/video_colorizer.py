@@ -0,0 +1,143 @@
+import numpy as np
+from instrumentation import Instrumentation
+
+# This module colorizes sequences of frames (digitized film, exported frame folders) running the network on keyframes
+# only. Consecutive frames are nearly identical, so their 'ab' predictions are too: a frame becomes a keyframe when
+# its network input differs enough from the one of the previous keyframe (mean absolute difference of the 'L'
+# channel), when the histogram of its 'L' channel changes abruptly (a scene cut), or when too many frames went by
+# since the last keyframe. The frames in between reuse the low resolution 'ab' prediction of the keyframes, blended
+# linearly between the previous and the next keyframe of the same scene, which also smooths out the color flicker of
+# independent predictions. Only the full resolution reconstruction runs on every frame.
+
+# Default mean absolute difference of the 'L' network input (on the 0-100 scale of L) starting a new keyframe
+DEFAULT_KEYFRAME_THRESHOLD = 3.0
+
+# Default histogram distance (0 for identical histograms, 1 for disjoint ones) detecting a scene cut
+DEFAULT_SCENE_THRESHOLD = 0.3
+
+# Default maximum number of frames between two keyframes
+DEFAULT_MAX_INTERVAL = 30
+
+# Number of bins of the histograms of the 'L' network inputs compared to detect scene cuts
+_HISTOGRAM_BINS = 32
+
+
+def lightness_histogram(L):
+    """
+    :param L: mean centered L channel, as returned by Colorizer.prepare
+    :return: normalized histogram of the L values
+    """
+    histogram, _ = np.histogram(L, bins=_HISTOGRAM_BINS, range=(-50, 50))
+    return histogram / max(1, histogram.sum())
+
+
+def histogram_distance(histogram, other):
+    """
+    :param histogram: normalized histogram returned by lightness_histogram
+    :param other: another normalized histogram
+    :return: fraction of the pixels that would have to change bin to turn one histogram into the other (0 to 1)
+    """
+    return 0.5 * float(np.abs(histogram - other).sum())
+
+
+class KeyframeColorizer:
+    """
+    Colorizes a sequence of frames with a Colorizer, running the network on keyframes only.
+    """
+
+    def __init__(self, colorizer, keyframe_threshold=DEFAULT_KEYFRAME_THRESHOLD,
+                 scene_threshold=DEFAULT_SCENE_THRESHOLD, max_interval=DEFAULT_MAX_INTERVAL, blend=True,
+                 instrumentation=None):
+        """
+        :param colorizer: Colorizer running the network and the reconstruction
+        :param keyframe_threshold: mean absolute difference of the 'L' network input to the previous keyframe from
+                                   which a frame becomes a keyframe, 0 to run the network on every frame
+        :param scene_threshold: histogram distance to the previous keyframe detecting a scene cut
+        :param max_interval: maximum number of frames between two keyframes
+        :param blend: True to blend the predictions of the keyframes before and after each frame, False to reuse the
+                      prediction of the previous keyframe. Blending holds the frames between two keyframes in memory
+        :param instrumentation: optional Instrumentation timing the stages
+        """
+        if keyframe_threshold < 0 or scene_threshold < 0:
+            raise ValueError("The keyframe and scene thresholds must not be negative.")
+        if max_interval < 1:
+            raise ValueError("max_interval must be a positive integer.")
+
+        self.colorizer = colorizer
+        self.keyframe_threshold = keyframe_threshold
+        self.scene_threshold = scene_threshold
+        self.max_interval = max_interval
+        self.blend = blend
+        self.instrumentation = instrumentation or Instrumentation()
+
+        self.frames = 0
+        self.keyframes = 0
+        self.scene_cuts = 0
+
+    def colorize(self, frames):
+        """
+        Colorizes frames lazily, in order. With blending, the frames following a keyframe are yielded once the next
+        keyframe has been found.
+
+        :param frames: iterable of (item, image, net_image) tuples, where item identifies the frame (e.g. its index),
+                       image is the BGR or grayscale frame (uint8) and net_image is None or the image used for the
+                       network input, see Colorizer.prepare
+        :return: generator of (item, colorized RGB frame) tuples
+        """
+        key = None  # (L, histogram, ab) of the last keyframe
+        pending = []  # (item, image) of the frames since the last keyframe, waiting for the next one to be blended
+        since_key = 0
+
+        for item, image, net_image in frames:
+            self.frames += 1
+            with self.instrumentation.timer("network_input", item):
+                image, L = self.colorizer.prepare(image, net_image)
+            histogram = lightness_histogram(L)
+
+            cut = key is None or key[0].shape != L.shape or \
+                histogram_distance(histogram, key[1]) > self.scene_threshold
+            if not cut and since_key + 1 < self.max_interval and \
+                    float(np.abs(L - key[0]).mean()) < self.keyframe_threshold:
+                since_key += 1
+                if self.blend:
+                    pending.append((item, image))
+                else:
+                    yield item, self._reconstruct(item, image, key[2])
+                continue
+
+            with self.instrumentation.timer("forward", item):
+                ab = self.colorizer.predict([L])[0]
+            self.keyframes += 1
+            self.scene_cuts += cut and key is not None
+
+            # The frames between the previous keyframe and this one, blended only within the same scene
+            for index, (pending_item, pending_image) in enumerate(pending):
+                if cut:
+                    pending_ab = key[2]
+                else:
+                    weight = (index + 1) / (len(pending) + 1)
+                    pending_ab = key[2] * (1 - weight) + ab * weight
+                yield pending_item, self._reconstruct(pending_item, pending_image, pending_ab)
+            pending = []
+
+            yield item, self._reconstruct(item, image, ab)
+            key = (L, histogram, ab)
+            since_key = 0
+
+        # The frames after the last keyframe have no next keyframe to blend with
+        for pending_item, pending_image in pending:
+            yield pending_item, self._reconstruct(pending_item, pending_image, key[2])
+
+    def summary(self):
+        """
+        :return: a one line summary of the frames colorized and of the forward passes run
+        """
+        saved = 1 - self.keyframes / self.frames if self.frames else 0
+        return (f"{self.frames} frames, {self.keyframes} keyframes ({self.scene_cuts} scene cuts), "
+                f"{saved:.0%} of the forward passes skipped")
+
+    def _reconstruct(self, item, image, ab):
+        with self.instrumentation.timer("reconstruction", item):
+            colorized = self.colorizer.reconstruct(image, ab)
+        self.instrumentation.count("images")
+        return colorized